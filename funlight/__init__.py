@@ -1,13 +1,13 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
-from flask_socketio import SocketIO
 from flask_migrate import Migrate
 import os
-from sqlalchemy import text
+from sqlalchemy import inspect, text
+from funlight.instrumentation import InstrumentedSocketIO
 
 db = SQLAlchemy()
-socketio = SocketIO()
+socketio = InstrumentedSocketIO()
 login_manager = LoginManager()
 migrate = Migrate()
 
@@ -18,28 +18,157 @@ def create_app(test_config=None):
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev')
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///funlight.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))  # 16MB max request size
+    app.config['PERMISSION_CACHE_SIZE'] = int(os.environ.get('PERMISSION_CACHE_SIZE', 10000))
+    
+    # Write-behind message persistence (opt-in)
+    app.config['MESSAGE_WRITE_BEHIND'] = os.environ.get('MESSAGE_WRITE_BEHIND', 'false').lower() == 'true'
+    app.config['MESSAGE_BATCH_SIZE'] = int(os.environ.get('MESSAGE_BATCH_SIZE', 200))
+    app.config['MESSAGE_FLUSH_INTERVAL'] = float(os.environ.get('MESSAGE_FLUSH_INTERVAL', 0.05))
+    app.config['MESSAGE_DURABILITY'] = os.environ.get('MESSAGE_DURABILITY', 'journal')
+    app.config['MESSAGE_JOURNAL_DIR'] = os.environ.get('MESSAGE_JOURNAL_DIR', os.path.join(app.instance_path, 'message_journal'))
     
     # Setup upload folder
     app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'static', 'uploads')
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'mp4', 'webm', 'mp3', 'ogg', 'wav', 'pdf', 'doc', 'docx', 'txt'}
+    
+    # Large files are sent in chunks of at most UPLOAD_CHUNK_SIZE bytes, so the
+    # file size is only bounded by MAX_UPLOAD_SIZE and not by MAX_CONTENT_LENGTH
+    app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+    app.config['MAX_UPLOAD_SIZE'] = int(os.environ.get('MAX_UPLOAD_SIZE', 2 * 1024 * 1024 * 1024))
+    app.config['UPLOAD_SESSION_DIR'] = os.environ.get('UPLOAD_SESSION_DIR', os.path.join(app.instance_path, 'upload_sessions'))
+    app.config['UPLOAD_SESSION_TTL'] = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 60 * 60))
+    
+    # Hand upload transfers to the front proxy: 'x-sendfile' (Apache, lighttpd) or
+    # 'x-accel-redirect' (nginx, with an internal location at UPLOAD_ACCEL_PREFIX
+    # aliased to the upload folder)
+    app.config['UPLOAD_OFFLOAD'] = os.environ.get('UPLOAD_OFFLOAD', '')
+    app.config['UPLOAD_ACCEL_PREFIX'] = os.environ.get('UPLOAD_ACCEL_PREFIX', '/protected-uploads')
+    if app.config['UPLOAD_OFFLOAD'] not in ('', 'x-sendfile', 'x-accel-redirect'):
+        raise ValueError("UPLOAD_OFFLOAD must be '', 'x-sendfile' or 'x-accel-redirect'")
+    app.config['USE_X_SENDFILE'] = app.config['UPLOAD_OFFLOAD'] == 'x-sendfile'
+    
+    # Resized image variants, rendered by a process pool (0 workers disables them)
+    app.config['VARIANT_WORKERS'] = int(os.environ.get('VARIANT_WORKERS', 2))
+    app.config['VARIANT_FORMAT'] = os.environ.get('VARIANT_FORMAT', 'webp')
+    
+    # Voice/video and online presence: 'memory' (per worker) or 'database' (shared by all workers)
+    app.config['PRESENCE_BACKEND'] = os.environ.get('PRESENCE_BACKEND', 'memory')
+    app.config['PRESENCE_TTL'] = int(os.environ.get('PRESENCE_TTL', 30))
+    app.config['PRESENCE_SWEEP_INTERVAL'] = int(os.environ.get('PRESENCE_SWEEP_INTERVAL', 5))
+    
+    # Online status broadcasts are batched and only sent for real changes
+    app.config['STATUS_FLUSH_INTERVAL'] = float(os.environ.get('STATUS_FLUSH_INTERVAL', 1))
+    app.config['STATUS_OFFLINE_GRACE'] = float(os.environ.get('STATUS_OFFLINE_GRACE', 5))
+    
+    # ICE candidates for one socket are coalesced into a frame per interval (seconds)
+    app.config['SIGNALING_BATCH_INTERVAL'] = float(os.environ.get('SIGNALING_BATCH_INTERVAL', 0.01))
+    
+    # Voice channels with at least this many participants use the server as SFU
+    # instead of a peer-to-peer mesh (0 disables, needs aiortc)
+    app.config['VOICE_SFU_THRESHOLD'] = int(os.environ.get('VOICE_SFU_THRESHOLD', 0))
+    
+    # Active speakers per voice room: frames at most every SPEAKER_INTERVAL seconds,
+    # speaking means a level of SPEAKER_THRESHOLD (0-1) within SPEAKER_HOLD seconds
+    app.config['SPEAKER_INTERVAL'] = float(os.environ.get('SPEAKER_INTERVAL', 0.25))
+    app.config['SPEAKER_THRESHOLD'] = float(os.environ.get('SPEAKER_THRESHOLD', 0.05))
+    app.config['SPEAKER_HOLD'] = float(os.environ.get('SPEAKER_HOLD', 0.6))
+    
+    # Typing indicators: one frame per channel every TYPING_INTERVAL seconds, a typist
+    # expires TYPING_TTL seconds after its last ping, pings per socket and channel
+    # closer than TYPING_RATE_LIMIT seconds are dropped
+    app.config['TYPING_INTERVAL'] = float(os.environ.get('TYPING_INTERVAL', 0.5))
+    app.config['TYPING_TTL'] = float(os.environ.get('TYPING_TTL', 6))
+    app.config['TYPING_RATE_LIMIT'] = float(os.environ.get('TYPING_RATE_LIMIT', 1))
+    
+    # Reconnecting clients replay up to EVENT_BUFFER_SIZE missed events per channel,
+    # for the EVENT_BUFFER_CHANNELS most recently active channels
+    app.config['EVENT_BUFFER_SIZE'] = int(os.environ.get('EVENT_BUFFER_SIZE', 200))
+    app.config['EVENT_BUFFER_CHANNELS'] = int(os.environ.get('EVENT_BUFFER_CHANNELS', 5000))
+    
+    # 'threading' (one OS thread per socket, development) or 'eventlet'/'gevent'
+    # (green threads, production). run.py applies the matching monkey patching.
+    app.config['SOCKETIO_ASYNC_MODE'] = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+    
+    # Socket.IO message queue shared by all workers, e.g. redis://localhost:6379/0
+    # or unix:///tmp/funlight.sock for the local broker in funlight/broker.py
+    app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    app.config['SOCKETIO_CHANNEL'] = os.environ.get('SOCKETIO_CHANNEL', 'flask-socketio')
+    # Permission, channel audience and server page caches are invalidated only in
+    # the worker that made a change, so with a queue they expire after CACHE_TTL
+    # seconds (0 keeps them until invalidated)
+    app.config['CACHE_TTL'] = float(os.environ.get('CACHE_TTL', 5 if app.config['SOCKETIO_MESSAGE_QUEUE'] else 0))
+    if app.config['MESSAGE_WRITE_BEHIND'] and app.config['SOCKETIO_MESSAGE_QUEUE']:
+        # Every worker would hand out the same message ids
+        raise ValueError('MESSAGE_WRITE_BEHIND needs a single worker and cannot be used with SOCKETIO_MESSAGE_QUEUE')
+    if app.config['SOCKETIO_MESSAGE_QUEUE'] and app.config['PRESENCE_BACKEND'] == 'memory':
+        # Online status is counted in the presence store, per worker in memory
+        raise ValueError("SOCKETIO_MESSAGE_QUEUE needs PRESENCE_BACKEND='database'")
+    
+    # Per-packet Socket.IO logging, only for debugging: it is synchronous and slow
+    app.config['SOCKETIO_LOGGING'] = os.environ.get('SOCKETIO_LOGGING', 'false').lower() == 'true'
+    
+    # Share of Socket.IO events written as JSON trace records (0 disables tracing),
+    # to TRACE_LOG_FILE or the app log
+    app.config['TRACE_SAMPLE_RATE'] = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+    app.config['TRACE_LOG_FILE'] = os.environ.get('TRACE_LOG_FILE')
+    # Log handlers run on a background thread instead of the handler's
+    app.config['LOG_QUEUE'] = os.environ.get('LOG_QUEUE', 'true').lower() == 'true'
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+    # /metrics wants this bearer token if set, otherwise it only answers these addresses
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['METRICS_ALLOWED_IPS'] = set(os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(','))
+    if app.config['METRICS_ENABLED'] and app.config['UPLOAD_OFFLOAD'] and not app.config['METRICS_TOKEN']:
+        # Behind a proxy on the same host every request comes from loopback
+        raise ValueError('METRICS_TOKEN is required when the app runs behind a front proxy (UPLOAD_OFFLOAD)')
     
     # Initialize extensions
+    from funlight.green import GREEN_MODES, engine_options, offload_database
+    if app.config['SOCKETIO_ASYNC_MODE'] in GREEN_MODES:
+        if app.config['MESSAGE_WRITE_BEHIND'] and app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+            # Reads flush the writer on a second session, which would wait for
+            # the single SQLite connection the reading request already holds
+            raise ValueError('MESSAGE_WRITE_BEHIND cannot be used with SQLite in the eventlet and gevent modes')
+        offload_database(app.config['SOCKETIO_ASYNC_MODE'])
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+            **engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+        }
     db.init_app(app)
     migrate.init_app(app, db)
-    socketio.init_app(app, cors_allowed_origins="*", async_mode='threading', logger=True, engineio_logger=True)
+    
+    socketio_options = {}
+    message_queue = app.config['SOCKETIO_MESSAGE_QUEUE']
+    if message_queue and message_queue.startswith('unix://'):
+        from funlight.broker import UnixSocketManager
+        socketio_options['client_manager'] = UnixSocketManager(message_queue, channel=app.config['SOCKETIO_CHANNEL'])
+    elif message_queue:
+        socketio_options['message_queue'] = message_queue
+        socketio_options['channel'] = app.config['SOCKETIO_CHANNEL']
+    socketio.init_app(app, cors_allowed_origins="*", async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+                      logger=app.config['SOCKETIO_LOGGING'], engineio_logger=app.config['SOCKETIO_LOGGING'], **socketio_options)
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
     
     with app.app_context():
         # Import parts of our application
         from funlight.models import User
+        from funlight.permissions import permission_cache, channel_audiences
+        from funlight.snapshots import server_snapshots
+        from funlight.search import init_search_index
+        from funlight.friends import merge_legacy_friendships
         from funlight.auth import auth as auth_blueprint
         from funlight.main import main as main_blueprint
         from funlight.voice_video import voice_video as voice_video_blueprint
         from funlight.uploads import uploads as uploads_blueprint
+        from funlight.direct_messages import direct_messages as direct_messages_blueprint
         from . import routes
         
+        permission_cache.maxsize = app.config['PERMISSION_CACHE_SIZE']
+        for cache in (permission_cache, channel_audiences, server_snapshots):
+            cache.ttl = app.config['CACHE_TTL'] or None
+        
         # Create database tables
         db.create_all()
         
@@ -56,15 +185,120 @@ def create_app(test_config=None):
                     if 'boost_count' not in columns:
                         conn.execute(text("ALTER TABLE server ADD COLUMN boost_count INTEGER DEFAULT 0"))
                     
+                    # Keyset index for message history pagination
+                    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_message_channel_id_id ON message (channel_id, id)"))
+                    # Servers of a user, used for presence fan-out
+                    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_server_member_user_id ON server_member (user_id)"))
+                    
+                    result = conn.execute(text("PRAGMA table_info(server_member)"))
+                    columns = [row[1] for row in result.fetchall()]
+                    
+                    if 'nickname' not in columns:
+                        conn.execute(text("ALTER TABLE server_member ADD COLUMN nickname VARCHAR(32)"))
+                    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_server_member_server_id_id ON server_member (server_id, id)"))
+                    
+                    # Bulk joins rely on one membership per user and server, drop
+                    # duplicates left by the old check-then-insert join first
+                    unique_columns = [
+                        [info[2] for info in conn.execute(text(f"PRAGMA index_info('{index[1]}')"))]
+                        for index in conn.execute(text("PRAGMA index_list(server_member)")).fetchall() if index[2]
+                    ]
+                    if ['server_id', 'user_id'] not in unique_columns:
+                        conn.execute(text(
+                            "DELETE FROM server_member WHERE id NOT IN "
+                            "(SELECT MIN(id) FROM server_member GROUP BY server_id, user_id)"
+                        ))
+                        conn.execute(text("DELETE FROM member_roles WHERE member_id NOT IN (SELECT id FROM server_member)"))
+                        conn.execute(text(
+                            "CREATE UNIQUE INDEX uq_server_member_server_id_user_id ON server_member (server_id, user_id)"
+                        ))
+                    
+                    result = conn.execute(text("PRAGMA table_info(role)"))
+                    columns = [row[1] for row in result.fetchall()]
+                    
+                    if 'is_default' not in columns:
+                        conn.execute(text("ALTER TABLE role ADD COLUMN is_default BOOLEAN DEFAULT 0"))
+                    
+                    result = conn.execute(text("PRAGMA table_info(attachment)"))
+                    columns = [row[1] for row in result.fetchall()]
+                    
+                    if 'original_name' not in columns:
+                        conn.execute(text("ALTER TABLE attachment ADD COLUMN original_name VARCHAR(255)"))
+                    
+                    result = conn.execute(text("PRAGMA table_info(channel)"))
+                    columns = [row[1] for row in result.fetchall()]
+                    
+                    if 'last_message_id' not in columns:
+                        conn.execute(text("ALTER TABLE channel ADD COLUMN last_message_id INTEGER"))
+                        # One pass over the (channel_id, id) index to seed the high-water marks
+                        conn.execute(text(
+                            "UPDATE channel SET last_message_id = "
+                            "(SELECT MAX(id) FROM message WHERE message.channel_id = channel.id)"
+                        ))
+                    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_channel_server_id ON channel (server_id)"))
+                    if 'seq' not in columns:
+                        conn.execute(text("ALTER TABLE channel ADD COLUMN seq INTEGER NOT NULL DEFAULT 0"))
+                    
+                    # Friendships moved into one friendship row per pair, the old
+                    # tables are dropped once they are merged
+                    tables = set(inspect(conn).get_table_names())
+                    if tables & {'friendships', 'friend_associations'}:
+                        merge_legacy_friendships(conn)
+                    conn.execute(text(
+                        "CREATE INDEX IF NOT EXISTS ix_friend_request_receiver_id_status "
+                        "ON friend_request (receiver_id, status)"
+                    ))
+                    conn.execute(text(
+                        "CREATE INDEX IF NOT EXISTS ix_friend_request_sender_id_receiver_id "
+                        "ON friend_request (sender_id, receiver_id)"
+                    ))
+                    
+                    # Full-text index over message content, kept in sync by triggers
+                    init_search_index(conn)
+                    
                     conn.commit()
 
         init_db()
         
+        # Before any background thread is started, the image pool forks
+        from funlight.variants import variant_worker, icon_url
+        variant_worker.init_app(app)
+        app.jinja_env.globals['icon_url'] = icon_url
+        
+        # Starts the log queue thread, so it comes after the fork
+        from funlight.instrumentation import metrics
+        metrics.init_app(app)
+        
+        from funlight.message_writer import message_writer
+        message_writer.init_app(app)
+        
+        from funlight.presence import presence
+        presence.init_app(app)
+        
+        from funlight.status import status_tracker
+        status_tracker.init_app(app)
+        
+        from funlight.signaling import signaling
+        signaling.init_app(app)
+        
+        from funlight.sfu import voice_sfu
+        voice_sfu.init_app(app)
+        
+        from funlight.speakers import speaker_tracker
+        speaker_tracker.init_app(app)
+        
+        from funlight.typing_indicators import typing_tracker
+        typing_tracker.init_app(app)
+        
+        from funlight.channel_events import channel_events
+        channel_events.init_app(app)
+        
         # Register blueprints
         app.register_blueprint(auth_blueprint)
         app.register_blueprint(main_blueprint)
         app.register_blueprint(voice_video_blueprint)
         app.register_blueprint(uploads_blueprint)
+        app.register_blueprint(direct_messages_blueprint)
         app.register_blueprint(routes.bp)
         
         @login_manager.user_loader
@@ -22,7 +22,9 @@ def register():
         if email_exists:
             flash('Email already registered')
             return redirect(url_for('auth.register'))
-            
+        # Hand the database connection back before the slow password hashing
+        db.session.close()
+        
         new_user = User(username=username, email=email)
         new_user.set_password(password)
         
@@ -42,6 +44,7 @@ def login():
         remember = True if request.form.get('remember') else False
         
         user = User.query.filter_by(username=username).first()
+        db.session.close()
         
         if not user or not user.check_password(password):
             flash('Please check your login details and try again.')
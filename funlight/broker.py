@@ -0,0 +1,165 @@
+"""Local pub/sub broker for running several Socket.IO workers on one host.
+
+Workers connect to a Unix domain socket and every frame published by one
+worker is forwarded to all others. Each connection starts with a role frame:
+a worker publishes on one connection and listens on another, and frames are
+only forwarded to listening connections. A publishing connection is never
+read by its worker, so writing to it would fill its socket buffer and
+block the broker. Start the broker with
+
+    python -m funlight.broker /tmp/funlight.sock
+
+and point every worker at it with SOCKETIO_MESSAGE_QUEUE=unix:///tmp/funlight.sock
+and PRESENCE_BACKEND=database.
+Across hosts, use a real backend such as redis:// or amqp:// instead.
+"""
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+from socketio import PubSubManager
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('!I')
+
+# First frame of every connection
+PUBLISHER = b'publisher'
+LISTENER = b'listener'
+
+def send_frame(sock, payload):
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+def recv_frame(sock):
+    """Reads one length-prefixed frame, returns None once the peer is gone."""
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    return _recv_exactly(sock, _HEADER.unpack(header)[0])
+
+def _recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+class Broker:
+    """Fans every published frame out to all listening peers."""
+    
+    def __init__(self, path):
+        self.path = path
+        self._peers = {}
+        self._lock = threading.Lock()
+    
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o600)
+        server.listen()
+        logger.info('Broker listening on %s', self.path)
+        
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=self._serve_peer, args=(conn,), daemon=True).start()
+    
+    def _serve_peer(self, conn):
+        try:
+            role = recv_frame(conn)
+            if role == LISTENER:
+                with self._lock:
+                    self._peers[conn] = threading.Lock()
+            elif role != PUBLISHER:
+                if role is not None:
+                    logger.warning('Dropping peer with unknown role %r', role[:32])
+                return
+            while True:
+                payload = recv_frame(conn)
+                if payload is None:
+                    break
+                self._forward(conn, payload)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._peers.pop(conn, None)
+            conn.close()
+    
+    def _forward(self, sender, payload):
+        with self._lock:
+            peers = [(peer, lock) for peer, lock in self._peers.items() if peer is not sender]
+        for peer, lock in peers:
+            try:
+                with lock:
+                    send_frame(peer, payload)
+            except OSError:
+                # The reader thread of that peer cleans it up
+                pass
+
+class UnixSocketManager(PubSubManager):
+    """Socket.IO client manager that talks to the local Broker.
+    
+    Used when SOCKETIO_MESSAGE_QUEUE is a unix:// URL, in the same way
+    python-socketio's RedisManager is used for redis:// URLs.
+    """
+    name = 'unix'
+    
+    def __init__(self, url='unix:///tmp/funlight.sock', channel='socketio',
+                 write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url[len('unix://'):]
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+    
+    def _connect(self, role):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        send_frame(sock, role)
+        return sock
+    
+    def _publish(self, data):
+        payload = json.dumps({'channel': self.channel, 'data': data}).encode('utf-8')
+        with self._publish_lock:
+            # One reconnect attempt, as in RedisManager
+            for retries_left in range(1, -1, -1):
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect(PUBLISHER)
+                    send_frame(self._publisher, payload)
+                    return
+                except OSError:
+                    self._publisher = None
+                    if not retries_left:
+                        self._get_logger().error('Cannot publish to broker at %s', self.path)
+    
+    def _listen(self):
+        retry_sleep = 1
+        while True:
+            try:
+                sock = self._connect(LISTENER)
+                retry_sleep = 1
+                while True:
+                    payload = recv_frame(sock)
+                    if payload is None:
+                        break
+                    message = json.loads(payload)
+                    if message.get('channel') == self.channel:
+                        yield message['data']
+            except OSError:
+                self._get_logger().error('Cannot receive from broker at %s, retrying in %d secs',
+                                         self.path, retry_sleep)
+            time.sleep(retry_sleep)
+            retry_sleep = min(retry_sleep * 2, 60)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    Broker(sys.argv[1] if len(sys.argv) > 1 else '/tmp/funlight.sock').serve_forever()
@@ -0,0 +1,114 @@
+"""Broadcast throughput of the local broker against the number of workers.
+    
+    python -m funlight.broker_bench --workers 1 2 4 8 --emits 20000
+
+Starts a Broker on a temporary socket and, for each worker count, that many
+processes with a UnixSocketManager each. Every worker publishes its share of
+--emits room broadcasts, the way workers fan out new_message, while it
+receives everybody's. It reports how long the slowest worker took to
+publish and the deliveries per second summed over all workers, from the
+first frame any of them got to the last.
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+import socketio
+
+from funlight.broker import Broker, UnixSocketManager
+
+# Time for the managers' listener threads to connect to the broker
+SETTLE_TIME = 1
+RECEIVE_TIMEOUT = 60
+
+class CountingManager(UnixSocketManager):
+    """Counts the emits it receives instead of sending them to clients."""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = 0
+        self.first = self.last = None
+    
+    def _handle_emit(self, message):
+        self.last = time.perf_counter()
+        if self.first is None:
+            self.first = self.last
+        self.received += 1
+
+def _serve(path):
+    Broker(path).serve_forever()
+
+def _work(url, emits, payload_size, total, ready, start, results):
+    manager = CountingManager(url, channel='bench')
+    socketio.Server(client_manager=manager, async_mode='threading')
+    manager.initialize()
+    time.sleep(SETTLE_TIME)
+    ready.release()
+    start.wait()
+    
+    payload = {'content': 'x' * payload_size}
+    started = time.perf_counter()
+    for i in range(emits):
+        manager.emit('new_message', dict(payload, id=i), room='channel_1')
+    published = time.perf_counter() - started
+    
+    deadline = time.monotonic() + RECEIVE_TIMEOUT
+    while manager.received < total and time.monotonic() < deadline:
+        time.sleep(0.01)
+    results.put((published, manager.received, manager.first, manager.last))
+
+def measure(context, url, workers, emits, payload_size):
+    # Every worker gets everybody's emits, its own ones are handled locally
+    per_worker = emits // workers
+    total = per_worker * workers
+    ready = context.Semaphore(0)
+    start = context.Event()
+    results = context.Queue()
+    processes = [context.Process(target=_work, args=(url, per_worker, payload_size, total, ready, start, results),
+                                 daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.acquire()
+    start.set()
+    
+    counts = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    
+    # perf_counter is CLOCK_MONOTONIC on Linux, so timestamps compare across processes
+    published = max(seconds for seconds, _, _, _ in counts)
+    received = sum(count for _, count, _, _ in counts)
+    firsts = [first for _, _, first, _ in counts if first is not None]
+    lasts = [last for _, _, _, last in counts if last is not None]
+    elapsed = max(lasts) - min(firsts) if firsts else 0
+    rate = received / elapsed if elapsed else 0
+    print(f'{workers} workers: published {total} in {published:.2f}s, '
+          f'{received}/{total * workers} delivered, {rate / 1000:.1f}k deliveries/s')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--emits', type=int, default=20000)
+    parser.add_argument('--payload-size', type=int, default=100)
+    args = parser.parse_args()
+    
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'broker.sock')
+        broker = context.Process(target=_serve, args=(path,), daemon=True)
+        broker.start()
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        
+        try:
+            for workers in args.workers:
+                measure(context, f'unix://{path}', workers, args.emits, args.payload_size)
+        finally:
+            broker.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Recent channel events, replayed to clients that reconnect.
+
+Every new_message, message_edited and messages_deleted goes out through
+publish, which numbers it with event_seq and keeps it in a ring buffer of
+the channel's last EVENT_BUFFER_SIZE events. event_seq is one counter for
+all channels, so it only ever grows, and a channel's events are increasing
+but not contiguous.
+
+joined_channel tells a client the epoch and current event_seq. After a
+reconnect the client sends resume with the channel, the epoch and the last
+event_seq it saw, and gets the buffered events after it followed by
+resumed. When the buffer no longer reaches back that far, or the epoch
+changed because the worker restarted, resumed says complete: false and the
+client catches up through the paginated history API instead.
+
+At most EVENT_BUFFER_CHANNELS channels are buffered, the least recently
+active one is dropped first. The events live in the worker's memory, like
+the 'memory' presence backend. With SOCKETIO_MESSAGE_QUEUE set, clients also
+get events that other workers numbered and buffered, so one worker's buffer
+cannot tell what a client missed. resume then always answers complete:
+false and clients catch up through the history API.
+"""
+import secrets
+import threading
+from collections import OrderedDict, deque
+
+from funlight import socketio
+
+class ChannelEventBuffer:
+    """A ring buffer of events per channel and the event_seq counter."""
+    
+    def __init__(self):
+        self.app = None
+        self.replay = True
+        # Seqs restart with the process, the epoch tells clients apart
+        self.epoch = secrets.token_hex(8)
+        self._seq = 0
+        # Events up to this seq may be lost for channels buffered from now on
+        self._evicted = 0
+        self._channels = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def init_app(self, app):
+        self.app = app
+        self.size = app.config['EVENT_BUFFER_SIZE']
+        self.max_channels = app.config['EVENT_BUFFER_CHANNELS']
+        # Other workers publish events this buffer never sees
+        self.replay = not app.config['SOCKETIO_MESSAGE_QUEUE']
+    
+    @property
+    def seq(self):
+        return self._seq
+    
+    def publish(self, channel_id, event, payload, room):
+        """Numbers, buffers and emits a channel event to room."""
+        with self._lock:
+            self._seq += 1
+            payload = dict(payload, event_seq=self._seq)
+            buffered = self._channels.get(channel_id)
+            if buffered is None:
+                buffered = self._channels[channel_id] = [self._evicted, deque()]
+                if len(self._channels) > self.max_channels:
+                    self._channels.popitem(last=False)
+                    self._evicted = self._seq - 1
+            else:
+                self._channels.move_to_end(channel_id)
+            
+            events = buffered[1]
+            if len(events) >= self.size:
+                buffered[0] = events.popleft()[0]
+            events.append((self._seq, event, payload))
+            
+            # Emitted under the lock, so events go out in event_seq order and a
+            # client resuming from the last seq it saw cannot get one twice
+            socketio.emit(event, payload, room=room)
+        return payload
+    
+    def since(self, channel_id, epoch, event_seq):
+        """The (event, payload) pairs of a channel after event_seq, None if
+        some of them are not buffered in this worker."""
+        if not self.replay:
+            return None
+        with self._lock:
+            if epoch != self.epoch or event_seq > self._seq:
+                return None
+            floor, events = self._channels.get(channel_id, (self._evicted, ()))
+            if event_seq < floor:
+                return None
+            return [(event, payload) for seq, event, payload in events if seq > event_seq]
+
+channel_events = ChannelEventBuffer()
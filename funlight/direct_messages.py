@@ -0,0 +1,268 @@
+"""Direct messages, 1:1 and in small groups.
+
+DMs have their own tables (dm_conversation, dm_participant, dm_message) and
+never touch servers, channels or roles. A 1:1 conversation is keyed by the
+canonical (user_low_id, user_high_id) pair, so it is created once and found
+with one unique lookup. Groups hold up to DM_GROUP_SIZE participants.
+
+    POST /api/dm/<friend_id>                    open the 1:1 conversation with a friend
+    POST /api/dm/groups                         {user_ids, name?} start a group
+    GET  /api/dm                                the user's conversations, latest first
+    GET  /api/dm/<id>/messages?before|after=<message_id>&limit=<n>
+    POST /api/dm/<id>/messages                  {content}, or the dm_message socket event
+
+Opening a conversation needs a friendship. Sending only checks that the
+sender participates, against the participant lists cached in memory, and
+delivers dm_message straight to the participants' user_<id> rooms.
+"""
+import threading
+from datetime import datetime
+
+from flask import Blueprint, request, jsonify, abort
+from flask_login import login_required, current_user
+from flask_socketio import emit
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+
+from funlight import socketio, db
+from funlight.friends import are_friends
+from funlight.models import User, DirectConversation, DirectParticipant, DirectMessage
+
+direct_messages = Blueprint('direct_messages', __name__)
+
+DM_GROUP_SIZE = 10
+DM_PAGE_SIZE = 50
+DM_PAGE_SIZE_MAX = 100
+
+_UPSERT_INSERTS = {
+    'sqlite': sqlite.insert,
+    'postgresql': postgresql.insert
+}
+
+class ParticipantCache:
+    """Participants per conversation.
+    
+    Participants are fixed when a conversation is created, so entries are
+    never stale and need no invalidation.
+    """
+    
+    def __init__(self):
+        self._participants = {}
+        self._lock = threading.Lock()
+    
+    def get(self, conversation_id):
+        with self._lock:
+            participants = self._participants.get(conversation_id)
+        if participants is None:
+            participants = frozenset(user_id for user_id, in db.session.query(DirectParticipant.user_id).filter(
+                DirectParticipant.conversation_id == conversation_id
+            ))
+            if participants:
+                with self._lock:
+                    self._participants[conversation_id] = participants
+        return participants
+
+dm_participants = ParticipantCache()
+
+def open_conversation(user_id, other_id):
+    """The 1:1 conversation of two users, created on first use."""
+    low, high = min(user_id, other_id), max(user_id, other_id)
+    conversation = DirectConversation.query.filter_by(user_low_id=low, user_high_id=high).first()
+    if conversation is not None:
+        return conversation
+    
+    upsert_insert = _UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if upsert_insert is not None:
+        # Both users may open it at the same time, the pair is unique
+        db.session.execute(upsert_insert(DirectConversation).values(
+            user_low_id=low, user_high_id=high
+        ).on_conflict_do_nothing(index_elements=['user_low_id', 'user_high_id']))
+    else:
+        db.session.execute(insert(DirectConversation).values(user_low_id=low, user_high_id=high))
+    conversation = DirectConversation.query.filter_by(user_low_id=low, user_high_id=high).one()
+    
+    participants = [{'conversation_id': conversation.id, 'user_id': uid} for uid in (low, high)]
+    if upsert_insert is not None:
+        db.session.execute(upsert_insert(DirectParticipant).values(participants).on_conflict_do_nothing(
+            index_elements=['conversation_id', 'user_id']
+        ))
+    elif not DirectParticipant.query.filter_by(conversation_id=conversation.id).first():
+        db.session.execute(insert(DirectParticipant), participants)
+    db.session.commit()
+    return conversation
+
+def get_dm_page(conversation_id, before=None, after=None, limit=DM_PAGE_SIZE):
+    """Keyset-paginated slice of a conversation, oldest message first."""
+    base = DirectMessage.query.filter(DirectMessage.conversation_id == conversation_id)
+    if after is not None:
+        return base.filter(DirectMessage.id > after).order_by(DirectMessage.id.asc()).limit(limit).all()
+    if before is not None:
+        base = base.filter(DirectMessage.id < before)
+    return base.order_by(DirectMessage.id.desc()).limit(limit).all()[::-1]
+
+def send_dm(conversation_id, user, content):
+    """Stores a message and delivers it to every participant's user room.
+    
+    Returns the delivered payload, or None if the user does not take part.
+    """
+    participants = dm_participants.get(conversation_id)
+    if user.id not in participants:
+        return None
+    
+    # Built before the commit, which would expire the user and the message
+    payload = {
+        'conversation_id': conversation_id,
+        'content': content,
+        'user_id': user.id,
+        'username': user.username,
+        'avatar_url': user.avatar_url,
+        'created_at': datetime.utcnow()
+    }
+    message = DirectMessage(conversation_id=conversation_id, user_id=user.id, content=content,
+                            created_at=payload['created_at'])
+    db.session.add(message)
+    db.session.flush()
+    payload['message_id'] = message.id
+    DirectConversation.query.filter_by(id=conversation_id).update(
+        {'last_message_id': message.id}, synchronize_session=False
+    )
+    db.session.commit()
+    payload['created_at'] = payload['created_at'].isoformat()
+    
+    socketio.emit('dm_message', payload, room=[f'user_{user_id}' for user_id in participants])
+    return payload
+
+def _user_summary(user):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'avatar': user.avatar_url,
+        'status': user.status
+    }
+
+@direct_messages.route('/api/dm/<int:friend_id>', methods=['POST'])
+@login_required
+def open_direct_message(friend_id):
+    friend = User.query.get_or_404(friend_id)
+    if friend.id == current_user.id:
+        return jsonify({'error': 'You cannot message yourself'}), 400
+    if not are_friends(current_user.id, friend.id):
+        return jsonify({'error': 'User is not your friend'}), 403
+    
+    conversation = open_conversation(current_user.id, friend.id)
+    return jsonify({
+        'channel_id': conversation.id,
+        'friend': _user_summary(friend)
+    })
+
+@direct_messages.route('/api/dm/groups', methods=['POST'])
+@login_required
+def create_group():
+    data = request.get_json(silent=True) or {}
+    user_ids = data.get('user_ids')
+    if not isinstance(user_ids, list) or not all(isinstance(user_id, int) for user_id in user_ids):
+        return jsonify({'error': 'user_ids must be a list of user ids'}), 400
+    
+    user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id != current_user.id]
+    if not user_ids:
+        return jsonify({'error': 'A group needs at least one other user'}), 400
+    if len(user_ids) + 1 > DM_GROUP_SIZE:
+        return jsonify({'error': f'Groups have at most {DM_GROUP_SIZE} participants'}), 400
+    if not all(are_friends(current_user.id, user_id) for user_id in user_ids):
+        return jsonify({'error': 'Groups can only include friends'}), 403
+    
+    conversation = DirectConversation(name=(data.get('name') or '').strip()[:100] or None)
+    db.session.add(conversation)
+    db.session.flush()
+    db.session.execute(insert(DirectParticipant), [
+        {'conversation_id': conversation.id, 'user_id': user_id} for user_id in [current_user.id] + user_ids
+    ])
+    db.session.commit()
+    
+    members = User.query.filter(User.id.in_(user_ids)).all()
+    return jsonify({
+        'channel_id': conversation.id,
+        'name': conversation.name,
+        'participants': [_user_summary(member) for member in members]
+    }), 201
+
+@direct_messages.route('/api/dm', methods=['GET'])
+@login_required
+def list_conversations():
+    conversations = DirectConversation.query.join(
+        DirectParticipant, DirectParticipant.conversation_id == DirectConversation.id
+    ).filter(DirectParticipant.user_id == current_user.id).order_by(
+        DirectConversation.last_message_id.desc(), DirectConversation.id.desc()
+    ).all()
+    
+    # Every other participant of all conversations in one query
+    others = {}
+    for conversation_id, user in db.session.query(DirectParticipant.conversation_id, User).join(
+        User, User.id == DirectParticipant.user_id
+    ).filter(
+        DirectParticipant.conversation_id.in_([conversation.id for conversation in conversations]),
+        DirectParticipant.user_id != current_user.id
+    ):
+        others.setdefault(conversation_id, []).append(_user_summary(user))
+    
+    return jsonify({'conversations': [{
+        'channel_id': conversation.id,
+        'name': conversation.name,
+        'participants': others.get(conversation.id, []),
+        'last_message_id': conversation.last_message_id
+    } for conversation in conversations]})
+
+@direct_messages.route('/api/dm/<int:conversation_id>/messages', methods=['GET'])
+@login_required
+def get_direct_messages(conversation_id):
+    if current_user.id not in dm_participants.get(conversation_id):
+        abort(404)
+    
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    limit = min(max(request.args.get('limit', DM_PAGE_SIZE, type=int), 1), DM_PAGE_SIZE_MAX)
+    messages = get_dm_page(conversation_id, before=before, after=after, limit=limit)
+    
+    authors = {user.id: user for user in User.query.filter(
+        User.id.in_({message.user_id for message in messages})
+    )}
+    return jsonify({
+        'messages': [{
+            'id': message.id,
+            'content': message.content,
+            'author': {
+                'id': message.user_id,
+                'username': authors[message.user_id].username,
+                'avatar': authors[message.user_id].avatar_url
+            },
+            'timestamp': message.created_at.isoformat()
+        } for message in messages],
+        'has_more': len(messages) == limit
+    })
+
+@direct_messages.route('/api/dm/<int:conversation_id>/messages', methods=['POST'])
+@login_required
+def post_direct_message(conversation_id):
+    content = ((request.get_json(silent=True) or {}).get('content') or '').strip()
+    if not content:
+        return jsonify({'error': 'Message content is required'}), 400
+    
+    payload = send_dm(conversation_id, current_user, content)
+    if payload is None:
+        abort(404)
+    return jsonify(payload), 201
+
+@socketio.on('dm_message')
+def handle_dm_message(data):
+    if not current_user.is_authenticated:
+        emit('error', 'Not authenticated', room=request.sid)
+        return
+    
+    conversation_id = data.get('conversation_id')
+    content = (data.get('content') or '').strip()
+    if not isinstance(conversation_id, int) or not content:
+        emit('error', 'Conversation and content are required', room=request.sid)
+        return
+    
+    if send_dm(conversation_id, current_user, content) is None:
+        emit('error', 'Conversation not found', room=request.sid)
@@ -0,0 +1,95 @@
+"""The friend graph.
+
+Every friendship is one friendship row with the two user ids in canonical
+order, so there is nothing to keep in sync between directions. "Are friends"
+is one primary key lookup and a user's friends are two index range scans,
+one per column, whatever the size of the table.
+"""
+from sqlalchemy import inspect, insert, select, text, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+
+from funlight import db
+from funlight.models import Friendship, User
+
+_UPSERT_INSERTS = {
+    'sqlite': sqlite.insert,
+    'postgresql': postgresql.insert
+}
+
+def merge_legacy_friendships(conn):
+    """Moves the friendships of the old friendships and friend_associations
+    tables and of accepted friend requests into friendship, then drops the
+    old tables. Pairs already in friendship are kept as they are."""
+    tables = set(inspect(conn).get_table_names())
+    
+    # Every accepted edge of the three old stores, in either direction, once
+    sources = ["SELECT sender_id AS a, receiver_id AS b FROM friend_request WHERE status = 'accepted'"]
+    if 'friendships' in tables:
+        sources.append("SELECT user_id AS a, friend_id AS b FROM friendships")
+    if 'friend_associations' in tables:
+        sources.append("SELECT user1_id AS a, user2_id AS b FROM friend_associations WHERE status = 'accepted'")
+    conn.execute(text(
+        "INSERT INTO friendship (user_low_id, user_high_id, created_at) "
+        "SELECT DISTINCT low, high, CURRENT_TIMESTAMP FROM ("
+        "SELECT CASE WHEN a < b THEN a ELSE b END AS low, CASE WHEN a < b THEN b ELSE a END AS high "
+        "FROM (" + " UNION ALL ".join(sources) + ") edges WHERE a <> b) pairs "
+        "WHERE NOT EXISTS (SELECT 1 FROM friendship "
+        "WHERE friendship.user_low_id = pairs.low AND friendship.user_high_id = pairs.high)"
+    ))
+    conn.execute(text("DELETE FROM friend_request WHERE status = 'accepted'"))
+    
+    if 'friend_associations' in tables:
+        # Pending associations become requests, unless one exists between the pair
+        conn.execute(text(
+            "INSERT INTO friend_request (sender_id, receiver_id, status, created_at) "
+            "SELECT user1_id, user2_id, 'pending', created_at FROM friend_associations "
+            "WHERE status = 'pending' AND NOT EXISTS (SELECT 1 FROM friend_request "
+            "WHERE (sender_id = user1_id AND receiver_id = user2_id) "
+            "OR (sender_id = user2_id AND receiver_id = user1_id))"
+        ))
+        conn.execute(text("DROP TABLE friend_associations"))
+    if 'friendships' in tables:
+        conn.execute(text("DROP TABLE friendships"))
+
+def friend_pair(user_id, other_id):
+    return (user_id, other_id) if user_id < other_id else (other_id, user_id)
+
+def are_friends(user_id, other_id):
+    if user_id == other_id:
+        return False
+    return db.session.get(Friendship, friend_pair(user_id, other_id)) is not None
+
+def _friend_ids_query(user_ids):
+    return union_all(
+        select(Friendship.user_low_id.label('user_id'), Friendship.user_high_id.label('friend_id')).where(
+            Friendship.user_low_id.in_(user_ids)
+        ),
+        select(Friendship.user_high_id, Friendship.user_low_id).where(
+            Friendship.user_high_id.in_(user_ids)
+        )
+    )
+
+def friend_pairs(user_ids):
+    """(user_id, friend_id) pairs for the given users."""
+    return {tuple(row) for row in db.session.execute(_friend_ids_query(list(user_ids)))}
+
+def friends_of(user_id):
+    """The user's friends, by username."""
+    friend_ids = _friend_ids_query([user_id]).subquery()
+    return User.query.join(friend_ids, User.id == friend_ids.c.friend_id).order_by(User.username).all()
+
+def add_friendship(user_id, other_id):
+    """Records a friendship, a no-op if it exists. The caller commits."""
+    low, high = friend_pair(user_id, other_id)
+    upsert_insert = _UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if upsert_insert is not None:
+        db.session.execute(upsert_insert(Friendship).values(
+            user_low_id=low, user_high_id=high
+        ).on_conflict_do_nothing(index_elements=['user_low_id', 'user_high_id']))
+    elif not are_friends(low, high):
+        db.session.execute(insert(Friendship).values(user_low_id=low, user_high_id=high))
+
+def remove_friendship(user_id, other_id):
+    """Returns False if the users were not friends. The caller commits."""
+    low, high = friend_pair(user_id, other_id)
+    return Friendship.query.filter_by(user_low_id=low, user_high_id=high).delete() > 0
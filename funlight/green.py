@@ -0,0 +1,88 @@
+"""Database access under green-thread servers (eventlet, gevent).
+
+Database drivers such as sqlite3 and psycopg2 block in C code, where
+monkey patching cannot reach. One slow query would stall every socket
+served by the event loop. In green modes, every DBAPI connection is
+therefore wrapped so that its calls (and its cursors' calls) run on the
+event loop's pool of real OS threads, while the calling green thread waits.
+
+SQLite allows one writer per file, and green threads interleave their
+transactions far more than OS threads do, so concurrent writers fail with
+"database is locked". For SQLite, every transaction therefore runs on one
+pooled connection: a green thread checks it out for its transaction while
+the others wait on the pool (a green lock after monkey patching) instead of
+on SQLite's busy timeout, and at most one offloaded call runs at a time.
+
+CPU-heavy calls that do not release the event loop, like password hashing,
+go through run_blocking() for the same reason.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+GREEN_MODES = ('eventlet', 'gevent')
+
+# Calls whose result has to be wrapped as well
+_WRAPPED_RESULTS = ('cursor', 'execute')
+
+class OffloadedProxy:
+    """Runs every method call of the wrapped object through offload(fn, *args, **kwargs)."""
+    
+    def __init__(self, target, offload):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_offload', offload)
+    
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        
+        def call(*args, **kwargs):
+            result = self._offload(attr, *args, **kwargs)
+            if name in _WRAPPED_RESULTS and result is not None:
+                return OffloadedProxy(result, self._offload)
+            return result
+        return call
+    
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+    
+    def __iter__(self):
+        return iter(self.fetchall())
+
+def _offload_function(async_mode):
+    if async_mode == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute
+    if async_mode == 'gevent':
+        from gevent import get_hub
+        return lambda fn, *args, **kwargs: get_hub().threadpool.apply(fn, args, kwargs)
+    raise ValueError(f'No thread offloading for async mode {async_mode!r}')
+
+def engine_options(database_uri):
+    """Engine options that keep database access green-safe for the given URI."""
+    if not database_uri.startswith('sqlite'):
+        return {}
+    if database_uri in ('sqlite://', 'sqlite:///:memory:'):
+        raise ValueError('In-memory SQLite is not supported in green async modes, use a database file')
+    return {'poolclass': QueuePool, 'pool_size': 1, 'max_overflow': 0}
+
+_offload = None
+
+def run_blocking(fn, *args, **kwargs):
+    """Calls fn off the event loop in green modes, directly otherwise."""
+    if _offload is None:
+        return fn(*args, **kwargs)
+    return _offload(fn, *args, **kwargs)
+
+def offload_database(async_mode, offload=None):
+    """Makes all engines created from now on run DBAPI calls off the event loop."""
+    global _offload
+    if _offload is not None:
+        return
+    offload = _offload = offload or _offload_function(async_mode)
+    
+    @event.listens_for(Engine, 'do_connect')
+    def _connect(dialect, connection_record, cargs, cparams):
+        connection = offload(dialect.loaded_dbapi.connect, *cargs, **cparams)
+        return OffloadedProxy(connection, offload)
@@ -0,0 +1,193 @@
+"""Socket.IO event metrics, sampled tracing and queued logging.
+
+Every Socket.IO event handler is timed into a latency histogram per event
+name, served at /metrics in the Prometheus text format. The numbers are per
+worker process, so Prometheus scrapes each worker. /metrics needs the
+METRICS_TOKEN bearer token if one is set, and only answers unproxied
+requests from METRICS_ALLOWED_IPS otherwise. A TRACE_SAMPLE_RATE
+share of the events is also written as one JSON record (event, sid, user,
+duration, error) to the funlight.trace logger.
+
+Handlers never wait on log I/O: with LOG_QUEUE, the handlers of the root
+and app loggers are moved behind a queue that a background thread drains.
+"""
+import bisect
+import hmac
+import json
+import logging
+import random
+import threading
+import time
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+from flask import abort, current_app, request
+from flask_login import current_user
+from flask_socketio import SocketIO
+
+trace_logger = logging.getLogger('funlight.trace')
+
+# Seconds, from well below a cached lookup to a handler that is clearly stuck
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    """Bucketed observations, cumulated only when rendered."""
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+    
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+    
+    def render(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {total}')
+        lines.append(f'{name}_count{{{labels}}} {cumulative}')
+        return lines
+
+class Metrics:
+    """Per-event latency histograms and error counts of this worker."""
+    
+    def __init__(self):
+        self.sample_rate = 0.0
+        self._histograms = {}
+        self._errors = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+    
+    def init_app(self, app):
+        self.sample_rate = app.config['TRACE_SAMPLE_RATE']
+        if app.config['TRACE_LOG_FILE']:
+            trace_logger.addHandler(logging.FileHandler(app.config['TRACE_LOG_FILE']))
+            trace_logger.propagate = False
+        # Trace records are sampled already, they must not be filtered by level
+        trace_logger.setLevel(logging.INFO)
+        
+        if app.config['LOG_QUEUE']:
+            for logger in (logging.getLogger(), app.logger, trace_logger):
+                self._queue_handlers(logger)
+        if app.config['METRICS_ENABLED']:
+            app.add_url_rule('/metrics', 'metrics', self.metrics_response)
+    
+    def _queue_handlers(self, logger):
+        handlers = [handler for handler in logger.handlers if not isinstance(handler, QueueHandler)]
+        if not handlers:
+            return
+        
+        queue = SimpleQueue()
+        listener = QueueListener(queue, *handlers, respect_handler_level=True)
+        listener.start()
+        self._listeners.append(listener)
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(QueueHandler(queue))
+    
+    def sampled(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+    
+    def observe(self, event, duration, error=None):
+        histogram = self._histograms.get(event)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(event, Histogram())
+        histogram.observe(duration)
+        if error is not None:
+            with self._lock:
+                self._errors[event] = self._errors.get(event, 0) + 1
+    
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            errors = sorted(self._errors.items())
+        
+        lines = [
+            '# HELP funlight_socketio_event_duration_seconds Socket.IO event handler latency.',
+            '# TYPE funlight_socketio_event_duration_seconds histogram'
+        ]
+        for event, histogram in histograms:
+            lines.extend(histogram.render('funlight_socketio_event_duration_seconds', f'event="{event}"'))
+        lines.extend([
+            '# HELP funlight_socketio_event_errors_total Socket.IO event handlers that raised.',
+            '# TYPE funlight_socketio_event_errors_total counter'
+        ])
+        for event, count in errors:
+            lines.append(f'funlight_socketio_event_errors_total{{event="{event}"}} {count}')
+        return '\n'.join(lines) + '\n'
+    
+    def metrics_response(self):
+        token = current_app.config['METRICS_TOKEN']
+        if token:
+            expected = f'Bearer {token}'.encode()
+            if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), expected):
+                abort(401)
+        elif request.remote_addr not in current_app.config['METRICS_ALLOWED_IPS']:
+            abort(403)
+        elif 'X-Forwarded-For' in request.headers:
+            # Proxied, so remote_addr is the proxy's address and not the client's
+            abort(403)
+        return current_app.response_class(self.render(), mimetype='text/plain; version=0.0.4')
+
+metrics = Metrics()
+
+def instrumented(message, handler):
+    """Wraps an event handler so that every call is recorded in metrics."""
+    
+    @wraps(handler)
+    def timed(*args):
+        started = time.perf_counter()
+        sampled = metrics.sampled()
+        error = None
+        try:
+            if message == 'connect' and args:
+                # Flask-SocketIO calls connect handlers with auth, and without
+                # arguments if that raises TypeError
+                try:
+                    return handler(*args)
+                except TypeError:
+                    return handler()
+            return handler(*args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            metrics.observe(message, duration, error)
+            if sampled:
+                trace_logger.info(json.dumps({
+                    'event': message,
+                    'sid': request.sid,
+                    'user_id': current_user.get_id(),
+                    'duration_ms': round(duration * 1000, 3),
+                    'error': repr(error) if error is not None else None
+                }))
+    return timed
+
+class InstrumentedSocketIO(SocketIO):
+    """SocketIO that records every event handler call in metrics.
+    
+    Handlers are wrapped as they are registered through on, which on_event
+    uses as well.
+    """
+    
+    def on(self, message, namespace=None):
+        register = super().on(message, namespace)
+        
+        def decorator(handler):
+            register(instrumented(message, handler))
+            return handler
+        return decorator
@@ -0,0 +1,143 @@
+"""Socket.IO load test: connection ceiling and message latency of a running server.
+
+    python -m funlight.loadtest --url http://127.0.0.1:5000 --invite CODE \\
+        --channel-id 1 --sockets 2000 --step 100 --messages 200 --label eventlet
+
+Start the server once per SOCKETIO_ASYNC_MODE and run the same command
+against each, the reports are directly comparable. Needs aiohttp on the
+client side (pip install aiohttp). The users loadtest_<n> are registered on
+first use and join the server through --invite, so create an invite without
+max_uses for the target server first.
+
+Phase 1 opens sockets in steps of --step until --sockets are connected or a
+step does not fully connect within --timeout. The last fully connected count
+is the ceiling. Phase 2 joins every socket to --channel-id and, once every
+join is confirmed, sends --messages messages at --rate per second. Every
+delivery is timed from send to receipt.
+"""
+import argparse
+import asyncio
+import math
+import time
+
+import aiohttp
+import socketio
+
+PASSWORD = 'loadtest-password'
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+class LoadClient:
+    def __init__(self, index, latencies):
+        self.username = f'loadtest_{index}'
+        self.latencies = latencies
+        self.joined = asyncio.Event()
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on('new_message', self._on_message)
+        self.sio.on('joined_channel', lambda data: self.joined.set())
+    
+    async def _on_message(self, data):
+        content = data.get('content', '')
+        if content.startswith('loadtest '):
+            self.latencies.append(time.perf_counter() - float(content.split()[1]))
+    
+    async def login(self, url, invite):
+        """Registers the user if needed, logs in and joins the server, returns the session cookie."""
+        jar = aiohttp.CookieJar(unsafe=True)
+        async with aiohttp.ClientSession(cookie_jar=jar) as http:
+            await http.post(f'{url}/register', data={
+                'username': self.username,
+                'email': f'{self.username}@loadtest.invalid',
+                'password': PASSWORD
+            }, allow_redirects=False)
+            await http.post(f'{url}/login', data={'username': self.username, 'password': PASSWORD},
+                            allow_redirects=False)
+            await http.post(f'{url}/api/invites/{invite}')
+            return '; '.join(f'{cookie.key}={cookie.value}' for cookie in jar)
+    
+    async def connect(self, url, cookie, timeout):
+        await self.sio.connect(url, headers={'Cookie': cookie}, transports=['websocket'],
+                               wait_timeout=timeout)
+
+async def open_sockets(args, latencies):
+    clients = []
+    logins = asyncio.Semaphore(50)
+    
+    async def start(index):
+        client = LoadClient(index, latencies)
+        async with logins:
+            cookie = await client.login(args.url, args.invite)
+        await client.connect(args.url, cookie, args.timeout)
+        return client
+    
+    while len(clients) < args.sockets:
+        step = range(len(clients), min(len(clients) + args.step, args.sockets))
+        started = time.perf_counter()
+        results = await asyncio.gather(*(start(index) for index in step), return_exceptions=True)
+        connected = [result for result in results if isinstance(result, LoadClient)]
+        clients.extend(connected)
+        print(f'{len(clients)} sockets connected (+{len(connected)}/{len(step)} in '
+              f'{time.perf_counter() - started:.1f}s)')
+        if len(connected) < len(step):
+            failure = next(result for result in results if not isinstance(result, LoadClient))
+            print(f'Connection ceiling reached: {failure!r}')
+            break
+    return clients
+
+async def measure_latency(args, clients, latencies):
+    for client in clients:
+        await client.sio.emit('join_channel', {'channel_id': args.channel_id})
+    joins = [asyncio.ensure_future(client.joined.wait()) for client in clients]
+    done, pending = await asyncio.wait(joins, timeout=args.timeout)
+    for join in pending:
+        join.cancel()
+    if pending:
+        print(f'{len(pending)} sockets did not join the channel')
+    
+    sender = clients[0]
+    for _ in range(args.messages):
+        await sender.sio.emit('message', {
+            'channel_id': args.channel_id,
+            'content': f'loadtest {time.perf_counter()}'
+        })
+        await asyncio.sleep(1 / args.rate)
+    # Let the last deliveries arrive
+    await asyncio.sleep(args.timeout)
+
+async def run(args):
+    latencies = []
+    clients = await open_sockets(args, latencies)
+    if clients and args.messages:
+        await measure_latency(args, clients, latencies)
+    
+    expected = len(clients) * args.messages
+    print()
+    print(f'mode:               {args.label}')
+    print(f'max sockets:        {len(clients)}')
+    print(f'deliveries:         {len(latencies)}/{expected}')
+    if latencies:
+        print(f'latency p50:        {percentile(latencies, 50) * 1000:.1f} ms')
+        print(f'latency p99:        {percentile(latencies, 99) * 1000:.1f} ms')
+        print(f'latency max:        {max(latencies) * 1000:.1f} ms')
+    
+    await asyncio.gather(*(client.sio.disconnect() for client in clients), return_exceptions=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--invite', required=True, help='invite code of the server to test')
+    parser.add_argument('--channel-id', type=int, required=True)
+    parser.add_argument('--sockets', type=int, default=1000, help='sockets to open at most')
+    parser.add_argument('--step', type=int, default=100, help='sockets opened per step')
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=10, help='messages per second')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--label', default='', help='async mode of the server, for the report')
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
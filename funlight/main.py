@@ -1,12 +1,26 @@
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash, current_app
+from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash, current_app, abort
 from flask_login import login_required, current_user
 from funlight import socketio, db
-from funlight.models import Server, Channel, Message, User, ServerMember, Role, Category, FriendAssociation
+from funlight.models import Server, Channel, Message, User, ServerMember, Role, Category, Invite
+from funlight.permissions import Permissions, channel_audience, channel_audiences, channel_server_id, check_permission, get_permission_bits, has_permission, is_member
+from funlight.friends import friends_of
+from funlight.membership import add_members, announce_members, create_invite, redeem_invite
+from funlight.message_writer import message_writer
+from funlight.channel_events import channel_events
+from funlight.message_changes import changes_since, delete_messages, edit_message
+from funlight.read_state import mark_read, record_messages, server_badges, unread_channels
+from funlight.voice_video import leave_all_rooms
+from funlight.signaling import signaling
+from funlight.status import status_tracker
+from funlight.typing_indicators import typing_tracker
+from funlight.snapshots import server_snapshots
+from funlight.search import MAX_SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE, search_messages
+from funlight.uploads import store_file, is_content_addressed
+from funlight.variants import variant_worker
 from flask_socketio import emit, join_room, leave_room
-from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException
 import os
 import time
-import uuid
 from datetime import datetime
 
 main = Blueprint('main', __name__)
@@ -24,36 +38,24 @@ def dashboard():
     servers = Server.query.join(ServerMember).filter(ServerMember.user_id == current_user.id).all()
     
     # Get user's friends
-    friends = []
-    friend_associations = FriendAssociation.query.filter(
-        (
-            ((FriendAssociation.user1_id == current_user.id) | 
-             (FriendAssociation.user2_id == current_user.id)) &
-            (FriendAssociation.status == 'accepted')
-        )
-    ).all()
-    
-    for assoc in friend_associations:
-        friend = assoc.user2 if assoc.user1_id == current_user.id else assoc.user1
-        friends.append(friend)
+    friends = friends_of(current_user.id)
     
     return render_template('dashboard.html', 
                          servers=servers,
-                         friends=friends)
+                         friends=friends,
+                         server_unread=server_badges(unread_channels(current_user.id)))
 
 @main.route('/server/<int:server_id>')
 @login_required
 def server(server_id):
-    # Get current server
-    current_server = Server.query.get_or_404(server_id)
+    # Categories, channels, roles and the member summary come from the cached
+    # snapshot, so rendering does not depend on the size of the server
+    snapshot = server_snapshots.get(server_id)
+    if snapshot is None:
+        abort(404)
     
     # Check if user is member of the server
-    is_member = ServerMember.query.filter_by(
-        user_id=current_user.id,
-        server_id=server_id
-    ).first()
-    
-    if not is_member and current_server.owner_id != current_user.id:
+    if not is_member(current_user.id, server_id):
         flash('You are not a member of this server')
         return redirect(url_for('main.dashboard'))
     
@@ -62,36 +64,46 @@ def server(server_id):
         ServerMember.user_id == current_user.id
     ).all()
     
-    # Get server's categories and channels
-    categories = Category.query.filter_by(server_id=server_id).order_by(Category.position).all()
+    channels = snapshot['uncategorized'] + [
+        channel for category in snapshot['categories'] for channel in category['channels']
+    ]
     
-    # Get the current channel (default to first channel if none specified)
+    # Get the current channel (default to first text channel if none specified)
     channel_id = request.args.get('channel_id', type=int)
     current_channel = None
     
     if channel_id:
-        current_channel = Channel.query.get(channel_id)
+        current_channel = next((channel for channel in channels if channel['id'] == channel_id), None)
     else:
-        # Default to first text channel
-        current_channel = Channel.query.filter_by(server_id=server_id, type='text').first()
+        current_channel = next((channel for channel in channels if channel['type'] == 'text'), None)
     
-    # Get server members
-    members = User.query.join(ServerMember).filter(
-        ServerMember.server_id == server_id
-    ).all()
+    # The open channel is read as it renders
+    if current_channel and current_channel['type'] == 'text':
+        mark_read(current_user.id, current_channel['id'])
+        db.session.commit()
+    unread = unread_channels(current_user.id)
     
     return render_template('server.html',
-        current_server=current_server,
+        current_server=snapshot['server'],
         current_channel=current_channel,
         servers=servers,
-        categories=categories,
-        members=members
+        categories=snapshot['categories'],
+        uncategorized=snapshot['uncategorized'],
+        snapshot_version=snapshot['version'],
+        unread=unread,
+        server_unread=server_badges(unread)
     )
 
 def allowed_file(filename):
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_server_icon(icon):
+    """Stores an icon upload, returns its path relative to the static folder."""
+    icon_path = os.path.join('uploads', store_file(icon))
+    variant_worker.submit(icon_path, 'icon')
+    return icon_path
+
 @main.route('/api/servers', methods=['POST'])
 @login_required
 def create_server():
@@ -107,10 +119,7 @@ def create_server():
         if 'icon' in request.files:
             icon = request.files['icon']
             if icon and icon.filename:
-                filename = secure_filename(icon.filename)
-                icon_path = f'server_icons/{uuid.uuid4()}_{filename}'
-                os.makedirs(os.path.join(current_app.static_folder, 'server_icons'), exist_ok=True)
-                icon.save(os.path.join(current_app.static_folder, icon_path))
+                icon_path = save_server_icon(icon)
 
         # Create server in database
         server = Server(
@@ -159,56 +168,95 @@ def create_server():
                 'id': server.id,
                 'name': server.name,
                 'icon': icon_path,
+                'icon_variants': variant_worker.urls(icon_path, 'icon'),
                 'owner_id': server.owner_id
             }), 201
         except Exception as e:
             db.session.rollback()
-            print(f"Error during commit: {str(e)}")
+            current_app.logger.error(f"Error during commit: {str(e)}")
             return jsonify({'error': f'Database error: {str(e)}'}), 500
             
     except Exception as e:
-        print(f"Error creating server: {str(e)}")
+        current_app.logger.error(f"Error creating server: {str(e)}")
         return jsonify({'error': f'Unexpected error: {str(e)}'}), 500
 
+MEMBER_PAGE_SIZE = 100
+MAX_MEMBER_PAGE_SIZE = 1000
+
+def get_member_page(server_id, after=None, limit=MEMBER_PAGE_SIZE):
+    """One page of a server's members with their users and roles.
+
+    Members and users come from a single joined query paged by member id,
+    roles from one extra IN query, so the statement count does not depend on
+    the number of members.
+    """
+    query = db.session.query(ServerMember, User).join(
+        User, User.id == ServerMember.user_id
+    ).options(
+        db.selectinload(ServerMember.roles)
+    ).filter(ServerMember.server_id == server_id)
+    
+    if after is not None:
+        query = query.filter(ServerMember.id > after)
+    
+    return query.order_by(ServerMember.id).limit(limit).all()
+
+def member_page_response(rows, limit):
+    return {
+        'members': [{
+            'id': member.id,
+            'user': {
+                'id': user.id,
+                'username': user.username,
+                'avatar': user.avatar,
+                'status': 'online' if user.is_online else 'offline'
+            },
+            'nickname': member.nickname,
+            'roles': [{
+                'id': role.id,
+                'name': role.name,
+                'color': role.color
+            } for role in member.roles]
+        } for member, user in rows],
+        # Pass as ?after= to get the next page
+        'next_cursor': rows[-1][0].id if len(rows) == limit else None
+    }
+
+def member_page_args():
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', MEMBER_PAGE_SIZE, type=int)
+    return after, max(1, min(limit, MAX_MEMBER_PAGE_SIZE))
+
 @main.route('/api/servers/<int:server_id>', methods=['GET'])
 @login_required
 def get_server(server_id):
     try:
         server = Server.query.get_or_404(server_id)
-        member = ServerMember.query.filter_by(
-            user_id=current_user.id,
-            server_id=server_id
-        ).first()
         
-        if not member:
+        if not is_member(current_user.id, server_id):
             return jsonify({'error': 'Not a member of this server'}), 403
         
         channels = Channel.query.filter_by(server_id=server_id).all()
-        members = ServerMember.query.filter_by(server_id=server_id).all()
+        after, limit = member_page_args()
+        members = member_page_response(get_member_page(server_id, after, limit), limit)
         
         return jsonify({
             'id': server.id,
             'name': server.name,
             'description': server.description,
             'icon': server.icon,
+            'icon_variants': variant_worker.urls(server.icon, 'icon'),
             'channels': [{
                 'id': channel.id,
                 'name': channel.name,
                 'type': channel.type
             } for channel in channels],
-            'members': [{
-                'id': member.user.id,
-                'username': member.nickname or member.user.username,
-                'avatar': member.user.avatar,
-                'status': 'online' if member.user.is_online else 'offline',
-                'roles': [{
-                    'id': role.id,
-                    'name': role.name,
-                    'color': role.color
-                } for role in member.roles]
-            } for member in members]
+            'members': members['members'],
+            'members_next_cursor': members['next_cursor']
         })
         
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -230,10 +278,7 @@ def update_server(server_id):
         if 'icon' in request.files:
             icon = request.files['icon']
             if icon and allowed_file(icon.filename):
-                filename = secure_filename(icon.filename)
-                icon_path = os.path.join('uploads', 'server_icons', filename)
-                icon.save(os.path.join(current_app.root_path, 'static', icon_path))
-                server.icon = icon_path
+                server.icon = save_server_icon(icon)
         
         db.session.commit()
         return jsonify({'message': 'Server updated successfully'})
@@ -253,8 +298,8 @@ def delete_server(server_id):
         return jsonify({'message': 'Unauthorized'}), 403
     
     try:
-        # Delete server icon if it exists
-        if server.icon:
+        # Delete server icon if it exists, stored files may be shared with other uploads
+        if server.icon and not is_content_addressed(server.icon):
             icon_path = os.path.join(current_app.root_path, 'static', server.icon)
             if os.path.exists(icon_path):
                 os.remove(icon_path)
@@ -310,63 +355,334 @@ def create_channel(server_id):
         'private': channel.private
     }), 201
 
-@main.route('/server/<int:server_id>/members')
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 100
+
+def get_message_page(channel_id, before=None, after=None, around=None, limit=MESSAGE_PAGE_SIZE):
+    """Keyset-paginated slice of a channel's history, oldest message first.
+
+    Every query is bounded by the (channel_id, id) index and a LIMIT, so the
+    cost only depends on the page size and never on the channel size.
+    """
+    base = Message.query.options(
+        db.joinedload(Message.author),
+        db.selectinload(Message.attachments)
+    ).filter(Message.channel_id == channel_id)
+    
+    if around is not None:
+        older = base.filter(Message.id <= around).order_by(Message.id.desc()).limit(limit // 2 + 1).all()
+        newer = base.filter(Message.id > around).order_by(Message.id.asc()).limit(limit - len(older)).all()
+        return older[::-1] + newer
+    
+    if after is not None:
+        return base.filter(Message.id > after).order_by(Message.id.asc()).limit(limit).all()
+    
+    if before is not None:
+        base = base.filter(Message.id < before)
+    return base.order_by(Message.id.desc()).limit(limit).all()[::-1]
+
+@main.route('/api/channels/<int:channel_id>/messages', methods=['GET'])
 @login_required
-def get_server_members(server_id):
-    server = Server.query.get_or_404(server_id)
+def get_channel_messages(channel_id):
+    channel = Channel.query.get_or_404(channel_id)
+    
     member = ServerMember.query.filter_by(
         user_id=current_user.id,
-        server_id=server_id
+        server_id=channel.server_id
     ).first()
     
-    if not member:
+    if not member and channel.server.owner_id != current_user.id:
         return jsonify({'error': 'Not a member of this server'}), 403
     
-    members = ServerMember.query.filter_by(server_id=server_id).all()
+    audience = channel_audience(channel_id)
+    if audience is not None and current_user.id not in audience:
+        return jsonify({'error': 'No access to this channel'}), 403
+    
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    around = request.args.get('around', type=int)
+    if sum(cursor is not None for cursor in (before, after, around)) > 1:
+        return jsonify({'error': 'Only one of before, after or around is allowed'}), 400
+    
+    limit = request.args.get('limit', MESSAGE_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+    
+    # Make messages still waiting in the write-behind buffer visible
+    message_writer.flush()
+    
+    messages = get_message_page(channel_id, before=before, after=after, around=around, limit=limit)
+    
     return jsonify({
-        'members': [{
-            'id': m.id,
-            'user': {
-                'id': m.user_id,
-                'username': User.query.get(m.user_id).username,
-                'avatar': User.query.get(m.user_id).avatar
-            },
-            'nickname': m.nickname,
-            'roles': [{
-                'id': role.id,
-                'name': role.name,
-                'color': role.color
-            } for role in m.roles]
-        } for m in members]
+        'messages': [message.to_dict() for message in messages],
+        'oldest_id': messages[0].id if messages else None,
+        'newest_id': messages[-1].id if messages else None,
+        'seq': channel.seq
+    })
+
+MAX_BULK_DELETE = 100
+
+def channel_target(channel_id, audience):
+    return f'channel_{channel_id}' if audience is None else [f'user_{user_id}' for user_id in audience]
+
+def channel_access(channel_id):
+    """The channel's server id and audience, or an error response if the
+    current user cannot see the channel."""
+    server_id = channel_server_id(channel_id)
+    if server_id is None:
+        abort(404)
+    if not is_member(current_user.id, server_id):
+        return None, None, (jsonify({'error': 'Not a member of this server'}), 403)
+    
+    audience = channel_audience(channel_id)
+    if audience is not None and current_user.id not in audience:
+        return None, None, (jsonify({'error': 'No access to this channel'}), 403)
+    return server_id, audience, None
+
+def get_channel_message(channel_id, message_id):
+    message = Message.query.filter_by(id=message_id, channel_id=channel_id).first()
+    if message is None and message_writer.enabled:
+        # The message may still be waiting in the write-behind buffer
+        message_writer.flush()
+        message = Message.query.filter_by(id=message_id, channel_id=channel_id).first()
+    if message is None:
+        abort(404)
+    return message
+
+@main.route('/api/channels/<int:channel_id>/messages/<int:message_id>', methods=['PATCH'])
+@login_required
+def edit_channel_message(channel_id, message_id):
+    _, audience, error = channel_access(channel_id)
+    if error:
+        return error
+    
+    content = ((request.get_json(silent=True) or {}).get('content') or '').strip()
+    if not content:
+        return jsonify({'error': 'Message content is required'}), 400
+    
+    message = get_channel_message(channel_id, message_id)
+    if message.user_id != current_user.id:
+        return jsonify({'error': 'Only the author can edit a message'}), 403
+    
+    delta = edit_message(message, content)
+    delta = channel_events.publish(channel_id, 'message_edited', delta, channel_target(channel_id, audience))
+    return jsonify(delta)
+
+@main.route('/api/channels/<int:channel_id>/messages/<int:message_id>', methods=['DELETE'])
+@login_required
+def delete_channel_message(channel_id, message_id):
+    server_id, audience, error = channel_access(channel_id)
+    if error:
+        return error
+    
+    message = get_channel_message(channel_id, message_id)
+    if message.user_id != current_user.id and not check_permission(
+        current_user.id, server_id, Permissions.MANAGE_MESSAGES
+    ):
+        return jsonify({'error': 'Insufficient permissions'}), 403
+    
+    delta = delete_messages(channel_id, [message.id])
+    delta = channel_events.publish(channel_id, 'messages_deleted', delta, channel_target(channel_id, audience))
+    return jsonify(delta)
+
+@main.route('/api/channels/<int:channel_id>/messages/bulk-delete', methods=['POST'])
+@login_required
+def bulk_delete_channel_messages(channel_id):
+    server_id, audience, error = channel_access(channel_id)
+    if error:
+        return error
+    if not check_permission(current_user.id, server_id, Permissions.MANAGE_MESSAGES):
+        return jsonify({'error': 'Insufficient permissions'}), 403
+    
+    message_ids = (request.get_json(silent=True) or {}).get('message_ids')
+    if not isinstance(message_ids, list) or not message_ids \
+            or not all(isinstance(message_id, int) for message_id in message_ids):
+        return jsonify({'error': 'message_ids must be a list of message ids'}), 400
+    if len(message_ids) > MAX_BULK_DELETE:
+        return jsonify({'error': f'At most {MAX_BULK_DELETE} messages can be deleted at once'}), 400
+    
+    message_writer.flush()
+    delta = delete_messages(channel_id, set(message_ids))
+    if delta is None:
+        abort(404)
+    delta = channel_events.publish(channel_id, 'messages_deleted', delta, channel_target(channel_id, audience))
+    return jsonify(delta)
+
+@main.route('/api/channels/<int:channel_id>/changes', methods=['GET'])
+@login_required
+def get_channel_changes(channel_id):
+    _, _, error = channel_access(channel_id)
+    if error:
+        return error
+    
+    since = request.args.get('since', type=int)
+    if since is None or since < 0:
+        return jsonify({'error': 'since must be a seq'}), 400
+    return jsonify(changes_since(channel_id, since))
+
+@main.route('/api/unread', methods=['GET'])
+@login_required
+def get_unread():
+    channels = unread_channels(current_user.id)
+    return jsonify({
+        'channels': {str(channel_id): badge for channel_id, badge in channels.items()},
+        'servers': {str(server_id): badge for server_id, badge in server_badges(channels).items()}
+    })
+
+@main.route('/api/channels/<int:channel_id>/ack', methods=['POST'])
+@login_required
+def ack_channel(channel_id):
+    server_id = channel_server_id(channel_id)
+    if server_id is None:
+        abort(404)
+    if not is_member(current_user.id, server_id):
+        return jsonify({'error': 'Not a member of this server'}), 403
+    
+    audience = channel_audience(channel_id)
+    if audience is not None and current_user.id not in audience:
+        return jsonify({'error': 'No access to this channel'}), 403
+    
+    message_id = (request.get_json(silent=True) or {}).get('message_id')
+    if message_id is not None and not isinstance(message_id, int):
+        return jsonify({'error': 'message_id must be an integer'}), 400
+    
+    last_read_message_id = mark_read(current_user.id, channel_id, message_id)
+    db.session.commit()
+    
+    # Clears the badge in the user's other tabs
+    socketio.emit('channel_read', {
+        'channel_id': channel_id,
+        'last_read_message_id': last_read_message_id
+    }, room=f'user_{current_user.id}')
+    return jsonify({'last_read_message_id': last_read_message_id})
+
+@main.route('/api/servers/<int:server_id>/search', methods=['GET'])
+@login_required
+def search_server_messages(server_id):
+    if not is_member(current_user.id, server_id):
+        return jsonify({'error': 'Not a member of this server'}), 403
+    
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Search query is required'}), 400
+    
+    try:
+        after = request.args.get('after', type=datetime.fromisoformat)
+        before = request.args.get('before', type=datetime.fromisoformat)
+    except ValueError:
+        return jsonify({'error': 'Dates must be in ISO format'}), 400
+    
+    limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    
+    messages = search_messages(
+        server_id, query,
+        channel_id=request.args.get('channel_id', type=int),
+        author_id=request.args.get('author_id', type=int),
+        after=after,
+        before=before,
+        include_private=current_user.id in channel_audiences.get(server_id),
+        limit=limit,
+        offset=offset
+    )
+    
+    return jsonify({
+        'messages': [message.to_dict() for message in messages],
+        'next_offset': offset + limit if len(messages) == limit else None
     })
 
+@main.route('/server/<int:server_id>/members')
+@login_required
+def get_server_members(server_id):
+    server = Server.query.get_or_404(server_id)
+    
+    if not is_member(current_user.id, server_id):
+        return jsonify({'error': 'Not a member of this server'}), 403
+    
+    after, limit = member_page_args()
+    return jsonify(member_page_response(get_member_page(server_id, after, limit), limit))
+
 @main.route('/server/<int:server_id>/join', methods=['POST'])
 @login_required
 def join_server(server_id):
     server = Server.query.get_or_404(server_id)
     
-    # Check if already a member
-    existing_member = ServerMember.query.filter_by(
-        user_id=current_user.id,
-        server_id=server_id
-    ).first()
+    try:
+        added = add_members(server_id, [current_user.id])
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
     
-    if existing_member:
+    if not added:
         return jsonify({'error': 'Already a member of this server'}), 400
     
-    # Add as new member
-    member = ServerMember(
-        user_id=current_user.id,
-        server_id=server_id
-    )
+    announce_members(server_id, added)
+    return jsonify({'message': 'Joined server successfully'})
+
+MAX_BULK_MEMBERS = 10000
+
+@main.route('/api/servers/<int:server_id>/members/bulk', methods=['POST'])
+@login_required
+@has_permission(Permissions.MANAGE_SERVER)
+def add_server_members(server_id):
+    user_ids = (request.get_json() or {}).get('user_ids')
+    if not isinstance(user_ids, list) or not all(isinstance(user_id, int) for user_id in user_ids):
+        return jsonify({'error': 'user_ids must be a list of user ids'}), 400
+    if len(user_ids) > MAX_BULK_MEMBERS:
+        return jsonify({'error': f'At most {MAX_BULK_MEMBERS} users per request'}), 400
     
     try:
-        db.session.add(member)
-        db.session.commit()
-        return jsonify({'message': 'Joined server successfully'})
+        added = add_members(server_id, user_ids)
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
+    
+    announce_members(server_id, added)
+    return jsonify({
+        'added': added,
+        'skipped': len(set(user_ids)) - len(added)
+    })
+
+@main.route('/api/servers/<int:server_id>/invites', methods=['POST'])
+@login_required
+def create_server_invite(server_id):
+    if not is_member(current_user.id, server_id):
+        return jsonify({'error': 'Not a member of this server'}), 403
+    if not check_permission(current_user.id, server_id, Permissions.MANAGE_SERVER):
+        return jsonify({'error': 'Insufficient permissions'}), 403
+    
+    data = request.get_json() or {}
+    max_uses = data.get('max_uses')
+    expires_in = data.get('expires_in')
+    if max_uses is not None and (not isinstance(max_uses, int) or max_uses < 1):
+        return jsonify({'error': 'max_uses must be a positive number'}), 400
+    if expires_in is not None and (not isinstance(expires_in, int) or expires_in < 1):
+        return jsonify({'error': 'expires_in must be a positive number of seconds'}), 400
+    
+    invite = create_invite(server_id, current_user.id, max_uses=max_uses, expires_in=expires_in)
+    return jsonify({
+        'code': invite.code,
+        'server_id': invite.server_id,
+        'max_uses': invite.max_uses,
+        'expires_at': invite.expires_at.isoformat() if invite.expires_at else None
+    }), 201
+
+@main.route('/api/invites/<code>', methods=['POST'])
+@login_required
+def accept_invite(code):
+    invite = Invite.query.filter_by(code=code).first()
+    if not invite:
+        return jsonify({'error': 'Invite not found'}), 404
+    
+    added = redeem_invite(invite, current_user.id)
+    if added is None:
+        return jsonify({'error': 'Invite has expired'}), 410
+    
+    announce_members(invite.server_id, added)
+    return jsonify({
+        'server_id': invite.server_id,
+        'joined': bool(added)
+    })
 
 @main.route('/api/servers/<int:server_id>/categories', methods=['POST'])
 @login_required
@@ -406,32 +722,38 @@ def create_category():
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+def grantable(server_id, permissions):
+    """True if the current user holds every bit of permissions on the server."""
+    bits = get_permission_bits(current_user.id, server_id)
+    return bits is not None and permissions & ~bits == 0
+
 @main.route('/api/servers/<int:server_id>/roles', methods=['POST'])
 @login_required
-def create_role():
+@has_permission(Permissions.MANAGE_ROLES)
+def create_role(server_id):
     try:
-        server_id = request.form.get('server_id')
         name = request.form.get('name')
         color = request.form.get('color', '#99AAB5')
-        permissions = request.form.get('permissions', 0)
         
         if not name:
             return jsonify({'error': 'Role name is required'}), 400
-            
-        # Check permissions
-        member = ServerMember.query.filter_by(
-            user_id=current_user.id,
-            server_id=server_id
-        ).first()
         
-        if not member or not any(role.permissions & 0x8 for role in member.roles):  # MANAGE_ROLES permission
+        try:
+            permissions = int(request.form.get('permissions', 0))
+        except ValueError:
+            return jsonify({'error': 'permissions must be an integer'}), 400
+        if permissions < 0 or permissions & ~Permissions.all_permissions().value:
+            return jsonify({'error': 'Unknown permission bits'}), 400
+        # Nobody can hand out permissions they do not have themselves
+        if not grantable(server_id, permissions):
             return jsonify({'error': 'Insufficient permissions'}), 403
             
         role = Role(
             name=name,
             server_id=server_id,
             color=color,
-            permissions=permissions
+            permissions=permissions,
+            is_default=request.form.get('is_default', 'false').lower() == 'true'
         )
         db.session.add(role)
         db.session.commit()
@@ -440,7 +762,8 @@ def create_role():
             'id': role.id,
             'name': role.name,
             'color': role.color,
-            'permissions': role.permissions
+            'permissions': role.permissions,
+            'is_default': role.is_default
         })
         
     except Exception as e:
@@ -449,20 +772,10 @@ def create_role():
 
 @main.route('/api/servers/<int:server_id>/members/<int:user_id>/roles', methods=['POST'])
 @login_required
-def assign_role():
+@has_permission(Permissions.MANAGE_ROLES)
+def assign_role(server_id, user_id):
     try:
-        server_id = request.form.get('server_id')
-        user_id = request.form.get('user_id')
-        role_id = request.form.get('role_id')
-        
-        # Check permissions
-        member = ServerMember.query.filter_by(
-            user_id=current_user.id,
-            server_id=server_id
-        ).first()
-        
-        if not member or not any(role.permissions & 0x8 for role in member.roles):  # MANAGE_ROLES permission
-            return jsonify({'error': 'Insufficient permissions'}), 403
+        role_id = request.form.get('role_id', type=int)
             
         target_member = ServerMember.query.filter_by(
             user_id=user_id,
@@ -472,11 +785,14 @@ def assign_role():
         if not target_member:
             return jsonify({'error': 'Member not found'}), 404
             
-        role = Role.query.get(role_id)
+        role = Role.query.get(role_id) if role_id else None
         if not role or role.server_id != server_id:
             return jsonify({'error': 'Role not found'}), 404
+        if not grantable(server_id, role.permissions or 0):
+            return jsonify({'error': 'Insufficient permissions'}), 403
             
-        target_member.roles.append(role)
+        if role not in target_member.roles:
+            target_member.roles.append(role)
         db.session.commit()
         
         return jsonify({
@@ -492,20 +808,19 @@ def assign_role():
 def handle_connect():
     if current_user.is_authenticated:
         join_room(f'user_{current_user.id}')
-        current_user.status = 'online'
-        db.session.commit()
-        emit('user_status_changed', 
-             {'user_id': current_user.id, 'status': 'online'}, 
-             broadcast=True)
+        # Server rooms carry presence updates and other server-wide events
+        for membership in current_user.server_memberships:
+            join_room(f'server_{membership.server_id}')
+        status_tracker.connect(current_user.id, request.sid)
+        signaling.connect(current_user.id, request.sid)
 
 @socketio.on('disconnect')
-def handle_disconnect():
+def handle_disconnect(reason=None):
+    leave_all_rooms(request.sid)
+    typing_tracker.disconnect(request.sid)
     if current_user.is_authenticated:
-        current_user.status = 'offline'
-        db.session.commit()
-        emit('user_status_changed', 
-             {'user_id': current_user.id, 'status': 'offline'}, 
-             broadcast=True)
+        signaling.disconnect(current_user.id, request.sid)
+        status_tracker.disconnect(current_user.id, request.sid)
 
 @socketio.on('join_server')
 def on_join(data):
@@ -523,9 +838,103 @@ def on_leave(data):
             leave_room(f'server_{server_id}')
             emit('left_server', {'server_id': server_id}, room=request.sid)
 
+@socketio.on('join_channel')
+def on_join_channel(data):
+    if not current_user.is_authenticated:
+        return
+    channel_id = data.get('channel_id')
+    server_id = channel_server_id(channel_id) if channel_id else None
+    if server_id is None or not is_member(current_user.id, server_id):
+        emit('error', 'Channel not found', room=request.sid)
+        return
+    
+    # Private channels reach their audience through the user rooms instead
+    if channel_audience(channel_id) is None:
+        join_room(f'channel_{channel_id}')
+    emit('joined_channel', {
+        'channel_id': channel_id,
+        'epoch': channel_events.epoch,
+        'event_seq': channel_events.seq
+    }, room=request.sid)
+
+@socketio.on('resume')
+def on_resume(data):
+    """Rejoins a channel after a reconnect and replays the events missed
+    since event_seq, if they are still buffered."""
+    if not current_user.is_authenticated:
+        return
+    channel_id = data.get('channel_id')
+    event_seq = data.get('event_seq')
+    if not isinstance(channel_id, int) or not isinstance(event_seq, int):
+        emit('error', 'Channel and event_seq are required', room=request.sid)
+        return
+    server_id = channel_server_id(channel_id)
+    if server_id is None or not is_member(current_user.id, server_id):
+        emit('error', 'Channel not found', room=request.sid)
+        return
+    audience = channel_audience(channel_id)
+    if audience is not None and current_user.id not in audience:
+        emit('error', 'No access to this channel', room=request.sid)
+        return
+    
+    # Joined before reading the buffer, so no event falls in between
+    if audience is None:
+        join_room(f'channel_{channel_id}')
+    events = channel_events.since(channel_id, data.get('epoch'), event_seq)
+    for event, payload in events or ():
+        emit(event, payload, room=request.sid)
+    
+    # Incomplete means the client reloads through the history API
+    emit('resumed', {
+        'channel_id': channel_id,
+        'epoch': channel_events.epoch,
+        'event_seq': channel_events.seq,
+        'complete': events is not None,
+        'replayed': len(events or ())
+    }, room=request.sid)
+
+@socketio.on('leave_channel')
+def on_leave_channel(data):
+    channel_id = data.get('channel_id')
+    if current_user.is_authenticated and channel_id:
+        leave_room(f'channel_{channel_id}')
+
+@socketio.on('typing')
+def on_typing(data):
+    if not current_user.is_authenticated:
+        return
+    try:
+        channel_id = int(data.get('channel_id'))
+    except (TypeError, ValueError):
+        return
+    # Checked before any lookup, a flood of pings costs nothing
+    if not typing_tracker.allow(request.sid, channel_id):
+        return
+    
+    server_id = channel_server_id(channel_id)
+    if server_id is None or not is_member(current_user.id, server_id):
+        return
+    audience = channel_audience(channel_id)
+    if audience is not None and current_user.id not in audience:
+        return
+    
+    typing_tracker.start(
+        channel_id, current_user.id, current_user.username, request.sid,
+        f'channel_{channel_id}' if audience is None else [f'user_{user_id}' for user_id in audience]
+    )
+
+@socketio.on('stop_typing')
+def on_stop_typing(data):
+    if not current_user.is_authenticated:
+        return
+    try:
+        typing_tracker.stop(int(data.get('channel_id')), current_user.id)
+    except (TypeError, ValueError):
+        pass
+
 @socketio.on_error()
 def error_handler(e):
-    print('SocketIO error:', str(e))
+    current_app.logger.error(f"SocketIO error: {str(e)}")
     emit('error', str(e), room=request.sid)
 
 @socketio.on('message')
@@ -547,38 +956,57 @@ def handle_message(data):
             return
         
         # Verify channel exists and user has access
-        channel = Channel.query.get(channel_id)
-        if not channel:
+        server_id = channel_server_id(channel_id)
+        if server_id is None:
             emit('error', 'Channel not found', room=request.sid)
             return
             
-        server_member = ServerMember.query.filter_by(
-            user_id=current_user.id,
-            server_id=channel.server_id
-        ).first()
-        
-        if not server_member:
+        if not is_member(current_user.id, server_id):
             emit('error', 'Not a member of this server', room=request.sid)
             return
         
-        message = Message(
-            content=content,
-            channel_id=channel_id,
-            user_id=current_user.id
-        )
-        db.session.add(message)
-        db.session.commit()
+        # Private channels only reach the users allowed to view them
+        audience = channel_audience(channel_id)
+        if audience is not None and current_user.id not in audience:
+            emit('error', 'No access to this channel', room=request.sid)
+            return
+        
+        if message_writer.enabled:
+            # Broadcast right away, the row is committed with the next batch
+            message = message_writer.submit(channel_id, current_user.id, content)
+            message_id = message['id']
+            created_at = message['created_at']
+        else:
+            message = Message(
+                content=content,
+                channel_id=channel_id,
+                user_id=current_user.id
+            )
+            db.session.add(message)
+            db.session.flush()
+            record_messages([{
+                'id': message.id,
+                'channel_id': message.channel_id,
+                'user_id': message.user_id,
+                'content': content
+            }])
+            db.session.commit()
+            message_id = message.id
+            created_at = message.created_at
+        
+        typing_tracker.stop(int(channel_id), current_user.id)
         
-        emit('new_message', {
-            'message_id': message.id,
-            'content': message.content,
-            'user_id': message.user_id,
+        channel_events.publish(int(channel_id), 'new_message', {
+            'channel_id': int(channel_id),
+            'message_id': message_id,
+            'content': content,
+            'user_id': current_user.id,
             'username': current_user.username,
             'avatar_url': current_user.avatar_url,
-            'created_at': message.created_at.isoformat()
-        }, room=f'channel_{channel_id}')
+            'created_at': created_at.isoformat()
+        }, channel_target(channel_id, audience))
         
     except Exception as e:
-        print('Error handling message:', str(e))
+        current_app.logger.exception(f"Error handling message: {str(e)}")
         db.session.rollback()
         emit('error', 'Error sending message', room=request.sid)
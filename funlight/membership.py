@@ -0,0 +1,142 @@
+"""Set-based membership changes, for onboarding whole communities at once.
+
+Members are inserted in batches of MEMBER_BATCH_SIZE rows with
+INSERT ... ON CONFLICT DO NOTHING against the (server_id, user_id) unique
+constraint, so existing memberships are skipped by the database instead of
+being looked up one by one. Default roles are assigned in the same
+transaction and the server room gets one members_added event per call.
+"""
+import secrets
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import load_only
+
+from funlight import db, socketio
+from funlight.models import User, ServerMember, Role, Invite, member_roles
+from funlight.permissions import queue_member_invalidations
+
+MEMBER_BATCH_SIZE = 200
+
+_UPSERT_INSERTS = {
+    'sqlite': sqlite.insert,
+    'postgresql': postgresql.insert
+}
+
+def _insert_new_members(server_id, rows):
+    """Inserts member rows, skipping existing memberships.
+    
+    Returns (member_id, user_id) of the rows actually inserted.
+    """
+    upsert_insert = _UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if upsert_insert is not None:
+        statement = upsert_insert(ServerMember).values(rows).on_conflict_do_nothing(
+            index_elements=['server_id', 'user_id']
+        ).returning(ServerMember.id, ServerMember.user_id)
+        return db.session.execute(statement).all()
+    
+    # Other databases: filter out existing members first, then read the ids back
+    user_ids = [row['user_id'] for row in rows]
+    existing = {user_id for user_id, in db.session.query(ServerMember.user_id).filter(
+        ServerMember.server_id == server_id, ServerMember.user_id.in_(user_ids)
+    )}
+    rows = [row for row in rows if row['user_id'] not in existing]
+    if not rows:
+        return []
+    db.session.execute(insert(ServerMember), rows)
+    return db.session.query(ServerMember.id, ServerMember.user_id).filter(
+        ServerMember.server_id == server_id,
+        ServerMember.user_id.in_([row['user_id'] for row in rows])
+    ).all()
+
+def add_members(server_id, user_ids, commit=True):
+    """Adds users to a server and returns the members that were added.
+    
+    Unknown users and existing members are skipped. Everything happens in
+    the caller's transaction, which is committed unless commit is False.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    default_role_ids = [role_id for role_id, in db.session.query(Role.id).filter_by(
+        server_id=server_id, is_default=True
+    )]
+    joined_at = datetime.utcnow()
+    
+    added = []
+    for start in range(0, len(user_ids), MEMBER_BATCH_SIZE):
+        users = {user.id: user for user in db.session.query(User).options(
+            load_only(User.id, User.username, User.avatar)
+        ).filter(User.id.in_(user_ids[start:start + MEMBER_BATCH_SIZE]))}
+        if not users:
+            continue
+        
+        new_members = _insert_new_members(server_id, [{
+            'server_id': server_id,
+            'user_id': user_id,
+            'role': 'member',
+            'joined_at': joined_at
+        } for user_id in users])
+        
+        if new_members and default_role_ids:
+            db.session.execute(member_roles.insert(), [
+                {'member_id': member_id, 'role_id': role_id}
+                for member_id, _ in new_members for role_id in default_role_ids
+            ])
+        
+        added.extend({
+            'id': member_id,
+            'user_id': user_id,
+            'username': users[user_id].username,
+            'avatar': users[user_id].avatar_url
+        } for member_id, user_id in new_members)
+    
+    session = db.session()
+    queue_member_invalidations(session, server_id, [member['user_id'] for member in added])
+    if commit:
+        db.session.commit()
+    return added
+
+def announce_members(server_id, members):
+    """One members_added frame for the server room, however many joined."""
+    if members:
+        socketio.emit('members_added', {
+            'server_id': server_id,
+            'members': members
+        }, room=f'server_{server_id}')
+
+def create_invite(server_id, creator_id, max_uses=None, expires_in=None):
+    invite = Invite(
+        code=secrets.token_urlsafe(6),
+        server_id=server_id,
+        creator_id=creator_id,
+        max_uses=max_uses,
+        expires_at=datetime.utcnow() + timedelta(seconds=expires_in) if expires_in else None
+    )
+    db.session.add(invite)
+    db.session.commit()
+    return invite
+
+def redeem_invite(invite, user_id):
+    """Uses up one invite use and adds the user, returns the added members.
+    
+    Returns None if the invite is expired or used up. The use counter is
+    bumped with a conditional UPDATE, so concurrent joins never exceed
+    max_uses.
+    """
+    now = datetime.utcnow()
+    claimed = Invite.query.filter(
+        Invite.id == invite.id,
+        (Invite.max_uses.is_(None)) | (Invite.uses < Invite.max_uses),
+        (Invite.expires_at.is_(None)) | (Invite.expires_at > now)
+    ).update({'uses': Invite.uses + 1}, synchronize_session=False)
+    if not claimed:
+        db.session.rollback()
+        return None
+    
+    added = add_members(invite.server_id, [user_id], commit=False)
+    if not added:
+        # Already a member, the use is not spent
+        db.session.rollback()
+        return []
+    db.session.commit()
+    return added
@@ -0,0 +1,108 @@
+"""Message edits and deletes as sequenced deltas.
+
+Every edit or delete bumps its channel's seq and is recorded in
+message_change, in the transaction that changes the message. Clients get
+one small event per change instead of reloading history:
+
+    message_edited    {channel_id, seq, message_id, content, edited_at}
+    messages_deleted  {channel_id, seq, message_ids}
+
+The history API returns the channel's current seq. A client that missed
+events, for example while reconnecting, asks for the changes since the last
+seq it applied. The answer is read from the (channel_id, seq) index, so it
+costs O(changes) and never depends on the size of the channel. New messages
+are not part of the seq, they are fetched with the after=<id> keyset.
+"""
+from datetime import datetime
+
+from sqlalchemy import func
+
+from funlight import db
+from funlight.models import Attachment, Channel, Message, MessageChange
+
+# Beyond this many changes a client is told to reload the channel instead
+MAX_CHANGES = 500
+
+def _next_seq(channel_id):
+    # The row stays locked until the commit, so concurrent changes queue up
+    Channel.query.filter_by(id=channel_id).update({'seq': Channel.seq + 1}, synchronize_session=False)
+    return db.session.query(Channel.seq).filter(Channel.id == channel_id).scalar()
+
+def edit_message(message, content):
+    """Changes a message's content and returns the message_edited delta."""
+    message.content = content
+    message.edited_at = datetime.utcnow()
+    seq = _next_seq(message.channel_id)
+    db.session.add(MessageChange(channel_id=message.channel_id, seq=seq, message_id=message.id, kind='edit'))
+    db.session.commit()
+    return {
+        'channel_id': message.channel_id,
+        'seq': seq,
+        'message_id': message.id,
+        'content': content,
+        'edited_at': message.edited_at.isoformat()
+    }
+
+def delete_messages(channel_id, message_ids):
+    """Deletes messages of a channel and returns the messages_deleted delta,
+    None if none of them exist."""
+    message_ids = [message_id for message_id, in db.session.query(Message.id).filter(
+        Message.channel_id == channel_id, Message.id.in_(message_ids)
+    )]
+    if not message_ids:
+        return None
+    
+    # Uploaded files are shared by content hash, only the rows go
+    Attachment.query.filter(Attachment.message_id.in_(message_ids)).delete(synchronize_session=False)
+    Message.query.filter(Message.id.in_(message_ids)).delete(synchronize_session=False)
+    
+    seq = _next_seq(channel_id)
+    db.session.execute(MessageChange.__table__.insert(), [{
+        'channel_id': channel_id,
+        'seq': seq,
+        'message_id': message_id,
+        'kind': 'delete'
+    } for message_id in message_ids])
+    
+    # A deleted head would keep the channel unread for everyone who read it
+    head = db.session.query(Channel.last_message_id).filter(Channel.id == channel_id).scalar()
+    if head in message_ids:
+        Channel.query.filter_by(id=channel_id).update({
+            'last_message_id': db.session.query(func.max(Message.id)).filter(
+                Message.channel_id == channel_id
+            ).scalar_subquery()
+        }, synchronize_session=False)
+    db.session.commit()
+    
+    return {
+        'channel_id': channel_id,
+        'seq': seq,
+        'message_ids': message_ids
+    }
+
+def changes_since(channel_id, since):
+    """What changed in a channel after seq since, each message once.
+    
+    Returns the current seq, the edited messages with their current content
+    and the deleted ids, or reset if there are more than MAX_CHANGES.
+    """
+    seq = db.session.query(Channel.seq).filter(Channel.id == channel_id).scalar() or 0
+    changes = db.session.query(MessageChange.message_id, MessageChange.kind).filter(
+        MessageChange.channel_id == channel_id, MessageChange.seq > since
+    ).order_by(MessageChange.seq).limit(MAX_CHANGES + 1).all()
+    if len(changes) > MAX_CHANGES:
+        return {'seq': seq, 'reset': True}
+    
+    deleted = {message_id for message_id, kind in changes if kind == 'delete'}
+    edited_ids = {message_id for message_id, kind in changes if kind == 'edit'} - deleted
+    edited = Message.query.filter(Message.id.in_(edited_ids)).order_by(Message.id).all() if edited_ids else []
+    return {
+        'seq': seq,
+        'reset': False,
+        'edited': [{
+            'message_id': message.id,
+            'content': message.content,
+            'edited_at': message.edited_at.isoformat() if message.edited_at else None
+        } for message in edited],
+        'deleted': sorted(deleted)
+    }
@@ -0,0 +1,283 @@
+import atexit
+import fcntl
+import glob
+import itertools
+import json
+import logging
+import os
+import secrets
+import threading
+from datetime import datetime
+
+from sqlalchemy import func
+
+from funlight import db
+from funlight.models import Message
+from funlight.read_state import record_messages
+
+logger = logging.getLogger(__name__)
+
+# Durability levels for MESSAGE_DURABILITY:
+#   'memory'  - messages only live in the buffer until the next batch commit
+#   'journal' - every message is appended to the journal before it is broadcast
+#   'fsync'   - like 'journal', but the journal is fsynced before the broadcast
+DURABILITY_LEVELS = ('memory', 'journal', 'fsync')
+
+# A batch that failed this often is inserted row by row, rows that still fail
+# are appended to DEAD_LETTER_FILE in the journal directory
+MAX_FLUSH_ATTEMPTS = 5
+DEAD_LETTER_FILE = 'dead_letter.jsonl'
+# Longest wait between retries of a failing batch, in seconds
+MAX_RETRY_DELAY = 30
+
+class MessageWriter:
+    """Write-behind persistence for chat messages.
+    
+    Message ids are handed out in process, so a message can be broadcast as
+    soon as it is accepted. Accepted messages are buffered and inserted in a
+    single transaction once MESSAGE_BATCH_SIZE messages are pending or
+    MESSAGE_FLUSH_INTERVAL seconds have passed. Unless durability is
+    'memory', pending messages are also appended to a journal segment, which
+    is replayed on the next start if the process dies before the batch is
+    committed. Segments are named after their process, which holds a lock
+    on <owner>.lock in the journal directory while it runs. Only segments
+    whose lock is free are replayed, those of live workers are left alone.
+    A failing batch is retried with backoff, after MAX_FLUSH_ATTEMPTS its
+    rows are inserted one by one and the ones that still fail are set aside
+    in the dead-letter file, so they cannot block the messages after them.
+    
+    Ids are allocated from MAX(message.id) at startup, so only one process
+    may write messages while write-behind is enabled. create_app refuses
+    it together with SOCKETIO_MESSAGE_QUEUE, which implies several workers,
+    and with SQLite in the green modes, where flush() would wait for the one
+    pooled connection held by the request that calls it.
+    """
+    
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._journal = None
+        self._segment = itertools.count()
+        self._unflushed_segments = []
+        self._failures = 0
+        self._ids = None
+        self._owner = None
+        self._owner_lock = None
+        if app is not None:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['MESSAGE_WRITE_BEHIND']
+        if not self.enabled:
+            return
+        
+        self.batch_size = app.config['MESSAGE_BATCH_SIZE']
+        self.flush_interval = app.config['MESSAGE_FLUSH_INTERVAL']
+        self.durability = app.config['MESSAGE_DURABILITY']
+        if self.durability not in DURABILITY_LEVELS:
+            raise ValueError(f'MESSAGE_DURABILITY must be one of {DURABILITY_LEVELS}')
+        self.journal_dir = app.config['MESSAGE_JOURNAL_DIR']
+        os.makedirs(self.journal_dir, exist_ok=True)
+        # Unique even when pids are reused, e.g. pid 1 in every container
+        self._owner = f'{os.getpid()}.{secrets.token_hex(4)}'
+        
+        with app.app_context():
+            self.recover()
+            last_id = db.session.query(func.max(Message.id)).scalar() or 0
+        self._ids = itertools.count(last_id + 1)
+        self._open_segment()
+        
+        thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+        thread.start()
+        atexit.register(self.stop)
+    
+    def submit(self, channel_id, user_id, content):
+        """Accepts a message and returns its row as a dict with id and created_at set."""
+        with self._lock:
+            row = {
+                'id': next(self._ids),
+                'channel_id': channel_id,
+                'user_id': user_id,
+                'content': content,
+                'created_at': datetime.utcnow()
+            }
+            self._pending.append(row)
+            if self._journal is not None:
+                self._journal.write(json.dumps(row, default=datetime.isoformat) + '\n')
+                self._journal.flush()
+                if self.durability == 'fsync':
+                    os.fsync(self._journal.fileno())
+            pending = len(self._pending)
+        
+        if pending >= self.batch_size:
+            self._wakeup.set()
+        return row
+    
+    def flush(self):
+        """Commits everything that is pending. Safe to call from any thread."""
+        if not self.enabled:
+            return
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    # Reads flush on every request, nothing to rotate or insert
+                    return
+                batch, self._pending = self._pending, []
+                segment = self._close_segment()
+                self._open_segment()
+            
+            if segment:
+                self._unflushed_segments.append(segment)
+            
+            try:
+                with self.app.app_context():
+                    self._insert(batch)
+            except Exception:
+                self._failures += 1
+                if self._failures < MAX_FLUSH_ATTEMPTS:
+                    logger.exception('Failed to persist %d messages (attempt %d of %d)',
+                                     len(batch), self._failures, MAX_FLUSH_ATTEMPTS)
+                    # The journal segments stay on disk until a later flush succeeds,
+                    # the rows go back in front of anything accepted meanwhile
+                    with self._lock:
+                        self._pending[:0] = batch
+                    return
+                logger.exception('Failed to persist %d messages %d times, inserting them one by one',
+                                 len(batch), self._failures)
+                self._salvage(batch)
+            
+            self._failures = 0
+            for segment in self._unflushed_segments:
+                os.remove(segment)
+            self._unflushed_segments = []
+    
+    def _salvage(self, batch):
+        """Inserts rows one at a time, the ones that fail go to the dead-letter file."""
+        failed = []
+        with self.app.app_context():
+            for row in batch:
+                try:
+                    self._insert([row])
+                except Exception:
+                    db.session.rollback()
+                    failed.append(row)
+        if not failed:
+            return
+        
+        path = os.path.join(self.journal_dir, DEAD_LETTER_FILE)
+        with open(path, 'a') as dead_letter:
+            for row in failed:
+                dead_letter.write(json.dumps(row, default=datetime.isoformat) + '\n')
+            dead_letter.flush()
+            os.fsync(dead_letter.fileno())
+        logger.error('Moved %d messages that cannot be persisted to %s', len(failed), path)
+    
+    def recover(self):
+        """Replays journal segments left behind by crashed processes.
+        
+        Workers starting at the same time recover one after another, each
+        takes its own lock first so the others never mistake it for gone.
+        """
+        with open(os.path.join(self.journal_dir, 'recover.lock'), 'a') as recover_lock:
+            fcntl.flock(recover_lock, fcntl.LOCK_EX)
+            self._owner_lock = _try_lock(os.path.join(self.journal_dir, f'{self._owner}.lock'))
+            
+            owners = {}
+            segments = []
+            for segment in sorted(glob.glob(os.path.join(self.journal_dir, '*.journal'))):
+                owner = os.path.basename(segment).rsplit('-', 1)[0]
+                if owner not in owners:
+                    owners[owner] = _try_lock(os.path.join(self.journal_dir, f'{owner}.lock'))
+                if owners[owner] is not None:
+                    segments.append(segment)
+            
+            try:
+                self._replay(segments)
+            finally:
+                for lock in owners.values():
+                    if lock is not None:
+                        # Its process is gone, and so are its segments now
+                        os.remove(lock.name)
+                        lock.close()
+    
+    def _replay(self, segments):
+        if not segments:
+            return
+        
+        rows = {}
+        for segment in segments:
+            with open(segment) as journal:
+                for line in journal:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        # Torn write from the crash, everything before it is intact
+                        break
+                    row['created_at'] = datetime.fromisoformat(row['created_at'])
+                    rows[row['id']] = row
+        
+        existing = {message_id for message_id, in db.session.query(Message.id).filter(
+            Message.id.in_(list(rows))
+        )}
+        missing = [row for message_id, row in rows.items() if message_id not in existing]
+        if missing:
+            self._insert(missing)
+            logger.warning('Recovered %d unpersisted messages from the journal', len(missing))
+        
+        for segment in segments:
+            os.remove(segment)
+    
+    def stop(self):
+        self.flush()
+        with self._lock:
+            segment = self._close_segment()
+        if segment and not self._pending:
+            os.remove(segment)
+            if not self._unflushed_segments and self._owner_lock is not None:
+                # Nothing left to recover from this process
+                os.remove(self._owner_lock.name)
+    
+    def _insert(self, rows):
+        db.session.execute(Message.__table__.insert(), rows)
+        record_messages(rows)
+        db.session.commit()
+    
+    def _run(self):
+        while True:
+            # Failing batches are retried with exponential backoff
+            self._wakeup.wait(min(self.flush_interval * 2 ** self._failures, MAX_RETRY_DELAY))
+            self._wakeup.clear()
+            if self._pending:
+                self.flush()
+    
+    def _open_segment(self):
+        if self.durability == 'memory':
+            return
+        path = os.path.join(self.journal_dir, f'{self._owner}-{next(self._segment):08d}.journal')
+        self._journal = open(path, 'a')
+    
+    def _close_segment(self):
+        if self._journal is None:
+            return None
+        path = self._journal.name
+        self._journal.close()
+        self._journal = None
+        return path
+
+def _try_lock(path):
+    """An open file holding an exclusive lock on path, None if another
+    process holds it."""
+    lock = open(path, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+message_writer = MessageWriter()
@@ -3,12 +3,8 @@ from funlight import db
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask import url_for
-
-# Add friendship association table
-friendships = db.Table('friendships',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-    db.Column('friend_id', db.Integer, db.ForeignKey('user.id'), primary_key=True)
-)
+from funlight.variants import variant_worker
+from funlight.green import run_blocking
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -22,12 +18,6 @@ class User(UserMixin, db.Model):
     # Relationships
     owned_servers = db.relationship('Server', back_populates='owner', lazy=True, foreign_keys='Server.owner_id')
     server_memberships = db.relationship('ServerMember', back_populates='member', lazy=True)
-    friends = db.relationship('User', 
-        secondary=friendships,
-        primaryjoin=(friendships.c.user_id == id),
-        secondaryjoin=(friendships.c.friend_id == id),
-        lazy='dynamic'
-    )
     
     # Add sent and received friend requests
     sent_friend_requests = db.relationship('FriendRequest',
@@ -54,10 +44,11 @@ class User(UserMixin, db.Model):
         return url_for('static', filename=self.avatar)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        # Hashing takes a noticeable amount of CPU, keep it off the event loop
+        self.password_hash = run_blocking(generate_password_hash, password)
         
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return run_blocking(check_password_hash, self.password_hash, password)
     
     def to_dict(self):
         return {
@@ -82,6 +73,7 @@ class Server(db.Model):
     channels = db.relationship('Channel', back_populates='server', lazy=True, cascade='all, delete-orphan')
     members = db.relationship('ServerMember', back_populates='server', lazy=True, cascade='all, delete-orphan')
     categories = db.relationship('Category', back_populates='server', lazy=True, cascade='all, delete-orphan')
+    invites = db.relationship('Invite', back_populates='server', lazy=True, cascade='all, delete-orphan')
 
     def __repr__(self):
         return f'<Server {self.name}>'
@@ -98,6 +90,11 @@ class Category(db.Model):
     channels = db.relationship('Channel', back_populates='category', order_by='Channel.position')
 
 class Channel(db.Model):
+    # Unread badges look up the channels of a user's servers
+    __table_args__ = (
+        db.Index('ix_channel_server_id', 'server_id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     server_id = db.Column(db.Integer, db.ForeignKey('server.id'), nullable=False)
@@ -107,13 +104,25 @@ class Channel(db.Model):
     position = db.Column(db.Integer, default=0)
     private = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # High-water mark for unread badges, advanced with every message insert
+    last_message_id = db.Column(db.Integer)
+    # Number of edits and deletes so far, clients resync from their last seq
+    seq = db.Column(db.Integer, nullable=False, default=0)
     
     # Relationships
     server = db.relationship('Server', back_populates='channels')
     category = db.relationship('Category', back_populates='channels')
     messages = db.relationship('Message', back_populates='channel', cascade='all, delete-orphan')
+    read_states = db.relationship('ReadState', cascade='all, delete-orphan')
+    changes = db.relationship('MessageChange', cascade='all, delete-orphan')
 
 class Message(db.Model):
+    # History is always read per channel in id order, so (channel_id, id) is
+    # the keyset used for pagination
+    __table_args__ = (
+        db.Index('ix_message_channel_id_id', 'channel_id', 'id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'), nullable=False)
@@ -125,20 +134,77 @@ class Message(db.Model):
     
     # Relationship
     channel = db.relationship('Channel', back_populates='messages')
+    author = db.relationship('User')
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'channel_id': self.channel_id,
+            'content': self.content,
+            'author': {
+                'id': self.author.id,
+                'username': self.author.username,
+                'avatar': self.author.avatar_url
+            },
+            'timestamp': self.created_at.isoformat(),
+            'edited_at': self.edited_at.isoformat() if self.edited_at else None,
+            'attachments': [{
+                'id': attachment.id,
+                'name': attachment.original_name or attachment.filename,
+                'type': attachment.file_type or '',
+                'url': f'/uploads/{attachment.filename}',
+                'variants': variant_worker.urls(attachment.filename, 'preview')
+            } for attachment in self.attachments]
+        }
+
+class MessageChange(db.Model):
+    """An edit or delete of a message, numbered by its channel's seq.
+    
+    A bulk delete is one seq with a row per message.
+    """
+    __tablename__ = 'message_change'
+    __table_args__ = (
+        db.Index('ix_message_change_channel_id_seq', 'channel_id', 'seq'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)
+    message_id = db.Column(db.Integer, nullable=False)  # No foreign key, deleted messages keep their changes
+    kind = db.Column(db.String(10), nullable=False)  # 'edit' or 'delete'
 
 class Attachment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(255), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)  # <sha256>.<ext>, shared by identical files
+    original_name = db.Column(db.String(255))
     file_type = db.Column(db.String(50))
     message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class ReadState(db.Model):
+    """How far a user has read a channel, and the mentions since then."""
+    __tablename__ = 'read_state'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'), primary_key=True)
+    last_read_message_id = db.Column(db.Integer)  # None if the user never opened the channel
+    mention_count = db.Column(db.Integer, nullable=False, default=0)
+
 class ServerMember(db.Model):
     __tablename__ = 'server_member'
+    __table_args__ = (
+        db.Index('ix_server_member_user_id', 'user_id'),
+        # Member lists are paged per server in id order
+        db.Index('ix_server_member_server_id_id', 'server_id', 'id'),
+        # Target of the ON CONFLICT DO NOTHING bulk membership inserts
+        db.UniqueConstraint('server_id', 'user_id', name='uq_server_member_server_id_user_id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     server_id = db.Column(db.Integer, db.ForeignKey('server.id'), nullable=False)
     role = db.Column(db.String(20), nullable=False, default='member')
+    nickname = db.Column(db.String(32))
     joined_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -156,6 +222,7 @@ class Role(db.Model):
     server_id = db.Column(db.Integer, db.ForeignKey('server.id'), nullable=False)
     permissions = db.Column(db.Integer, default=0)
     color = db.Column(db.String(7))  # Hex color code
+    is_default = db.Column(db.Boolean, default=False)  # Given to every new member
 
 # Association table for many-to-many relationship between ServerMember and Role
 member_roles = db.Table('member_roles',
@@ -163,7 +230,82 @@ member_roles = db.Table('member_roles',
     db.Column('role_id', db.Integer, db.ForeignKey('role.id'), primary_key=True)
 )
 
+class Invite(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(16), unique=True, nullable=False)
+    server_id = db.Column(db.Integer, db.ForeignKey('server.id'), nullable=False, index=True)
+    creator_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    max_uses = db.Column(db.Integer)  # None means unlimited
+    uses = db.Column(db.Integer, nullable=False, default=0)
+    expires_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    server = db.relationship('Server', back_populates='invites')
+
+class RoomPresence(db.Model):
+    """A socket that is currently online or in a voice or video room."""
+    __tablename__ = 'room_presence'
+    __table_args__ = (
+        db.Index('ix_room_presence_room_user_id', 'room', 'user_id'),
+        db.Index('ix_room_presence_sid', 'sid'),
+        db.Index('ix_room_presence_expires_at', 'expires_at'),
+    )
+    
+    room = db.Column(db.String(64), primary_key=True)  # voice_<channel_id> / video_<room_id> / online
+    sid = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class DirectConversation(db.Model):
+    """A 1:1 or small group conversation outside of servers.
+    
+    1:1 conversations are keyed by their canonical (user_low_id, user_high_id)
+    pair, so opening one is a single unique lookup. Group conversations leave
+    the pair empty and are only reached through their participants.
+    """
+    __tablename__ = 'dm_conversation'
+    __table_args__ = (
+        db.UniqueConstraint('user_low_id', 'user_high_id', name='uq_dm_conversation_pair'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_low_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_high_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    name = db.Column(db.String(100))  # Groups only
+    last_message_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class DirectParticipant(db.Model):
+    __tablename__ = 'dm_participant'
+    __table_args__ = (
+        # A user's conversation list
+        db.Index('ix_dm_participant_user_id', 'user_id'),
+    )
+    
+    conversation_id = db.Column(db.Integer, db.ForeignKey('dm_conversation.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+
+class DirectMessage(db.Model):
+    __tablename__ = 'dm_message'
+    # Read per conversation in id order, like message history
+    __table_args__ = (
+        db.Index('ix_dm_message_conversation_id_id', 'conversation_id', 'id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('dm_conversation.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class FriendRequest(db.Model):
+    """A pending friend request, deleted once it is answered."""
+    __table_args__ = (
+        # Incoming requests of a user
+        db.Index('ix_friend_request_receiver_id_status', 'receiver_id', 'status'),
+        db.Index('ix_friend_request_sender_id_receiver_id', 'sender_id', 'receiver_id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -173,20 +315,19 @@ class FriendRequest(db.Model):
     def __repr__(self):
         return f'<FriendRequest {self.sender_id} -> {self.receiver_id}>'
 
-class FriendAssociation(db.Model):
-    __tablename__ = 'friend_associations'
+class Friendship(db.Model):
+    """One row per pair of friends, stored once as (lower id, higher id).
     
-    id = db.Column(db.Integer, primary_key=True)
-    user1_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    user2_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    status = db.Column(db.String(20), default='pending')  # pending, accepted, blocked
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    
-    # Relationships
-    user1 = db.relationship('User', foreign_keys=[user1_id], backref=db.backref('sent_friend_associations', lazy='dynamic'))
-    user2 = db.relationship('User', foreign_keys=[user2_id], backref=db.backref('received_friend_associations', lazy='dynamic'))
+    The primary key answers "are these two friends" and lists the friends
+    with a higher id, the reverse index lists those with a lower id. Both
+    cover the query, so the table itself is never read.
+    """
+    __tablename__ = 'friendship'
+    __table_args__ = (
+        db.Index('ix_friendship_user_high_id_user_low_id', 'user_high_id', 'user_low_id'),
+        db.CheckConstraint('user_low_id < user_high_id', name='ck_friendship_ordered'),
+    )
     
-    def __init__(self, user1_id, user2_id, status='pending'):
-        self.user1_id = user1_id
-        self.user2_id = user2_id
-        self.status = status
+    user_low_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    user_high_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -1,7 +1,12 @@
+from collections import OrderedDict
 from enum import Flag, auto
 from functools import wraps
+import threading
+import time
 from flask import abort
 from flask_login import current_user
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
 
 class Permissions(Flag):
     # Basis-Berechtigungen
@@ -47,6 +52,284 @@ class Permissions(Flag):
             result |= permission
         return result
 
+class PermissionCache:
+    """LRU cache of computed permission bitmasks keyed by (user_id, server_id).
+
+    A value of None means the user is not a member of the server. Entries are
+    dropped by the session listeners below whenever a role, a member's role
+    list, a membership or the server owner changes. Every invalidation bumps
+    the server's generation, so bits computed before it are not stored.
+    
+    The listeners only see writes of their own process. With several
+    workers, ttl (seconds) bounds how long another worker's change can go
+    unnoticed; None keeps entries until they are invalidated or evicted.
+    """
+    
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._by_server = {}
+        self._generations = {}
+        self._clears = 0
+        self._lock = threading.Lock()
+    
+    def get(self, user_id, server_id):
+        key = (user_id, server_id)
+        with self._lock:
+            if key not in self._entries:
+                raise KeyError(key)
+            bits, expires = self._entries[key]
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                self._discard_index(user_id, server_id)
+                raise KeyError(key)
+            self._entries.move_to_end(key)
+            return bits
+    
+    def generation(self, server_id):
+        """Taken before computing bits and passed to set."""
+        with self._lock:
+            return self._clears, self._generations.get(server_id, 0)
+    
+    def set(self, user_id, server_id, bits, generation=None):
+        key = (user_id, server_id)
+        with self._lock:
+            if generation is not None and (self._clears, self._generations.get(server_id, 0)) != generation:
+                # Invalidated while the bits were computed, they may be stale
+                return
+            self._entries[key] = (bits, _expiry(self.ttl))
+            self._entries.move_to_end(key)
+            self._by_server.setdefault(server_id, set()).add(user_id)
+            while len(self._entries) > self.maxsize:
+                (old_user_id, old_server_id), _ = self._entries.popitem(last=False)
+                self._discard_index(old_user_id, old_server_id)
+    
+    def invalidate(self, user_id, server_id):
+        with self._lock:
+            self._generations[server_id] = self._generations.get(server_id, 0) + 1
+            if self._entries.pop((user_id, server_id), _MISSING) is not _MISSING:
+                self._discard_index(user_id, server_id)
+    
+    def invalidate_server(self, server_id):
+        with self._lock:
+            self._generations[server_id] = self._generations.get(server_id, 0) + 1
+            for user_id in self._by_server.pop(server_id, ()):
+                self._entries.pop((user_id, server_id), None)
+    
+    def clear(self):
+        with self._lock:
+            self._clears += 1
+            self._entries.clear()
+            self._by_server.clear()
+    
+    def _discard_index(self, user_id, server_id):
+        users = self._by_server.get(server_id)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self._by_server[server_id]
+
+_MISSING = object()
+
+def _expiry(ttl):
+    return time.monotonic() + ttl if ttl else None
+
+def _expired(expires):
+    return expires is not None and expires <= time.monotonic()
+
+permission_cache = PermissionCache()
+
+# Channels never move between servers, so channel lookups are cached until the
+# channel is deleted or its private flag changes, or for permission_cache.ttl
+# seconds when other workers may make those changes
+_channels = {}
+
+def _channel_info(channel_id):
+    info = _channels.get(channel_id)
+    if info is None or _expired(info[2]):
+        from funlight.models import Channel
+        channel = Channel.query.get(channel_id)
+        if not channel:
+            _channels.pop(channel_id, None)
+            return None
+        info = _channels[channel_id] = (channel.server_id, bool(channel.private), _expiry(permission_cache.ttl))
+    return info
+
+def channel_server_id(channel_id):
+    info = _channel_info(channel_id)
+    return info[0] if info else None
+
+def channel_is_private(channel_id):
+    info = _channel_info(channel_id)
+    return bool(info and info[1])
+
+def _compute_permission_bits(user_id, server_id):
+    """Resolves a user's effective permissions on a server in a single query.
+
+    Returns _MISSING if the server does not exist and None if the user is not
+    a member. Owners and administrators get every permission bit.
+    """
+    from funlight import db
+    from funlight.models import Server, ServerMember, Role, member_roles
+    
+    rows = db.session.query(Server.owner_id, ServerMember.id, Role.permissions).outerjoin(
+        ServerMember,
+        (ServerMember.server_id == Server.id) & (ServerMember.user_id == user_id)
+    ).outerjoin(
+        member_roles, member_roles.c.member_id == ServerMember.id
+    ).outerjoin(
+        Role, Role.id == member_roles.c.role_id
+    ).filter(Server.id == server_id).all()
+    
+    if not rows:
+        return _MISSING
+    
+    # Server Owner hat alle Berechtigungen
+    if rows[0].owner_id == user_id:
+        return Permissions.all_permissions().value
+    
+    if rows[0][1] is None:
+        return None
+    
+    # Kombiniere Berechtigungen aller Rollen des Benutzers
+    bits = 0
+    for row in rows:
+        bits |= int(row.permissions or 0)
+    
+    if bits & Permissions.ADMINISTRATOR.value:
+        return Permissions.all_permissions().value
+    return bits
+
+def get_permission_bits(user_id, server_id):
+    """Cached effective permission bitmask, None for non-members and _MISSING
+    for unknown servers."""
+    try:
+        return permission_cache.get(user_id, server_id)
+    except KeyError:
+        pass
+    
+    generation = permission_cache.generation(server_id)
+    bits = _compute_permission_bits(user_id, server_id)
+    if bits is not _MISSING:
+        permission_cache.set(user_id, server_id, bits, generation)
+    return bits
+
+def is_member(user_id, server_id):
+    """Cached membership check, the owner always counts as a member."""
+    bits = get_permission_bits(user_id, server_id)
+    return bits is not None and bits is not _MISSING
+
+def _can_view(bits):
+    return bits is not None and bits is not _MISSING and bool(bits & Permissions.VIEW_CHANNEL.value)
+
+def _compute_viewers(server_id):
+    """Members of a server whose roles grant VIEW_CHANNEL, in a single query."""
+    from funlight import db
+    from funlight.models import Server, ServerMember, Role, member_roles
+    
+    rows = db.session.query(Server.owner_id, ServerMember.user_id, Role.permissions).outerjoin(
+        ServerMember, ServerMember.server_id == Server.id
+    ).outerjoin(
+        member_roles, member_roles.c.member_id == ServerMember.id
+    ).outerjoin(
+        Role, Role.id == member_roles.c.role_id
+    ).filter(Server.id == server_id).all()
+    
+    if not rows:
+        return frozenset()
+    
+    bits = {}
+    for row in rows:
+        if row.user_id is not None:
+            bits[row.user_id] = bits.get(row.user_id, 0) | int(row.permissions or 0)
+    
+    viewers = {user_id for user_id, user_bits in bits.items()
+               if user_bits & (Permissions.VIEW_CHANNEL.value | Permissions.ADMINISTRATOR.value)}
+    viewers.add(rows[0].owner_id)
+    return frozenset(viewers)
+
+class ChannelAudienceCache:
+    """Users allowed to receive the messages of a server's private channels.
+    
+    Channels have no per-channel overrides, so the audience of a private
+    channel is every member whose roles grant VIEW_CHANNEL plus owner and
+    administrators, shared by all private channels of a server. A set is
+    built with one query on first use. Membership and role assignment
+    changes only mark the affected user, who is re-resolved on the next read;
+    role permission and ownership changes drop the whole set. Like
+    PermissionCache, sets are rebuilt after ttl seconds if ttl is set.
+    """
+    
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._viewers = {}
+        self._expires = {}
+        self._stale = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+    
+    def get(self, server_id):
+        with self._lock:
+            viewers = self._viewers.get(server_id)
+            stale = self._stale.pop(server_id, set())
+            generation = self._generations.get(server_id, 0)
+            expires = self._expires.get(server_id)
+        
+        if viewers is None or _expired(expires):
+            viewers = _compute_viewers(server_id)
+            expires = _expiry(self.ttl)
+        elif stale:
+            viewers = set(viewers)
+            for user_id in stale:
+                if _can_view(get_permission_bits(user_id, server_id)):
+                    viewers.add(user_id)
+                else:
+                    viewers.discard(user_id)
+            viewers = frozenset(viewers)
+        else:
+            return viewers
+        
+        with self._lock:
+            # Only store it if the server was not invalidated while resolving
+            if self._generations.get(server_id, 0) == generation:
+                self._viewers[server_id] = viewers
+                self._expires[server_id] = expires
+        return viewers
+    
+    def invalidate(self, user_id, server_id):
+        with self._lock:
+            if server_id in self._viewers:
+                self._stale.setdefault(server_id, set()).add(user_id)
+            else:
+                # A set being built right now may already miss this change
+                self._generations[server_id] = self._generations.get(server_id, 0) + 1
+    
+    def invalidate_server(self, server_id):
+        with self._lock:
+            self._generations[server_id] = self._generations.get(server_id, 0) + 1
+            self._viewers.pop(server_id, None)
+            self._expires.pop(server_id, None)
+            self._stale.pop(server_id, None)
+    
+    def clear(self):
+        with self._lock:
+            for server_id in self._viewers:
+                self._generations[server_id] = self._generations.get(server_id, 0) + 1
+            self._viewers.clear()
+            self._expires.clear()
+            self._stale.clear()
+
+channel_audiences = ChannelAudienceCache()
+
+def channel_audience(channel_id):
+    """User ids that may receive a channel's messages, None if the whole
+    server may (public channels) or the channel does not exist."""
+    info = _channel_info(channel_id)
+    if not info or not info[1]:
+        return None
+    return channel_audiences.get(info[0])
+
 def has_permission(permission):
     def decorator(f):
         @wraps(f)
@@ -60,34 +343,17 @@ def has_permission(permission):
             if not server_id and not channel_id:
                 abort(400)
             
-            from funlight.models import Server, Channel, ServerMember, Role
-            
             if channel_id:
-                channel = Channel.query.get_or_404(channel_id)
-                server_id = channel.server_id
-            
-            server = Server.query.get_or_404(server_id)
+                server_id = channel_server_id(channel_id)
+                if server_id is None:
+                    abort(404)
             
-            # Server Owner hat alle Berechtigungen
-            if server.owner_id == current_user.id:
-                return f(*args, **kwargs)
-            
-            # Prüfe Benutzer-Rollen
-            member = ServerMember.query.filter_by(
-                user_id=current_user.id,
-                server_id=server_id
-            ).first()
-            
-            if not member:
-                abort(403)
-            
-            # Kombiniere Berechtigungen aller Rollen des Benutzers
-            user_permissions = Permissions(0)
-            for role in member.roles:
-                user_permissions |= Permissions(role.permissions)
+            bits = get_permission_bits(current_user.id, server_id)
+            if bits is _MISSING:
+                abort(404)
             
             # Prüfe ob Benutzer die erforderliche Berechtigung hat
-            if not (user_permissions & permission) and not (user_permissions & Permissions.ADMINISTRATOR):
+            if bits is None or not bits & permission.value:
                 abort(403)
             
             return f(*args, **kwargs)
@@ -98,27 +364,69 @@ def check_permission(user_id, server_id, permission):
     """
     Überprüft, ob ein Benutzer eine bestimmte Berechtigung auf einem Server hat.
     """
-    from funlight.models import Server, ServerMember
-    
-    server = Server.query.get(server_id)
-    if not server:
+    bits = get_permission_bits(user_id, server_id)
+    if bits is _MISSING or bits is None:
         return False
     
-    # Server Owner hat alle Berechtigungen
-    if server.owner_id == user_id:
-        return True
-    
-    member = ServerMember.query.filter_by(
-        user_id=user_id,
-        server_id=server_id
-    ).first()
+    return bool(bits & permission.value)
+
+def _changed(obj, attr):
+    return inspect(obj).attrs[attr].history.has_changes()
+
+def _previous_values(obj, attr):
+    """Values a column attribute had before the pending change, if loaded."""
+    return list(inspect(obj).attrs[attr].history.deleted)
+
+def _apply_invalidations(invalidations):
+    for kind, *key in invalidations:
+        if kind == 'member':
+            permission_cache.invalidate(*key)
+            channel_audiences.invalidate(*key)
+        elif kind == 'channel':
+            _channels.pop(*key, None)
+        else:
+            permission_cache.invalidate_server(*key)
+            channel_audiences.invalidate_server(*key)
+
+def queue_member_invalidations(session, server_id, user_ids):
+    """Invalidates memberships changed by Core statements, which the flush
+    listener below never sees, when the session's transaction ends."""
+    session.info.setdefault('permission_invalidations', set()).update(
+        ('member', user_id, server_id) for user_id in user_ids
+    )
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_permissions(session, flush_context):
+    """Drops cached permissions affected by the flushed changes.
+
+    Role permission edits and ownership changes invalidate the whole server,
+    membership and member_roles changes only the affected member. The keys
+    are invalidated again once the transaction ends, so values computed from
+    uncommitted or rolled back state never survive it.
+    """
+    from funlight.models import Server, ServerMember, Role, Channel
     
-    if not member:
-        return False
+    invalidations = session.info.setdefault('permission_invalidations', set())
     
-    # Kombiniere Berechtigungen aller Rollen des Benutzers
-    user_permissions = Permissions(0)
-    for role in member.roles:
-        user_permissions |= Permissions(role.permissions)
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, ServerMember):
+            invalidations.add(('member', obj.user_id, obj.server_id))
+            for user_id in _previous_values(obj, 'user_id') or [obj.user_id]:
+                for server_id in _previous_values(obj, 'server_id') or [obj.server_id]:
+                    invalidations.add(('member', user_id, server_id))
+        elif isinstance(obj, Role):
+            if obj in session.deleted or _changed(obj, 'permissions'):
+                invalidations.add(('server', obj.server_id))
+        elif isinstance(obj, Server):
+            if obj in session.deleted or _changed(obj, 'owner_id'):
+                invalidations.add(('server', obj.id))
+        elif isinstance(obj, Channel):
+            if obj in session.deleted or _changed(obj, 'private'):
+                invalidations.add(('channel', obj.id))
     
-    return bool(user_permissions & permission) or bool(user_permissions & Permissions.ADMINISTRATOR)
+    _apply_invalidations(invalidations)
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def _finish_invalidations(session, *args):
+    _apply_invalidations(session.info.pop('permission_invalidations', ()))
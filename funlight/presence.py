@@ -0,0 +1,251 @@
+"""Voice/video room and online presence with TTL heartbeats.
+
+Every socket in a room has to send a heartbeat at least once per
+PRESENCE_TTL seconds. Sockets that stop doing so (crashed tab, dead worker,
+disconnect without leave_voice) are swept and reported to the expiry
+callback, so the room can be notified. The status tracker keeps the online
+sockets in the same store and refreshes them itself.
+
+PRESENCE_BACKEND selects where the state lives: 'memory' keeps it in the
+worker process, 'database' keeps it in the room_presence table so it is
+shared by all workers and survives restarts.
+"""
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from funlight import db
+from funlight.models import RoomPresence
+
+logger = logging.getLogger(__name__)
+
+class MemoryPresenceStore:
+    """Presence kept in process.
+    
+    Rooms map user ids to the set of that user's sockets in the room, so a
+    user with two tabs only leaves once both are gone. Expiry times live in a
+    heap, a sweep only pops what has expired.
+    """
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._rooms = {}
+        self._sessions = {}
+        self._expires = {}
+        self._heap = []
+        self._lock = threading.Lock()
+    
+    def join(self, room, user_id, sid):
+        """Adds a socket to a room, returns True if the user was not in it yet."""
+        with self._lock:
+            users = self._rooms.setdefault(room, {})
+            is_new = user_id not in users
+            users.setdefault(user_id, set()).add(sid)
+            self._sessions.setdefault(sid, {})[room] = user_id
+            self._touch(sid)
+            return is_new
+    
+    def leave(self, room, sid):
+        """Removes a socket from a room, returns the user id if the user is gone."""
+        with self._lock:
+            return self._remove(room, sid)
+    
+    def leave_all(self, sid):
+        """Removes a socket from every room, returns (room, user_id) pairs that emptied."""
+        with self._lock:
+            self._expires.pop(sid, None)
+            return self._remove_session(sid)
+    
+    def heartbeat(self, sid):
+        with self._lock:
+            if sid in self._sessions:
+                self._touch(sid)
+    
+    def heartbeat_many(self, sids):
+        with self._lock:
+            for sid in sids:
+                if sid in self._sessions:
+                    self._touch(sid)
+    
+    def members(self, room):
+        with self._lock:
+            return list(self._rooms.get(room, ()))
+    
+    def present(self, room, user_id):
+        with self._lock:
+            return user_id in self._rooms.get(room, ())
+    
+    def sweep(self):
+        """Drops sockets whose heartbeat expired, returns (room, user_id) pairs that emptied."""
+        now = time.monotonic()
+        gone = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, sid = heapq.heappop(self._heap)
+                # Older entries were superseded by a later heartbeat
+                if self._expires.get(sid) == expires_at:
+                    del self._expires[sid]
+                    gone.extend(self._remove_session(sid))
+        return gone
+    
+    def _touch(self, sid):
+        expires_at = time.monotonic() + self.ttl
+        self._expires[sid] = expires_at
+        heapq.heappush(self._heap, (expires_at, sid))
+    
+    def _remove(self, room, sid):
+        user_id = self._sessions.get(sid, {}).pop(room, None)
+        if user_id is None:
+            return None
+        if not self._sessions[sid]:
+            del self._sessions[sid]
+            self._expires.pop(sid, None)
+        
+        users = self._rooms[room]
+        users[user_id].discard(sid)
+        if users[user_id]:
+            return None
+        del users[user_id]
+        if not users:
+            del self._rooms[room]
+        return user_id
+    
+    def _remove_session(self, sid):
+        gone = []
+        for room in list(self._sessions.get(sid, ())):
+            user_id = self._remove(room, sid)
+            if user_id is not None:
+                gone.append((room, user_id))
+        return gone
+
+class DatabasePresenceStore:
+    """Presence kept in the room_presence table, shared by all workers."""
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+    
+    def join(self, room, user_id, sid):
+        is_new = not RoomPresence.query.filter_by(room=room, user_id=user_id).first()
+        db.session.merge(RoomPresence(room=room, sid=sid, user_id=user_id, expires_at=self._expiry()))
+        db.session.commit()
+        return is_new
+    
+    def leave(self, room, sid):
+        entry = RoomPresence.query.get((room, sid))
+        gone = self._delete([entry]) if entry else []
+        return gone[0][1] if gone else None
+    
+    def leave_all(self, sid):
+        entries = RoomPresence.query.filter_by(sid=sid).all()
+        return self._delete(entries)
+    
+    def heartbeat(self, sid):
+        RoomPresence.query.filter_by(sid=sid).update({'expires_at': self._expiry()})
+        db.session.commit()
+    
+    def heartbeat_many(self, sids):
+        expires_at = self._expiry()
+        for start in range(0, len(sids), 500):
+            RoomPresence.query.filter(RoomPresence.sid.in_(sids[start:start + 500])).update(
+                {'expires_at': expires_at}, synchronize_session=False
+            )
+        db.session.commit()
+    
+    def members(self, room):
+        return [user_id for user_id, in db.session.query(RoomPresence.user_id).filter_by(room=room).distinct()]
+    
+    def present(self, room, user_id):
+        return RoomPresence.query.filter_by(room=room, user_id=user_id).first() is not None
+    
+    def sweep(self):
+        entries = RoomPresence.query.filter(RoomPresence.expires_at <= datetime.utcnow()).all()
+        return self._delete(entries)
+    
+    def _expiry(self):
+        return datetime.utcnow() + timedelta(seconds=self.ttl)
+    
+    def _delete(self, entries):
+        removed = []
+        for entry in entries:
+            # Another worker may have removed the entry in the meantime
+            if RoomPresence.query.filter_by(room=entry.room, sid=entry.sid).delete():
+                removed.append((entry.room, entry.user_id))
+        if not removed:
+            return []
+        db.session.commit()
+        
+        return [(room, user_id) for room, user_id in set(removed)
+                if self._gone_user(room, user_id) is not None]
+    
+    def _gone_user(self, room, user_id):
+        still_here = RoomPresence.query.filter_by(room=room, user_id=user_id).first()
+        return None if still_here else user_id
+
+BACKENDS = {
+    'memory': MemoryPresenceStore,
+    'database': DatabasePresenceStore
+}
+
+class Presence:
+    """Entry point used by the socket handlers, delegates to the configured store."""
+    
+    def __init__(self):
+        self.store = MemoryPresenceStore(ttl=30)
+        self.app = None
+        self._expiry_callbacks = []
+    
+    def init_app(self, app):
+        self.app = app
+        backend = app.config['PRESENCE_BACKEND']
+        if backend not in BACKENDS:
+            raise ValueError(f'PRESENCE_BACKEND must be one of {tuple(BACKENDS)}')
+        self.store = BACKENDS[backend](ttl=app.config['PRESENCE_TTL'])
+        self.sweep_interval = app.config['PRESENCE_SWEEP_INTERVAL']
+        
+        thread = threading.Thread(target=self._run, name='presence-sweeper', daemon=True)
+        thread.start()
+    
+    def on_expire(self, f):
+        """Registers f(room, user_id), called for users whose sockets all expired."""
+        self._expiry_callbacks.append(f)
+        return f
+    
+    def join(self, room, user_id, sid):
+        return self.store.join(room, user_id, sid)
+    
+    def leave(self, room, sid):
+        return self.store.leave(room, sid)
+    
+    def leave_all(self, sid):
+        return self.store.leave_all(sid)
+    
+    def heartbeat(self, sid):
+        self.store.heartbeat(sid)
+    
+    def heartbeat_many(self, sids):
+        """Refreshes several sockets at once, for sockets kept alive by the server."""
+        self.store.heartbeat_many(sids)
+    
+    def members(self, room):
+        return self.store.members(room)
+    
+    def present(self, room, user_id):
+        return self.store.present(room, user_id)
+    
+    def sweep(self):
+        for room, user_id in self.store.sweep():
+            for callback in self._expiry_callbacks:
+                callback(room, user_id)
+    
+    def _run(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                with self.app.app_context():
+                    self.sweep()
+            except Exception:
+                logger.exception('Presence sweep failed')
+
+presence = Presence()
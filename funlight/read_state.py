@@ -0,0 +1,172 @@
+"""Read state and unread badges.
+
+Every channel keeps the id of its newest message in channel.last_message_id,
+advanced in the same transaction that inserts the messages. How far a user
+has read a channel is a read_state row with the last message id they have
+seen and the mentions they got since. A channel is unread when its
+last_message_id is past the user's last read id, which compares two columns
+instead of counting messages, so all unread channels of a user come back
+from one query. Only for those the number of unread messages is counted,
+along the (channel_id, id) index and up to UNREAD_COUNT_CAP.
+
+A mention is @username of a member of the channel's server, counted into
+the read state when the message is written.
+"""
+import re
+from collections import Counter, defaultdict
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from funlight import db
+from funlight.models import Channel, Message, ReadState, ServerMember, User
+from funlight.permissions import channel_audiences
+
+# Badges show "99+" beyond this, so counting further is wasted work
+UNREAD_COUNT_CAP = 100
+
+MENTION_PATTERN = re.compile(r'@(\w+)')
+
+_UPSERT_INSERTS = {
+    'sqlite': sqlite.insert,
+    'postgresql': postgresql.insert
+}
+
+def record_messages(rows):
+    """Advances the channels' high-water marks, moves the authors' read
+    positions past their own messages and counts the mentions of new
+    message rows. Runs in the caller's transaction."""
+    heads = {}
+    authors = {}
+    for row in rows:
+        heads[row['channel_id']] = max(row['id'], heads.get(row['channel_id'], 0))
+        key = (row['user_id'], row['channel_id'])
+        authors[key] = max(row['id'], authors.get(key, 0))
+    for channel_id, message_id in heads.items():
+        Channel.query.filter(
+            Channel.id == channel_id,
+            (Channel.last_message_id.is_(None)) | (Channel.last_message_id < message_id)
+        ).update({'last_message_id': message_id}, synchronize_session=False)
+    
+    _upsert_read_states([{
+        'user_id': user_id,
+        'channel_id': channel_id,
+        'last_read_message_id': message_id,
+        'mention_count': 0
+    } for (user_id, channel_id), message_id in authors.items()], 'last_read_message_id')
+    
+    mentions = _mentions(rows)
+    if mentions:
+        _upsert_read_states([{
+            'user_id': user_id,
+            'channel_id': channel_id,
+            'last_read_message_id': None,
+            'mention_count': count
+        } for (user_id, channel_id), count in mentions.items()], 'mention_count')
+
+def _mentions(rows):
+    """Counter of (user_id, channel_id) for the mentions in message rows."""
+    names = defaultdict(list)
+    for row in rows:
+        for name in set(MENTION_PATTERN.findall(row['content'] or '')):
+            names[name].append(row)
+    if not names:
+        return None
+    
+    channel_ids = {row['channel_id'] for rows in names.values() for row in rows}
+    servers = dict(db.session.query(Channel.id, Channel.server_id).filter(Channel.id.in_(channel_ids)))
+    members = {(username, server_id): user_id for user_id, username, server_id in db.session.query(
+        User.id, User.username, ServerMember.server_id
+    ).join(ServerMember, ServerMember.user_id == User.id).filter(
+        User.username.in_(list(names)), ServerMember.server_id.in_(set(servers.values()))
+    )}
+    
+    mentions = Counter()
+    for name, mentioning in names.items():
+        for row in mentioning:
+            user_id = members.get((name, servers.get(row['channel_id'])))
+            if user_id is not None and user_id != row['user_id']:
+                mentions[(user_id, row['channel_id'])] += 1
+    return mentions
+
+def _upsert_read_states(rows, column):
+    """Inserts read states, existing ones get the row's last_read_message_id
+    or have its mention_count added, depending on column."""
+    if column == 'mention_count':
+        def updated(value):
+            return ReadState.mention_count + value
+    else:
+        def updated(value):
+            return value
+    
+    upsert_insert = _UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if upsert_insert is not None:
+        statement = upsert_insert(ReadState).values(rows)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['user_id', 'channel_id'],
+            set_={column: updated(getattr(statement.excluded, column))}
+        ))
+        return
+    
+    # Other databases: update the existing read states, create the missing ones
+    for row in rows:
+        if not ReadState.query.filter_by(user_id=row['user_id'], channel_id=row['channel_id']).update(
+            {column: updated(row[column])}, synchronize_session=False
+        ):
+            db.session.add(ReadState(**row))
+
+def mark_read(user_id, channel_id, message_id=None):
+    """Moves a user's read position forward, to the channel's newest message
+    unless message_id is given, and clears the mentions.
+    
+    Returns the last read message id, the caller commits.
+    """
+    head = db.session.query(Channel.last_message_id).filter(Channel.id == channel_id).scalar() or 0
+    message_id = head if message_id is None else min(message_id, head)
+    
+    state = db.session.get(ReadState, (user_id, channel_id))
+    if state is None:
+        state = ReadState(user_id=user_id, channel_id=channel_id)
+        db.session.add(state)
+    state.last_read_message_id = max(message_id, state.last_read_message_id or 0)
+    state.mention_count = 0
+    return state.last_read_message_id
+
+def unread_channels(user_id):
+    """The user's unread text channels as {channel_id: badge}, in one query.
+    
+    A badge has the server id, the number of unread messages (at most
+    UNREAD_COUNT_CAP) and the number of mentions.
+    """
+    last_read = func.coalesce(ReadState.last_read_message_id, 0)
+    unread = select(func.count()).select_from(
+        select(Message.id).where(
+            Message.channel_id == Channel.id, Message.id > last_read
+        ).correlate(Channel, ReadState).limit(UNREAD_COUNT_CAP).subquery()
+    ).scalar_subquery()
+    
+    rows = db.session.query(
+        Channel.id, Channel.server_id, Channel.private, unread, func.coalesce(ReadState.mention_count, 0)
+    ).join(
+        ServerMember, (ServerMember.server_id == Channel.server_id) & (ServerMember.user_id == user_id)
+    ).outerjoin(
+        ReadState, (ReadState.channel_id == Channel.id) & (ReadState.user_id == user_id)
+    ).filter(
+        Channel.type == 'text', Channel.last_message_id > last_read
+    ).all()
+    
+    return {channel_id: {
+        'server_id': server_id,
+        'count': count,
+        'mentions': mentions
+    } for channel_id, server_id, private, count, mentions in rows
+        if not private or user_id in channel_audiences.get(server_id)}
+
+def server_badges(channels):
+    """Sums the channel badges of unread_channels up per server."""
+    servers = {}
+    for badge in channels.values():
+        server = servers.setdefault(badge['server_id'], {'count': 0, 'mentions': 0})
+        server['count'] += badge['count']
+        server['mentions'] += badge['mentions']
+    return servers
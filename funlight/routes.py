@@ -1,6 +1,7 @@
 from flask import Blueprint, jsonify, request
 from flask_login import current_user, login_required
 from .models import User, FriendRequest, db
+from .friends import add_friendship, are_friends, friends_of, remove_friendship
 
 bp = Blueprint('routes', __name__)
 
@@ -8,7 +9,7 @@ bp = Blueprint('routes', __name__)
 @login_required
 def get_friends():
     """Get the current user's friends list"""
-    friends = current_user.friends
+    friends = friends_of(current_user.id)
     return jsonify({
         'friends': [{
             'id': friend.id,
@@ -35,7 +36,7 @@ def add_friend():
     if user == current_user:
         return jsonify({'error': 'You cannot add yourself as a friend'}), 400
         
-    if user in current_user.friends:
+    if are_friends(current_user.id, user.id):
         return jsonify({'error': 'User is already your friend'}), 400
         
     # Check if there's already a pending request
@@ -86,8 +87,7 @@ def handle_friend_request(request_id):
         return jsonify({'error': 'Unauthorized'}), 403
         
     if action == 'accept':
-        current_user.friends.append(friend_request.sender)
-        friend_request.sender.friends.append(current_user)
+        add_friendship(current_user.id, friend_request.sender_id)
         db.session.delete(friend_request)
         db.session.commit()
         return jsonify({'success': True, 'message': 'Friend request accepted'})
@@ -102,11 +102,9 @@ def remove_friend(friend_id):
     """Remove a friend"""
     friend = User.query.get_or_404(friend_id)
     
-    if friend not in current_user.friends:
+    if not remove_friendship(current_user.id, friend.id):
         return jsonify({'error': 'User is not your friend'}), 400
         
-    current_user.friends.remove(friend)
-    friend.friends.remove(current_user)
     db.session.commit()
     
     return jsonify({'success': True, 'message': 'Friend removed'})
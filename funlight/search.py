@@ -0,0 +1,106 @@
+"""Full-text message search.
+
+On SQLite, message_fts is an external-content FTS5 index over
+message.content. Triggers keep it in sync with every insert, edit and
+delete, in the same transaction as the write itself. The write-behind
+batches and the synchronous send path therefore update the index without
+an extra commit. On other databases, search falls back to a LIKE scan.
+"""
+import logging
+
+from sqlalchemy import column, table, text
+
+from funlight import db
+from funlight.models import Message, Channel
+
+logger = logging.getLogger(__name__)
+
+# Results per search page, clients may ask for up to MAX_SEARCH_PAGE_SIZE
+SEARCH_PAGE_SIZE = 25
+MAX_SEARCH_PAGE_SIZE = 50
+
+# Lightweight handle on the virtual table, it is not part of the model metadata
+# so create_all never tries to create it as a regular table
+message_fts = table('message_fts', column('rowid'), column('content'))
+
+fts_enabled = False
+
+FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+        content, content='message', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN
+        INSERT INTO message_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN
+        INSERT INTO message_fts(message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content ON message BEGIN
+        INSERT INTO message_fts(message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO message_fts(rowid, content) VALUES (new.id, new.content);
+    END"""
+]
+
+def init_search_index(conn):
+    """Creates the FTS index and its triggers, backfilling existing messages once."""
+    global fts_enabled
+    if conn.dialect.name != 'sqlite':
+        return
+    
+    exists = conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_fts'"
+    )).first()
+    try:
+        for statement in FTS_SCHEMA:
+            conn.execute(text(statement))
+    except Exception:
+        logger.exception('SQLite was built without FTS5, message search falls back to LIKE')
+        return
+    
+    if not exists:
+        conn.execute(text("INSERT INTO message_fts(message_fts) VALUES ('rebuild')"))
+    fts_enabled = True
+
+def to_match_expression(query):
+    """Turns user input into an FTS5 query that matches all terms.
+    
+    Every term is quoted, so operators and punctuation typed by the user
+    are searched for literally instead of breaking the MATCH syntax.
+    """
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    return ' '.join(terms)
+
+def escape_like(term):
+    """Escapes LIKE wildcards, so % and _ typed by the user match literally."""
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_messages(server_id, query, channel_id=None, author_id=None,
+                    after=None, before=None, include_private=True, limit=25, offset=0):
+    """Messages of a server matching query, best match first."""
+    filters = [Channel.server_id == server_id]
+    if not include_private:
+        filters.append(Channel.private.isnot(True))
+    if channel_id is not None:
+        filters.append(Message.channel_id == channel_id)
+    if author_id is not None:
+        filters.append(Message.user_id == author_id)
+    if after is not None:
+        filters.append(Message.created_at >= after)
+    if before is not None:
+        filters.append(Message.created_at < before)
+    
+    base = Message.query.join(Channel, Channel.id == Message.channel_id).options(
+        db.joinedload(Message.author),
+        db.selectinload(Message.attachments)
+    ).filter(*filters)
+    
+    if fts_enabled:
+        return base.join(
+            message_fts, message_fts.c.rowid == Message.id
+        ).filter(
+            text('message_fts MATCH :match').bindparams(match=to_match_expression(query))
+        ).order_by(text('bm25(message_fts)'), Message.id.desc()).limit(limit).offset(offset).all()
+    
+    for term in query.split():
+        base = base.filter(Message.content.ilike(f'%{escape_like(term)}%', escape='\\'))
+    return base.order_by(Message.id.desc()).limit(limit).offset(offset).all()
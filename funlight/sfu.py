@@ -0,0 +1,95 @@
+"""Optional SFU mode for large voice channels.
+
+In a mesh, every participant sends its audio to every other one, so upstream
+bandwidth per client grows with the channel size. Once a voice channel
+reaches VOICE_SFU_THRESHOLD participants, it switches to SFU mode: every
+client connects to the server only, sends one upstream and receives the
+others' audio from the server (see funlight/sfu_media.py). A channel stays
+in SFU mode until it is empty.
+
+Needs aiortc and the threading async mode, the media runs on an asyncio
+loop in its own thread. Rooms live in the worker's memory, like the
+'memory' presence backend.
+"""
+import asyncio
+import logging
+import threading
+from importlib.util import find_spec
+
+from funlight import socketio
+
+logger = logging.getLogger(__name__)
+
+# Seconds a socket handler waits for the media loop
+SFU_CALL_TIMEOUT = 15
+
+class VoiceSfu:
+    """Bridges the socket handlers to the rooms on the media loop."""
+    
+    def __init__(self):
+        self.enabled = False
+        self.threshold = 0
+        self._rooms = {}
+        self._loop = None
+    
+    def init_app(self, app):
+        self.threshold = app.config['VOICE_SFU_THRESHOLD']
+        self.enabled = self.threshold > 0
+        if self.enabled and find_spec('aiortc') is None:
+            logger.warning('aiortc is not installed, voice channels stay peer-to-peer')
+            self.enabled = False
+        if self.enabled and app.config['SOCKETIO_ASYNC_MODE'] != 'threading':
+            logger.warning('The voice SFU needs SOCKETIO_ASYNC_MODE=threading, voice channels stay peer-to-peer')
+            self.enabled = False
+        if self.enabled:
+            self._loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=self._loop.run_forever, name='sfu-media', daemon=True)
+            thread.start()
+    
+    def is_active(self, channel_id):
+        return channel_id in self._rooms
+    
+    def activate(self, channel_id, participants):
+        """Switches a channel to SFU mode once it is big enough, True if it just switched."""
+        if not self.enabled or channel_id in self._rooms or participants < self.threshold:
+            return False
+        from funlight.sfu_media import SfuRoom
+        self._rooms[channel_id] = SfuRoom(channel_id, self._send)
+        return True
+    
+    def join(self, channel_id, user_id, sid, offer):
+        """Connects a socket to the channel's SFU, the answer is sent as sfu_answer."""
+        room = self._rooms.get(channel_id)
+        if room is None:
+            return False
+        self._call(room.join(sid, user_id, offer))
+        return True
+    
+    def answer(self, channel_id, sid, answer):
+        room = self._rooms.get(channel_id)
+        if room is not None:
+            self._loop.call_soon_threadsafe(room.set_answer, sid, answer)
+    
+    def leave(self, channel_id, sid):
+        room = self._rooms.get(channel_id)
+        if room is not None:
+            self._call(room.leave(sid))
+    
+    def leave_all(self, sid):
+        for room in list(self._rooms.values()):
+            if sid in room.peers:
+                self._call(room.leave(sid))
+    
+    def deactivate(self, channel_id):
+        """Closes the SFU of a channel that became empty."""
+        room = self._rooms.pop(channel_id, None)
+        if room is not None:
+            self._call(room.close())
+    
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(SFU_CALL_TIMEOUT)
+    
+    def _send(self, sid, event, data):
+        socketio.emit(event, data, room=sid)
+
+voice_sfu = VoiceSfu()
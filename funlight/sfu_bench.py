@@ -0,0 +1,181 @@
+"""Loopback benchmark of a voice channel as mesh and as SFU.
+
+    python -m funlight.sfu_bench --participants 8 --seconds 10
+
+N synthetic participants, each sending a generated tone, connect over
+loopback, either with each other (mesh) or with an in-process SfuRoom.
+For each mode it reports the CPU used by the whole process (clients and
+server), the average upstream and downstream per participant, and for the
+SFU its egress. Needs aiortc.
+"""
+import argparse
+import array
+import asyncio
+import fractions
+import math
+import time
+
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.mediastreams import AudioStreamTrack, MediaStreamError
+from av import AudioFrame
+
+from funlight.sfu_media import SfuRoom
+
+SAMPLE_RATE = 48000
+FRAME_SAMPLES = 960
+
+class ToneTrack(AudioStreamTrack):
+    """A sine tone in real time, 20 ms per frame.
+    
+    The frequency is a multiple of 50 Hz, so every frame holds whole periods
+    and the same samples can be sent each time.
+    """
+    
+    def __init__(self, index):
+        super().__init__()
+        frequency = 200 + index * 50
+        self.samples = array.array('h', (
+            int(math.sin(2 * math.pi * frequency * n / SAMPLE_RATE) * 8000) for n in range(FRAME_SAMPLES)
+        )).tobytes()
+        self._pts = 0
+        self._start = None
+    
+    async def recv(self):
+        if self.readyState != 'live':
+            raise MediaStreamError
+        if self._start is None:
+            self._start = time.time()
+        else:
+            await asyncio.sleep(self._start + self._pts / SAMPLE_RATE - time.time())
+        
+        frame = AudioFrame(format='s16', layout='mono', samples=FRAME_SAMPLES)
+        frame.planes[0].update(self.samples)
+        frame.pts = self._pts
+        frame.sample_rate = SAMPLE_RATE
+        frame.time_base = fractions.Fraction(1, SAMPLE_RATE)
+        self._pts += FRAME_SAMPLES
+        return frame
+
+def _drain(track):
+    async def run():
+        try:
+            while True:
+                await track.recv()
+        except MediaStreamError:
+            pass
+    asyncio.ensure_future(run())
+
+async def _bytes(pcs):
+    sent = received = 0
+    for pc in pcs:
+        # Transport bytes, as on the wire: RTP and RTCP including SRTP overhead
+        for report in (await pc.getStats()).values():
+            if report.type == 'transport':
+                sent += report.bytesSent
+                received += report.bytesReceived
+    return sent, received
+
+async def _negotiate(offerer, answerer):
+    await offerer.setLocalDescription(await offerer.createOffer())
+    await answerer.setRemoteDescription(offerer.localDescription)
+    await answerer.setLocalDescription(await answerer.createAnswer())
+    await offerer.setRemoteDescription(answerer.localDescription)
+
+async def run_mesh(participants):
+    """Every pair of participants has its own connection and encoder."""
+    pcs = {index: [] for index in range(participants)}
+    for a in range(participants):
+        for b in range(a + 1, participants):
+            pc_a, pc_b = RTCPeerConnection(), RTCPeerConnection()
+            pc_a.addTrack(ToneTrack(a))
+            pc_b.addTrack(ToneTrack(b))
+            pc_a.on('track', _drain)
+            pc_b.on('track', _drain)
+            await _negotiate(pc_a, pc_b)
+            pcs[a].append(pc_a)
+            pcs[b].append(pc_b)
+    return pcs, []
+
+class SfuClient:
+    """A participant that connects to an SfuRoom the way the browser does."""
+    
+    def __init__(self, index, room):
+        self.sid = f'bench-{index}'
+        self.index = index
+        self.room = room
+        self.pc = RTCPeerConnection()
+        self.pc.addTrack(ToneTrack(index))
+        self.pc.on('track', _drain)
+        # Signaling is handled in order, like the client's promise chain
+        self.signals = asyncio.Queue()
+        asyncio.ensure_future(self._handle_signals())
+    
+    async def join(self):
+        await self.pc.setLocalDescription(await self.pc.createOffer())
+        await self.room.join(self.sid, self.index, {
+            'sdp': self.pc.localDescription.sdp,
+            'type': self.pc.localDescription.type
+        })
+    
+    async def _handle_signals(self):
+        while True:
+            event, data = await self.signals.get()
+            if event == 'sfu_answer':
+                await self.pc.setRemoteDescription(RTCSessionDescription(sdp=data['sdp'], type=data['type']))
+            elif event == 'sfu_offer':
+                await self.pc.setRemoteDescription(RTCSessionDescription(sdp=data['sdp'], type=data['type']))
+                await self.pc.setLocalDescription(await self.pc.createAnswer())
+                self.room.set_answer(self.sid, {
+                    'sdp': self.pc.localDescription.sdp,
+                    'type': self.pc.localDescription.type
+                })
+
+async def run_sfu(participants):
+    clients = {}
+    room = SfuRoom('bench', lambda sid, event, data: clients[sid].signals.put_nowait((event, data)))
+    for index in range(participants):
+        client = SfuClient(index, room)
+        clients[client.sid] = client
+        await client.join()
+    return {client.index: [client.pc] for client in clients.values()}, [peer.pc for peer in room.peers.values()]
+
+async def measure(mode, participants, seconds, warmup):
+    pcs, server_pcs = await (run_mesh if mode == 'mesh' else run_sfu)(participants)
+    await asyncio.sleep(warmup)
+    
+    client_pcs = [pc for index in pcs for pc in pcs[index]]
+    sent_before, received_before = await _bytes(client_pcs)
+    egress_before, _ = await _bytes(server_pcs)
+    cpu_before, started = time.process_time(), time.monotonic()
+    await asyncio.sleep(seconds)
+    elapsed = time.monotonic() - started
+    cpu = (time.process_time() - cpu_before) / elapsed
+    sent, received = await _bytes(client_pcs)
+    egress, _ = await _bytes(server_pcs)
+    
+    def kbps(octets):
+        return octets * 8 / elapsed / 1000
+    
+    print(f'{mode}: {participants} participants, {len(client_pcs)} client connections')
+    print(f'  CPU (process):           {cpu * 100:.0f}% of a core')
+    print(f'  upstream/participant:    {kbps(sent - sent_before) / participants:.1f} kbit/s')
+    print(f'  downstream/participant:  {kbps(received - received_before) / participants:.1f} kbit/s')
+    if server_pcs:
+        print(f'  SFU egress:              {kbps(egress - egress_before):.1f} kbit/s')
+    
+    for pc in client_pcs + server_pcs:
+        await pc.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--participants', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--mode', choices=('mesh', 'sfu', 'both'), default='both')
+    args = parser.parse_args()
+    
+    for mode in (('mesh', 'sfu') if args.mode == 'both' else (args.mode,)):
+        asyncio.run(measure(mode, args.participants, args.seconds, args.warmup))
+
+if __name__ == '__main__':
+    main()
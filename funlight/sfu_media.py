@@ -0,0 +1,242 @@
+"""Media side of the voice SFU, built on aiortc.
+
+Every participant has one RTCPeerConnection with the server and sends its
+microphone once. An AudioFanout decodes that track and encodes it to Opus
+once, however many listeners there are, and hands the packets to one
+ListenerSlot per listener. A slot is an outgoing track on the listener's
+connection. When a speaker leaves, the slot is kept and later reused for
+the next speaker, so the SDP does not grow with every join.
+
+Everything here runs on one asyncio event loop. Signaling messages go out
+through the send(sid, event, data) callable of the room.
+"""
+import asyncio
+import fractions
+import logging
+
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.codecs.opus import OpusEncoder
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+from av.packet import Packet
+
+logger = logging.getLogger(__name__)
+
+OPUS_TIME_BASE = fractions.Fraction(1, 48000)
+# 20 ms at 48 kHz, the frame size of OpusEncoder
+OPUS_FRAME_SAMPLES = 960
+
+# Packets a slow listener may lag behind before old audio is dropped (200 ms)
+SLOT_QUEUE_SIZE = 10
+
+NEGOTIATION_TIMEOUT = 10
+
+class ListenerSlot(MediaStreamTrack):
+    """Outgoing audio track of a listener, fed by whichever speaker is attached."""
+    
+    kind = 'audio'
+    
+    def __init__(self):
+        super().__init__()
+        self.fanout = None
+        self._queue = asyncio.Queue(maxsize=SLOT_QUEUE_SIZE)
+        self._next_pts = 0
+        self._offset = None
+    
+    def attach(self, fanout):
+        self.fanout = fanout
+        # Speakers have their own timestamps, continue ours instead of jumping
+        self._offset = None
+        fanout.listeners.add(self)
+    
+    def detach(self):
+        if self.fanout is not None:
+            self.fanout.listeners.discard(self)
+            self.fanout = None
+        while not self._queue.empty():
+            self._queue.get_nowait()
+    
+    def push(self, payload, pts):
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait((payload, pts))
+    
+    async def recv(self):
+        if self.readyState != 'live':
+            raise MediaStreamError
+        payload, pts = await self._queue.get()
+        if self._offset is None:
+            self._offset = self._next_pts - pts
+        packet = Packet(payload)
+        packet.pts = pts + self._offset
+        packet.time_base = OPUS_TIME_BASE
+        self._next_pts = packet.pts + OPUS_FRAME_SAMPLES
+        return packet
+
+class AudioFanout:
+    """Decodes one speaker's track and encodes it once for all listeners."""
+    
+    def __init__(self, user_id, track):
+        self.user_id = user_id
+        self.track = track
+        self.listeners = set()
+        self.encoder = OpusEncoder()
+        self.task = asyncio.ensure_future(self._run())
+    
+    async def _run(self):
+        try:
+            while True:
+                frame = await self.track.recv()
+                if not self.listeners:
+                    continue
+                payloads, timestamp = self.encoder.encode(frame)
+                for index, payload in enumerate(payloads):
+                    pts = timestamp + index * OPUS_FRAME_SAMPLES
+                    for listener in list(self.listeners):
+                        listener.push(payload, pts)
+        except MediaStreamError:
+            pass
+    
+    def stop(self):
+        self.task.cancel()
+        for listener in list(self.listeners):
+            listener.detach()
+
+class SfuPeer:
+    def __init__(self, sid, user_id):
+        self.sid = sid
+        self.user_id = user_id
+        self.pc = RTCPeerConnection()
+        self.fanout = None
+        self.slots = []
+        self.answer = None
+        self.negotiating = False
+        self.renegotiate = False
+    
+    def free_slot(self):
+        return next((slot for slot in self.slots if slot.fanout is None), None)
+    
+    def tracks(self):
+        """Which user each receiving mid of the client carries."""
+        return {
+            transceiver.mid: transceiver.sender.track.fanout.user_id
+            for transceiver in self.pc.getTransceivers()
+            if isinstance(transceiver.sender.track, ListenerSlot)
+            and transceiver.sender.track.fanout is not None and transceiver.mid is not None
+        }
+
+class SfuRoom:
+    """The participants of one voice channel in SFU mode."""
+    
+    def __init__(self, channel_id, send):
+        self.channel_id = channel_id
+        self.send = send
+        self.peers = {}
+    
+    async def join(self, sid, user_id, offer):
+        """Answers a participant's offer, then forwards the other speakers to it."""
+        if sid in self.peers:
+            await self.leave(sid)
+        peer = SfuPeer(sid, user_id)
+        self.peers[sid] = peer
+        
+        @peer.pc.on('track')
+        def on_track(track):
+            if track.kind != 'audio' or peer.fanout is not None:
+                return
+            peer.fanout = AudioFanout(user_id, track)
+            for listener in list(self.peers.values()):
+                if listener is not peer:
+                    self._forward(peer, listener)
+        
+        @peer.pc.on('connectionstatechange')
+        async def on_state_change():
+            if peer.pc.connectionState == 'failed' and self.peers.get(sid) is peer:
+                await self.leave(sid)
+        
+        await peer.pc.setRemoteDescription(RTCSessionDescription(sdp=offer['sdp'], type=offer['type']))
+        await peer.pc.setLocalDescription(await peer.pc.createAnswer())
+        self.send(sid, 'sfu_answer', {
+            'channelId': self.channel_id,
+            'sdp': peer.pc.localDescription.sdp,
+            'type': peer.pc.localDescription.type
+        })
+        
+        for speaker in list(self.peers.values()):
+            if speaker is not peer and speaker.fanout is not None:
+                self._forward(speaker, peer)
+    
+    def set_answer(self, sid, answer):
+        """The client's answer to the last offer the server sent it."""
+        peer = self.peers.get(sid)
+        if peer and peer.answer and not peer.answer.done():
+            peer.answer.set_result(answer)
+    
+    async def leave(self, sid):
+        peer = self.peers.pop(sid, None)
+        if peer is None:
+            return
+        if peer.fanout is not None:
+            peer.fanout.stop()
+        for slot in peer.slots:
+            slot.detach()
+        if peer.answer and not peer.answer.done():
+            peer.answer.cancel()
+        await peer.pc.close()
+        
+        # Freed slots stay on the listeners' connections for the next speaker
+        for listener in self.peers.values():
+            self.send(listener.sid, 'sfu_tracks', {
+                'channelId': self.channel_id,
+                'tracks': listener.tracks()
+            })
+    
+    async def close(self):
+        for sid in list(self.peers):
+            await self.leave(sid)
+    
+    def _forward(self, speaker, listener):
+        slot = listener.free_slot()
+        if slot is not None:
+            slot.attach(speaker.fanout)
+            if not listener.negotiating:
+                self.send(listener.sid, 'sfu_tracks', {
+                    'channelId': self.channel_id,
+                    'tracks': listener.tracks()
+                })
+                return
+        else:
+            slot = ListenerSlot()
+            slot.attach(speaker.fanout)
+            listener.slots.append(slot)
+            listener.pc.addTrack(slot)
+        
+        if listener.negotiating:
+            listener.renegotiate = True
+        else:
+            listener.negotiating = True
+            asyncio.ensure_future(self._negotiate(listener))
+    
+    async def _negotiate(self, peer):
+        """Offers the peer's new slots, one offer/answer round at a time."""
+        try:
+            while True:
+                peer.renegotiate = False
+                await peer.pc.setLocalDescription(await peer.pc.createOffer())
+                peer.answer = asyncio.get_running_loop().create_future()
+                self.send(peer.sid, 'sfu_offer', {
+                    'channelId': self.channel_id,
+                    'sdp': peer.pc.localDescription.sdp,
+                    'type': peer.pc.localDescription.type,
+                    'tracks': peer.tracks()
+                })
+                answer = await asyncio.wait_for(peer.answer, NEGOTIATION_TIMEOUT)
+                await peer.pc.setRemoteDescription(RTCSessionDescription(sdp=answer['sdp'], type=answer['type']))
+                if not peer.renegotiate:
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception('SFU negotiation with %s failed', peer.sid)
+            await self.leave(peer.sid)
+        finally:
+            peer.negotiating = False
@@ -0,0 +1,201 @@
+"""WebRTC signaling relay.
+
+Offers, answers and ICE candidates travel between the two sockets of a
+call instead of to whatever room the client names. A call starts when a
+user sends call_user with another user's id: the offer goes to every socket
+of the callee in one frame, the first socket to answer takes the call and
+the others are told it ended. The caller's candidates are held back until
+then, and so are candidates a ringing socket of the callee sends ahead of
+its answer.
+
+Candidates are coalesced per target socket and delivered every
+SIGNALING_BATCH_INTERVAL seconds as one ice_candidates frame. Signaling for
+a call that ended, or never existed, is dropped.
+
+The sid index and the calls live in the worker's memory, like the 'memory'
+presence backend, so both ends of a call must be served by the same worker.
+"""
+import threading
+
+from funlight import socketio
+
+class Call:
+    """One call between two users, and the socket each of them uses for it."""
+    
+    __slots__ = ('caller_id', 'caller_sid', 'callee_id', 'callee_sid', 'held', 'held_by_callee')
+    
+    def __init__(self, caller_id, caller_sid, callee_id):
+        self.caller_id = caller_id
+        self.caller_sid = caller_sid
+        self.callee_id = callee_id
+        # Set once a socket of the callee answers
+        self.callee_sid = None
+        # Candidates waiting for the answer, the callee's by ringing socket
+        self.held = []
+        self.held_by_callee = {}
+    
+    def peer_sid(self, sid):
+        return self.callee_sid if sid == self.caller_sid else self.caller_sid
+
+def _call_key(user_id, other_id):
+    return (user_id, other_id) if user_id < other_id else (other_id, user_id)
+
+class SignalingRelay:
+    """Per-worker sid index, calls and pending candidate batches."""
+    
+    def __init__(self):
+        self.batch_interval = 0.01
+        self._sids = {}
+        self._calls = {}
+        self._batches = {}
+        self._flush_scheduled = False
+        self._lock = threading.Lock()
+    
+    def init_app(self, app):
+        self.batch_interval = app.config['SIGNALING_BATCH_INTERVAL']
+    
+    def connect(self, user_id, sid):
+        with self._lock:
+            self._sids.setdefault(user_id, set()).add(sid)
+    
+    def disconnect(self, user_id, sid):
+        """Forgets a socket and ends the calls it was part of."""
+        with self._lock:
+            sids = self._sids.get(user_id)
+            if sids:
+                sids.discard(sid)
+                if not sids:
+                    del self._sids[user_id]
+            # A ringing call ends with the callee's last socket
+            calls = [call for call in self._calls.values()
+                     if sid in (call.caller_sid, call.callee_sid)
+                     or (call.callee_sid is None and call.callee_id == user_id and user_id not in self._sids)]
+        for call in calls:
+            peer_id = call.callee_id if call.caller_id == user_id else call.caller_id
+            self.end_call(user_id, sid, peer_id)
+    
+    def sids(self, user_id):
+        with self._lock:
+            return list(self._sids.get(user_id, ()))
+    
+    def start_call(self, caller_id, sid, callee_id, offer):
+        """Rings every socket of the callee, False if the callee is not connected."""
+        callee_sids = self.sids(callee_id)
+        if not callee_sids or callee_id == caller_id:
+            return False
+        
+        key = _call_key(caller_id, callee_id)
+        with self._lock:
+            replaced = self._calls.get(key)
+            self._calls[key] = Call(caller_id, sid, callee_id)
+        if replaced is not None:
+            self._drop_batches(replaced)
+        
+        socketio.emit('call_user', {
+            'offer': offer,
+            'from': caller_id
+        }, room=callee_sids)
+        return True
+    
+    def accept_call(self, callee_id, sid, caller_id, answer):
+        """Binds the call to the answering socket, False if there is no such call."""
+        with self._lock:
+            call = self._calls.get(_call_key(callee_id, caller_id))
+            if call is None or call.callee_id != callee_id or call.callee_sid is not None:
+                return False
+            call.callee_sid = sid
+            held, call.held = call.held, []
+            answered = call.held_by_callee.pop(sid, [])
+            call.held_by_callee.clear()
+            others = [other for other in self._sids.get(callee_id, ()) if other != sid]
+        
+        socketio.emit('call_accepted', {
+            'answer': answer,
+            'from': callee_id
+        }, room=call.caller_sid)
+        if held:
+            self._queue(sid, caller_id, held)
+        if answered:
+            self._queue(call.caller_sid, callee_id, answered)
+        if others:
+            # The call was answered in another tab
+            socketio.emit('call_ended', {'from': caller_id}, room=others)
+        return True
+    
+    def relay_candidates(self, user_id, sid, peer_id, candidates):
+        """Queues candidates for the peer's socket, False if they were dropped."""
+        with self._lock:
+            call = self._calls.get(_call_key(user_id, peer_id))
+            if call is None:
+                return False
+            if call.callee_sid is None:
+                if sid == call.caller_sid:
+                    call.held.extend(candidates)
+                elif user_id == call.callee_id:
+                    call.held_by_callee.setdefault(sid, []).extend(candidates)
+                else:
+                    return False
+                return True
+            if sid not in (call.caller_sid, call.callee_sid):
+                return False
+            target = call.peer_sid(sid)
+        self._queue(target, user_id, candidates)
+        return True
+    
+    def end_call(self, user_id, sid, peer_id):
+        """Ends a call and tells the other side, False if there was no such call."""
+        key = _call_key(user_id, peer_id)
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                return False
+            if user_id == call.caller_id:
+                if sid != call.caller_sid:
+                    return False
+                # While it is ringing, every socket of the callee has the call
+                targets = [call.callee_sid] if call.callee_sid else list(self._sids.get(call.callee_id, ()))
+            else:
+                # Any ringing socket may decline
+                if call.callee_sid not in (None, sid):
+                    return False
+                targets = [call.caller_sid]
+            del self._calls[key]
+        self._drop_batches(call)
+        
+        if targets:
+            socketio.emit('call_ended', {'from': user_id}, room=targets)
+        return True
+    
+    def flush(self):
+        """Sends every pending candidate batch."""
+        with self._lock:
+            batches, self._batches = self._batches, {}
+            self._flush_scheduled = False
+        for (sid, from_id), candidates in batches.items():
+            socketio.emit('ice_candidates', {
+                'from': from_id,
+                'candidates': candidates
+            }, room=sid)
+    
+    def _queue(self, sid, from_id, candidates):
+        if self.batch_interval <= 0:
+            socketio.emit('ice_candidates', {'from': from_id, 'candidates': candidates}, room=sid)
+            return
+        with self._lock:
+            self._batches.setdefault((sid, from_id), []).extend(candidates)
+            schedule = not self._flush_scheduled
+            self._flush_scheduled = True
+        if schedule:
+            socketio.start_background_task(self._flush_later)
+    
+    def _flush_later(self):
+        socketio.sleep(self.batch_interval)
+        self.flush()
+    
+    def _drop_batches(self, call):
+        with self._lock:
+            self._batches.pop((call.caller_sid, call.callee_id), None)
+            if call.callee_sid is not None:
+                self._batches.pop((call.callee_sid, call.caller_id), None)
+
+signaling = SignalingRelay()
@@ -0,0 +1,139 @@
+"""In-process benchmark of call setup through the signaling relay.
+
+    python -m funlight.signaling_bench --calls 50 --candidates 10 --interval 0.01
+
+Runs the app on a temporary SQLite database with two users connected
+through the Socket.IO test client. Each call is call_user, the callee's
+answer and --candidates ICE candidates per side, trickled in two bursts
+like host candidates followed by server reflexive ones after STUN. A call
+is set up once both sides received all candidates of the other.
+
+--client single sends one ice_candidate per candidate, as clients without
+batching do; batched sends each burst as one ice_candidates. It reports the
+messages clients sent and the frames they received per call, the setup time
+percentiles and the CPU used per call by the whole process.
+"""
+import argparse
+import math
+import os
+import tempfile
+import time
+
+PASSWORD = 'bench-password'
+# Delay between the two candidate bursts of a side
+BURST_GAP = 0.005
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def candidate_count(frames):
+    count = 0
+    for frame in frames:
+        if frame['name'] == 'ice_candidates':
+            count += len(frame['args'][0]['candidates'])
+        elif frame['name'] == 'ice_candidate':
+            count += 1
+    return count
+
+class Side:
+    """One user's socket, with what it sent and received during a call."""
+    
+    def __init__(self, app, socketio, username, batched):
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': PASSWORD})
+        self.socket = socketio.test_client(app, flask_test_client=client)
+        self.socket.get_received()
+        self.batched = batched
+        self.sent = 0
+        self.received = 0
+        self.frames = []
+    
+    def emit(self, event, data):
+        self.socket.emit(event, data)
+        self.sent += 1
+    
+    def send_candidates(self, to, candidates):
+        if self.batched:
+            self.emit('ice_candidates', {'to': to, 'candidates': candidates})
+        else:
+            for candidate in candidates:
+                self.emit('ice_candidate', {'to': to, 'candidate': candidate})
+    
+    def start_call(self):
+        self.frames = []
+    
+    def receive(self):
+        frames = self.socket.get_received()
+        self.received += len(frames)
+        self.frames += frames
+        return candidate_count(self.frames)
+
+def run_call(caller, callee, caller_id, callee_id, candidates):
+    half = candidates // 2
+    caller.start_call()
+    callee.start_call()
+    started = time.perf_counter()
+    caller.emit('call_user', {'to': callee_id, 'offer': 'offer'})
+    caller.send_candidates(callee_id, [f'caller-{i}' for i in range(half)])
+    callee.emit('call_accepted', {'to': caller_id, 'answer': 'answer'})
+    callee.send_candidates(caller_id, [f'callee-{i}' for i in range(half)])
+    time.sleep(BURST_GAP)
+    caller.send_candidates(callee_id, [f'caller-{i}' for i in range(half, candidates)])
+    callee.send_candidates(caller_id, [f'callee-{i}' for i in range(half, candidates)])
+    
+    while caller.receive() < candidates or callee.receive() < candidates:
+        time.sleep(0.001)
+    setup = time.perf_counter() - started
+    
+    caller.emit('end_call', {'to': callee_id})
+    callee.socket.get_received()
+    return setup
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--calls', type=int, default=50)
+    parser.add_argument('--candidates', type=int, default=10)
+    parser.add_argument('--interval', type=float, default=0.01, help='SIGNALING_BATCH_INTERVAL')
+    parser.add_argument('--client', choices=('single', 'batched'), default='batched')
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+        os.environ['SIGNALING_BATCH_INTERVAL'] = str(args.interval)
+        os.environ['VARIANT_WORKERS'] = '0'
+        
+        from funlight import create_app, db, socketio
+        from funlight.models import User
+        
+        app = create_app()
+        ids = {}
+        with app.app_context():
+            for username in ('caller', 'callee'):
+                user = User(username=username, email=f'{username}@example.com')
+                user.set_password(PASSWORD)
+                db.session.add(user)
+                db.session.commit()
+                ids[username] = user.id
+        
+        batched = args.client == 'batched'
+        caller = Side(app, socketio, 'caller', batched)
+        callee = Side(app, socketio, 'callee', batched)
+        
+        setups = []
+        cpu_before = time.process_time()
+        for _ in range(args.calls):
+            setups.append(run_call(caller, callee, ids['caller'], ids['callee'], args.candidates))
+        cpu = time.process_time() - cpu_before
+        
+        sent = caller.sent + callee.sent
+        frames = caller.received + callee.received
+        print(f'interval={args.interval} client={args.client}: {args.calls} calls, '
+              f'{args.candidates} candidates per side')
+        print(f'  messages sent/call:      {sent / args.calls:.1f}')
+        print(f'  frames received/call:    {frames / args.calls:.1f}')
+        print(f'  setup p50/p90:           {percentile(setups, 50) * 1000:.1f}/{percentile(setups, 90) * 1000:.1f} ms')
+        print(f'  CPU/call:                {cpu / args.calls * 1000:.2f} ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Cached per-server snapshots for rendering the server page.
+
+A snapshot is made of independent parts (server info, categories with their
+channels, channels without a category). The session
+listeners below drop only the parts touched by a committed change and bump
+the server's version, and the next read rebuilds just the missing parts. The listeners only see writes of
+their own process, so with several workers every part also expires after
+the cache's ttl.
+"""
+import threading
+import time
+
+from sqlalchemy import event, or_, select
+from sqlalchemy.orm import Session
+
+from funlight.models import Server, Category, Channel
+from funlight.variants import variant_worker
+
+def _build_server(server_id):
+    server = Server.query.get(server_id)
+    if not server:
+        return None
+    return {
+        'id': server.id,
+        'name': server.name,
+        'description': server.description,
+        'icon': server.icon,
+        'icon_variants': variant_worker.urls(server.icon, 'icon'),
+        'owner_id': server.owner_id
+    }
+
+def _channel_summary(channel):
+    return {
+        'id': channel.id,
+        'name': channel.name,
+        'type': channel.type,
+        'topic': channel.topic,
+        'position': channel.position,
+        'private': bool(channel.private)
+    }
+
+def _build_categories(server_id):
+    categories = Category.query.filter_by(server_id=server_id).order_by(Category.position, Category.id).all()
+    channels = Channel.query.filter_by(server_id=server_id).order_by(Channel.position, Channel.id).all()
+    
+    by_category = {category.id: [] for category in categories}
+    for channel in channels:
+        if channel.category_id in by_category:
+            by_category[channel.category_id].append(_channel_summary(channel))
+    
+    return [{
+        'id': category.id,
+        'name': category.name,
+        'position': category.position,
+        'channels': by_category[category.id]
+    } for category in categories]
+
+def _build_uncategorized(server_id):
+    """Channels outside the server's categories, migrated databases allow a NULL category_id."""
+    category_ids = select(Category.id).where(Category.server_id == server_id)
+    return [_channel_summary(channel) for channel in Channel.query.filter(
+        Channel.server_id == server_id,
+        or_(Channel.category_id.is_(None), Channel.category_id.notin_(category_ids))
+    ).order_by(Channel.position, Channel.id)]
+
+PARTS = {
+    'server': _build_server,
+    'categories': _build_categories,
+    'uncategorized': _build_uncategorized
+}
+
+class ServerSnapshotCache:
+    """Snapshots keyed by server id, plus a version per server that is bumped on every change.
+    
+    Parts are rebuilt ttl seconds after they were built if ttl is set.
+    """
+    
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._snapshots = {}
+        self._expires = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+    
+    def get(self, server_id):
+        """The server's snapshot, or None if the server does not exist."""
+        now = time.monotonic()
+        with self._lock:
+            snapshot = dict(self._snapshots.get(server_id, {}))
+            expires = dict(self._expires.get(server_id, {}))
+            version = self._versions.get(server_id, 0)
+        
+        missing = [part for part in PARTS if part not in snapshot or expires.get(part, now + 1) <= now]
+        if not missing:
+            return snapshot
+        
+        for part in missing:
+            snapshot[part] = PARTS[part](server_id)
+            if part == 'server' and snapshot[part] is None:
+                return None
+            if self.ttl:
+                expires[part] = now + self.ttl
+        snapshot['version'] = version
+        
+        with self._lock:
+            # Only store it if nothing was invalidated while building
+            if self._versions.get(server_id, 0) == version:
+                self._snapshots[server_id] = snapshot
+                self._expires[server_id] = expires
+        return snapshot
+    
+    def invalidate(self, server_id, *parts):
+        with self._lock:
+            self._versions[server_id] = self._versions.get(server_id, 0) + 1
+            snapshot = self._snapshots.get(server_id)
+            if snapshot is None:
+                return
+            if not parts:
+                del self._snapshots[server_id]
+                self._expires.pop(server_id, None)
+                return
+            snapshot = dict(snapshot)
+            for part in parts:
+                snapshot.pop(part, None)
+            snapshot.pop('version', None)
+            self._snapshots[server_id] = snapshot
+
+server_snapshots = ServerSnapshotCache()
+
+def _affected_parts(session):
+    """(server_id, part) pairs touched by the pending changes, None for all parts."""
+    affected = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Server):
+            affected.add((obj.id, None if obj in session.deleted else 'server'))
+        elif isinstance(obj, (Category, Channel)):
+            affected.add((obj.server_id, 'categories'))
+            affected.add((obj.server_id, 'uncategorized'))
+    return affected
+
+def _apply(affected):
+    for server_id, part in affected:
+        if part is None:
+            server_snapshots.invalidate(server_id)
+        else:
+            server_snapshots.invalidate(server_id, part)
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_snapshots(session, flush_context):
+    affected = _affected_parts(session)
+    session.info.setdefault('snapshot_invalidations', set()).update(affected)
+    _apply(affected)
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def _finish_snapshot_invalidations(session, *args):
+    _apply(session.info.pop('snapshot_invalidations', ()))
@@ -0,0 +1,111 @@
+"""Active speakers of voice rooms.
+
+Clients report their own microphone level (0 to 1) with audio_level, at most
+a few times per second and only while it changes. Every SPEAKER_INTERVAL
+seconds the tracker turns the reports of each voice room into one
+active_speakers frame for the room. The frame lists the users whose level
+is above SPEAKER_THRESHOLD, or was within the last SPEAKER_HOLD seconds,
+loudest first, with priority speakers ahead of everybody. A room only gets a frame
+when that list changed, so peers never see each other's raw level updates.
+
+Levels live in the worker's memory, like the 'memory' presence backend.
+"""
+import logging
+import threading
+import time
+
+from funlight import socketio
+
+logger = logging.getLogger(__name__)
+
+MAX_ACTIVE_SPEAKERS = 8
+
+class SpeakerTracker:
+    """Latest level per user and room, and the last frame sent per room."""
+    
+    def __init__(self):
+        self.app = None
+        self._levels = {}
+        self._published = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+    
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config['SPEAKER_INTERVAL']
+        self.threshold = app.config['SPEAKER_THRESHOLD']
+        self.hold = app.config['SPEAKER_HOLD']
+        
+        thread = threading.Thread(target=self._run, name='speaker-broadcaster', daemon=True)
+        thread.start()
+    
+    def report(self, room, user_id, level, priority=False):
+        level = min(max(float(level), 0.0), 1.0)
+        with self._lock:
+            users = self._levels.setdefault(room, {})
+            previous = users.get(user_id)
+            if level >= self.threshold:
+                # Clients only report changes, a steady voice stays active
+                users[user_id] = (level, None, priority)
+            elif previous is not None:
+                # Quiet now, listed with its last loud level for the hold time
+                quiet_since = previous[1] if previous[1] is not None else time.monotonic()
+                users[user_id] = (previous[0], quiet_since, priority)
+            self._dirty.add(room)
+    
+    def leave(self, room, user_id):
+        with self._lock:
+            users = self._levels.get(room)
+            if users and users.pop(user_id, None) is not None:
+                self._dirty.add(room)
+    
+    def speakers(self, room, now=None):
+        """The active speakers of a room as sent in active_speakers."""
+        now = now or time.monotonic()
+        with self._lock:
+            users = self._levels.get(room, {})
+            expired = [user_id for user_id, (_, quiet_since, _) in users.items()
+                       if quiet_since is not None and now - quiet_since > self.hold]
+            for user_id in expired:
+                del users[user_id]
+            if not users:
+                self._levels.pop(room, None)
+            active = sorted(users.items(), key=lambda item: (not item[1][2], -item[1][0]))
+        return [{
+            'userId': user_id,
+            # Coarse levels, so small changes do not produce a new frame
+            'level': round(level, 1),
+            'priority': priority
+        } for user_id, (level, _, priority) in active[:MAX_ACTIVE_SPEAKERS]]
+    
+    def flush(self):
+        """Sends a frame to every room whose active speakers changed."""
+        now = time.monotonic()
+        with self._lock:
+            # Rooms with speakers may change by time alone, when a hold runs out
+            rooms = self._dirty | set(self._levels)
+            self._dirty = set()
+        
+        for room in rooms:
+            speakers = self.speakers(room, now)
+            if speakers == self._published.get(room, []):
+                continue
+            if speakers:
+                self._published[room] = speakers
+            else:
+                self._published.pop(room, None)
+            socketio.emit('active_speakers', {
+                'channelId': room.split('_', 1)[1],
+                'speakers': speakers,
+                'priorityActive': any(speaker['priority'] for speaker in speakers)
+            }, room=room)
+    
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Active speaker broadcast failed')
+
+speaker_tracker = SpeakerTracker()
@@ -8,12 +8,19 @@ class ChatManager {
         this.emojiButton = document.querySelector('.emoji-btn');
         this.uploadPreview = document.getElementById('upload-preview');
         this.selectedFiles = [];
+        this.lastTypingPing = 0;
 
         this.initializeEventListeners();
         this.initializeSocketEvents();
         this.initializeAutoResize();
     }
 
+    // The rendered channel, kept up to date when the page switches channels
+    get channelId() {
+        return this.messagesContainer.dataset.channelId ||
+            new URLSearchParams(window.location.search).get('channel_id');
+    }
+
     initializeEventListeners() {
         // Message input handling
         this.messageInput.addEventListener('keypress', (e) => {
@@ -23,6 +30,16 @@ class ChatManager {
             }
         });
 
+        // Pings while typing, the server expires them after a few seconds
+        this.messageInput.addEventListener('input', () => {
+            if (!this.messageInput.value.trim()) {
+                this.stopTyping();
+            } else if (Date.now() - this.lastTypingPing > 3000) {
+                this.lastTypingPing = Date.now();
+                this.socket.emit('typing', { channel_id: this.channelId });
+            }
+        });
+
         // File upload handling
         this.uploadButton.addEventListener('click', () => {
             const input = document.createElement('input');
@@ -44,12 +61,14 @@ class ChatManager {
             this.addMessage(data);
         });
 
+        // One frame per channel with everybody typing, empty when nobody is
         this.socket.on('typing', (data) => {
-            this.showTypingIndicator(data);
-        });
-
-        this.socket.on('stop_typing', (data) => {
-            this.hideTypingIndicator(data);
+            if (String(data.channel_id) !== String(this.channelId)) return;
+            if (data.users.length) {
+                this.showTypingIndicator(data);
+            } else {
+                this.hideTypingIndicator();
+            }
         });
     }
 
@@ -80,6 +99,7 @@ class ChatManager {
         .then(response => response.json())
         .then(data => {
             if (data.success) {
+                this.stopTyping();
                 this.messageInput.value = '';
                 this.messageInput.style.height = 'auto';
                 this.clearUploadPreview();
@@ -228,12 +248,36 @@ class ChatManager {
         this.messagesContainer.scrollTop = this.messagesContainer.scrollHeight;
     }
 
-    showTypingIndicator(user) {
-        // TODO: Implement typing indicator
+    stopTyping() {
+        if (!this.lastTypingPing) return;
+        this.lastTypingPing = 0;
+        this.socket.emit('stop_typing', { channel_id: this.channelId });
+    }
+
+    showTypingIndicator(data) {
+        let indicator = document.getElementById('typing-indicator');
+        if (!indicator) {
+            indicator = document.createElement('div');
+            indicator.id = 'typing-indicator';
+            indicator.className = 'typing-indicator';
+            this.messagesContainer.after(indicator);
+        }
+
+        const names = data.users.map(user => user.username);
+        if (data.count > names.length) {
+            indicator.textContent = 'Several people are typing...';
+        } else if (names.length === 1) {
+            indicator.textContent = `${names[0]} is typing...`;
+        } else {
+            indicator.textContent = `${names.slice(0, -1).join(', ')} and ${names[names.length - 1]} are typing...`;
+        }
     }
 
-    hideTypingIndicator(user) {
-        // TODO: Implement typing indicator removal
+    hideTypingIndicator() {
+        const indicator = document.getElementById('typing-indicator');
+        if (indicator) {
+            indicator.remove();
+        }
     }
 
     showError(message) {
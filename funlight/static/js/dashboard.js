@@ -232,11 +232,96 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    let openConversationId = null;
+
     function openDirectMessage(channelId) {
-        // Update UI to show DM chat
-        // This will be implemented when we add DM functionality
+        openConversationId = Number(channelId);
+        document.querySelectorAll('.dm-item').forEach(item => {
+            item.classList.toggle('active', Number(item.dataset.dmId) === openConversationId);
+            if (Number(item.dataset.dmId) === openConversationId) item.classList.remove('unread');
+        });
+
+        const friendsContainer = document.querySelector('.friends-container');
+        if (friendsContainer) friendsContainer.classList.add('hidden');
+
+        let dmChat = document.getElementById('dm-chat');
+        if (!dmChat) {
+            dmChat = document.createElement('div');
+            dmChat.id = 'dm-chat';
+            dmChat.className = 'dm-chat';
+            dmChat.innerHTML = `
+                <div class="dm-messages" id="dm-messages"></div>
+                <input type="text" class="dm-input" id="dm-input" placeholder="Nachricht senden">
+            `;
+            document.querySelector('.chat-area').appendChild(dmChat);
+
+            dmChat.querySelector('#dm-input').addEventListener('keypress', function(e) {
+                const content = this.value.trim();
+                if (e.key === 'Enter' && content && openConversationId) {
+                    socket.emit('dm_message', {
+                        conversation_id: openConversationId,
+                        content: content
+                    });
+                    this.value = '';
+                }
+            });
+        }
+
+        const messages = dmChat.querySelector('#dm-messages');
+        messages.innerHTML = '';
+        fetch(`/api/dm/${openConversationId}/messages`)
+            .then(response => response.json())
+            .then(data => {
+                data.messages.forEach(message => appendDirectMessage(message.author.username, message.content));
+            });
     }
 
+    function appendDirectMessage(username, content) {
+        const messages = document.getElementById('dm-messages');
+        const messageEl = document.createElement('div');
+        messageEl.className = 'dm-message';
+        const author = document.createElement('span');
+        author.className = 'dm-message-author';
+        author.textContent = username;
+        const text = document.createElement('span');
+        text.className = 'dm-message-text';
+        text.textContent = content;
+        messageEl.append(author, text);
+        messages.appendChild(messageEl);
+        messages.scrollTop = messages.scrollHeight;
+    }
+
+    // Delivered to our user room, whichever conversation it belongs to
+    socket.on('dm_message', function(data) {
+        if (data.conversation_id === openConversationId) {
+            appendDirectMessage(data.username, data.content);
+            return;
+        }
+        const dmItem = document.querySelector(`[data-dm-id="${data.conversation_id}"]`);
+        if (dmItem) {
+            dmItem.classList.add('unread');
+        } else {
+            loadConversations();
+        }
+    });
+
+    function loadConversations() {
+        fetch('/api/dm')
+            .then(response => response.json())
+            .then(data => {
+                data.conversations.forEach(conversation => {
+                    const friend = conversation.participants[0];
+                    if (!friend) return;
+                    addDmToList({
+                        channel_id: conversation.channel_id,
+                        friend: conversation.name ? { ...friend, username: conversation.name } : friend
+                    });
+                });
+            });
+    }
+
+    loadConversations();
+
     // Server Settings Modal Functionality
     const serverSettingsModal = document.getElementById('serverSettingsModal');
     const deleteServerConfirmModal = document.getElementById('deleteServerConfirmModal');
@@ -42,14 +42,19 @@ class ServerManager {
     initializeSocketEvents() {
         if (!this.socket) return;
 
-        this.socket.on('user_status_changed', (data) => {
-            const userEl = document.querySelector(`[data-user-id="${data.user_id}"]`);
-            if (userEl) {
-                const statusIndicator = userEl.querySelector('.status-indicator');
-                if (statusIndicator) {
-                    statusIndicator.className = `status-indicator ${data.status}`;
-                }
-            }
+        // Status changes arrive batched: {online: [userIds], offline: [userIds]}
+        this.socket.on('presence_update', (data) => {
+            ['online', 'offline'].forEach(status => {
+                data[status].forEach(userId => {
+                    const userEl = document.querySelector(`[data-user-id="${userId}"]`);
+                    if (userEl) {
+                        const statusIndicator = userEl.querySelector('.status-indicator');
+                        if (statusIndicator) {
+                            statusIndicator.className = `status-indicator ${status}`;
+                        }
+                    }
+                });
+            });
         });
 
         this.socket.on('message', (data) => {
@@ -1009,7 +1014,7 @@ class ServerManager {
         
         if (server.icon) {
             const img = document.createElement('img');
-            img.src = `/static/uploads/${server.icon}`;
+            img.src = (server.icon_variants && server.icon_variants['96']) || `/static/${server.icon}`;
             img.alt = server.name;
             serverIcon.appendChild(img);
         } else {
@@ -1636,7 +1641,7 @@ document.addEventListener('DOMContentLoaded', function() {
             // Add active class to clicked channel
             this.classList.add('active');
             // Update URL without page reload
-            history.pushState({}, '', `?channel=${channelId}`);
+            history.pushState({}, '', `?channel_id=${channelId}`);
             loadChannelContent(channelId);
         });
     });
@@ -1687,6 +1692,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // Message handling
     const messageInput = document.querySelector('.message-input');
+    let lastTypingPing = 0;
     if (messageInput) {
         messageInput.addEventListener('keypress', function(e) {
             if (e.key === 'Enter' && !e.shiftKey) {
@@ -1699,9 +1705,57 @@ document.addEventListener('DOMContentLoaded', function() {
                         content: message
                     });
                     this.textContent = '';
+                    lastTypingPing = 0;
                 }
             }
         });
+
+        // Pings while typing, the server expires them after a few seconds
+        messageInput.addEventListener('input', function() {
+            const channelId = getCurrentChannelId();
+            if (!channelId) return;
+            if (!this.textContent.trim()) {
+                stopTyping(channelId);
+            } else if (Date.now() - lastTypingPing > 3000) {
+                lastTypingPing = Date.now();
+                socket.emit('typing', { channel_id: Number(channelId) });
+            }
+        });
+    }
+
+    function stopTyping(channelId) {
+        if (!lastTypingPing) return;
+        lastTypingPing = 0;
+        socket.emit('stop_typing', { channel_id: Number(channelId) });
+    }
+
+    // One frame per channel with everybody typing, empty when nobody is
+    socket.on('typing', function(data) {
+        if (String(data.channel_id) !== String(getCurrentChannelId())) return;
+        showTyping(data);
+    });
+
+    function showTyping(data) {
+        let indicator = document.getElementById('typing-indicator');
+        if (!data.users.length) {
+            if (indicator) indicator.remove();
+            return;
+        }
+        if (!indicator) {
+            indicator = document.createElement('div');
+            indicator.id = 'typing-indicator';
+            indicator.className = 'typing-indicator';
+            document.getElementById('messages').after(indicator);
+        }
+
+        const names = data.users.map(user => user.username);
+        if (data.count > names.length) {
+            indicator.textContent = 'Several people are typing...';
+        } else if (names.length === 1) {
+            indicator.textContent = `${names[0]} is typing...`;
+        } else {
+            indicator.textContent = `${names.slice(0, -1).join(', ')} and ${names[names.length - 1]} are typing...`;
+        }
     }
 
     // Socket events
@@ -1709,6 +1763,60 @@ document.addEventListener('DOMContentLoaded', function() {
         appendMessage(data);
     });
 
+    // Edits and deletes arrive as deltas numbered by the channel's seq
+    let channelSeq = null;
+    // Channel events are numbered by event_seq, replayed after a reconnect
+    let eventEpoch = null;
+    let eventSeq = null;
+    let newestMessageId = null;
+
+    socket.on('new_message', function(data) {
+        trackEvent(data);
+        if (String(data.channel_id) !== String(getCurrentChannelId())) return;
+        appendMessage({
+            id: data.message_id,
+            content: data.content,
+            author: { username: data.username, avatar: data.avatar_url },
+            timestamp: data.created_at
+        });
+    });
+
+    socket.on('message_edited', function(data) {
+        trackEvent(data);
+        if (!applyDelta(data)) return;
+        updateMessage(data);
+    });
+
+    socket.on('messages_deleted', function(data) {
+        trackEvent(data);
+        if (!applyDelta(data)) return;
+        data.message_ids.forEach(removeMessage);
+    });
+
+    socket.on('joined_channel', function(data) {
+        eventEpoch = data.epoch;
+        eventSeq = Math.max(eventSeq || 0, data.event_seq);
+    });
+
+    // Replays what was missed while disconnected
+    socket.on('connect', function() {
+        const channelId = getCurrentChannelId();
+        if (!channelId || eventSeq === null) return;
+        socket.emit('resume', { channel_id: Number(channelId), epoch: eventEpoch, event_seq: eventSeq });
+    });
+
+    socket.on('resumed', function(data) {
+        eventEpoch = data.epoch;
+        eventSeq = Math.max(eventSeq || 0, data.event_seq);
+        // The gap was too large for the server's buffer, catch up from the history
+        if (!data.complete) catchUp(data.channel_id);
+    });
+
+    // Read in another tab
+    socket.on('channel_read', function(data) {
+        clearUnread(data.channel_id);
+    });
+
     socket.on('user_joined', function(data) {
         // Handle user joining channel
     });
@@ -1718,26 +1826,117 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 
     // Helper functions
+    // The channel the page rendered or last switched to
     function getCurrentChannelId() {
-        const urlParams = new URLSearchParams(window.location.search);
-        return urlParams.get('channel');
+        return document.getElementById('messages').dataset.channelId || null;
     }
 
     function loadChannelContent(channelId) {
+        const messagesContainer = document.getElementById('messages');
+        if (String(channelId) !== String(getCurrentChannelId())) {
+            stopTyping(getCurrentChannelId());
+            showTyping({ users: [] });
+            messagesContainer.dataset.channelId = channelId;
+        }
+        // Joined first, so nothing sent during the fetch is missed
+        eventSeq = null;
+        newestMessageId = null;
+        socket.emit('join_channel', { channel_id: Number(channelId) });
+
         // Load channel messages and update UI
         fetch(`/api/channels/${channelId}/messages`)
             .then(response => response.json())
             .then(data => {
-                const messagesContainer = document.getElementById('messages');
                 messagesContainer.innerHTML = '';
+                newestMessageId = null;
+                data.messages.forEach(message => appendMessage(message));
+                channelSeq = data.seq;
+                
+                // Everything shown is read now
+                const last = data.messages[data.messages.length - 1];
+                fetch(`/api/channels/${channelId}/ack`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify(last ? { message_id: last.id } : {})
+                });
+                clearUnread(channelId);
+            });
+    }
+    
+    // True if the delta is the next one for the open channel, a gap
+    // fetches everything since the last applied seq instead
+    function applyDelta(data) {
+        if (String(data.channel_id) !== String(getCurrentChannelId()) || channelSeq === null) return false;
+        if (data.seq <= channelSeq) return false;
+        if (data.seq > channelSeq + 1) {
+            resyncChanges(data.channel_id);
+            return false;
+        }
+        channelSeq = data.seq;
+        return true;
+    }
+
+    function trackEvent(data) {
+        if (data.event_seq) eventSeq = Math.max(eventSeq || 0, data.event_seq);
+    }
+
+    function catchUp(channelId) {
+        if (newestMessageId === null) {
+            loadChannelContent(channelId);
+            return;
+        }
+        fetch(`/api/channels/${channelId}/messages?after=${newestMessageId}&limit=100`)
+            .then(response => response.json())
+            .then(data => {
                 data.messages.forEach(message => appendMessage(message));
+                if (data.messages.length === 100) {
+                    catchUp(channelId);
+                } else {
+                    resyncChanges(channelId);
+                }
+            });
+    }
+
+    function resyncChanges(channelId) {
+        fetch(`/api/channels/${channelId}/changes?since=${channelSeq}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.reset) {
+                    loadChannelContent(channelId);
+                    return;
+                }
+                data.edited.forEach(updateMessage);
+                data.deleted.forEach(removeMessage);
+                channelSeq = data.seq;
             });
     }
 
+    function updateMessage(data) {
+        const text = document.querySelector(`.message[data-message-id="${data.message_id}"] .message-text`);
+        if (text) text.innerHTML = marked.parse(data.content);
+    }
+
+    function removeMessage(messageId) {
+        const messageEl = document.querySelector(`.message[data-message-id="${messageId}"]`);
+        if (messageEl) messageEl.remove();
+    }
+
+    function clearUnread(channelId) {
+        const channel = document.querySelector(`.channel-item[data-channel-id="${channelId}"]`);
+        if (!channel) return;
+        channel.classList.remove('unread');
+        const badge = channel.querySelector('.mention-badge');
+        if (badge) badge.remove();
+    }
+
     function appendMessage(message) {
+        // Replayed events may repeat messages the history already showed
+        if (newestMessageId !== null && message.id <= newestMessageId) return;
+        newestMessageId = message.id;
         const messagesContainer = document.getElementById('messages');
         const messageEl = document.createElement('div');
         messageEl.className = 'message';
+        messageEl.dataset.messageId = message.id;
         messageEl.innerHTML = `
             <img src="${message.author.avatar}" alt="${message.author.username}" class="message-avatar">
             <div class="message-content">
@@ -1756,7 +1955,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const currentChannelId = getCurrentChannelId();
     if (currentChannelId) {
         loadChannelContent(currentChannelId);
-        const currentChannel = document.querySelector(`[data-channel-id="${currentChannelId}"]`);
+        const currentChannel = document.querySelector(`.channel-item[data-channel-id="${currentChannelId}"]`);
         if (currentChannel) currentChannel.classList.add('active');
     }
 });
@@ -121,6 +121,11 @@ class VideoChat {
             this.webrtc.socket.emit('join_video', {
                 roomId: roomId
             });
+            
+            // Keep our presence in the room alive, the server drops silent sockets
+            this.heartbeat = setInterval(() => {
+                this.webrtc.socket.emit('presence_heartbeat');
+            }, 10000);
         } catch (error) {
             console.error('Error joining video room:', error);
             throw error;
@@ -130,12 +135,15 @@ class VideoChat {
     async leaveVideoRoom() {
         if (!this.currentRoom) return;
         
+        const roomId = this.currentRoom;
+        
         this.webrtc.endAllCalls();
+        clearInterval(this.heartbeat);
         this.currentRoom = null;
         this.isConnected = false;
         
         this.webrtc.socket.emit('leave_video', {
-            roomId: this.currentRoom
+            roomId: roomId
         });
         
         this.clearVideoStreams();
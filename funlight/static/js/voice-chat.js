@@ -4,6 +4,8 @@ class VoiceChat {
         this.currentRoom = null;
         this.isConnected = false;
         this.audioElements = new Map();
+        this.volumes = new Map();
+        this.duckedUsers = new Set();
         
         this.initializeEventListeners();
     }
@@ -18,6 +20,39 @@ class VoiceChat {
             const { userId } = event.detail;
             this.removeAudioStream(userId);
         });
+        
+        // The server switches large channels from mesh to its SFU
+        this.webrtc.socket.on('voice_mode', async (data) => {
+            if (String(data.channelId) !== String(this.currentRoom)) return;
+            
+            if (data.mode === 'sfu') {
+                Object.keys(this.webrtc.peerConnections).forEach(userId => {
+                    this.webrtc.endCall(userId);
+                });
+                await this.webrtc.joinSfu(this.currentRoom);
+            } else {
+                this.webrtc.leaveSfu();
+            }
+        });
+        
+        // Throttled by the server, only sent when the speakers changed
+        this.webrtc.socket.on('active_speakers', (data) => {
+            if (String(data.channelId) !== String(this.currentRoom)) return;
+            
+            // While a priority speaker talks, everybody else is turned down
+            const priorityIds = new Set(data.speakers.filter(speaker => speaker.priority).map(speaker => String(speaker.userId)));
+            this.duckedUsers = new Set();
+            if (data.priorityActive) {
+                this.audioElements.forEach((audio, userId) => {
+                    if (!priorityIds.has(String(userId))) this.duckedUsers.add(userId);
+                });
+            }
+            this.audioElements.forEach((audio, userId) => this.applyVolume(userId));
+            
+            window.dispatchEvent(new CustomEvent('active_speakers', {
+                detail: data
+            }));
+        });
     }
     
     async joinVoiceChannel(channelId) {
@@ -37,6 +72,12 @@ class VoiceChat {
                 channelId: channelId
             });
             
+            // Keep our presence in the room alive, the server drops silent sockets
+            this.heartbeat = setInterval(() => {
+                this.webrtc.socket.emit('presence_heartbeat');
+            }, 10000);
+            
+            this.startLevelMonitor(channelId);
             this.updateVoiceStatus();
         } catch (error) {
             console.error('Error joining voice channel:', error);
@@ -47,19 +88,60 @@ class VoiceChat {
     async leaveVoiceChannel() {
         if (!this.currentRoom) return;
         
+        const channelId = this.currentRoom;
+        
         this.webrtc.endAllCalls();
+        clearInterval(this.heartbeat);
+        this.stopLevelMonitor();
         this.currentRoom = null;
         this.isConnected = false;
         
         // Notify server about leaving voice channel
         this.webrtc.socket.emit('leave_voice', {
-            channelId: this.currentRoom
+            channelId: channelId
         });
         
         this.clearAudioStreams();
         this.updateVoiceStatus();
     }
     
+    startLevelMonitor(channelId) {
+        const audioTrack = this.webrtc.localStream.getAudioTracks()[0];
+        if (!audioTrack) return;
+        
+        this.audioContext = new AudioContext();
+        const analyser = this.audioContext.createAnalyser();
+        analyser.fftSize = 512;
+        this.audioContext.createMediaStreamSource(new MediaStream([audioTrack])).connect(analyser);
+        const samples = new Float32Array(analyser.fftSize);
+        let lastLevel = 0;
+        
+        // Only changes are reported, the server decides who is speaking
+        this.levelMonitor = setInterval(() => {
+            analyser.getFloatTimeDomainData(samples);
+            let sum = 0;
+            for (const sample of samples) sum += sample * sample;
+            const level = audioTrack.enabled ? Math.min(1, Math.sqrt(sum / samples.length) * 4) : 0;
+            
+            if (Math.abs(level - lastLevel) >= 0.05 || (level === 0 && lastLevel !== 0)) {
+                lastLevel = level;
+                this.webrtc.socket.emit('audio_level', {
+                    channelId: channelId,
+                    level: Math.round(level * 100) / 100
+                });
+            }
+        }, 250);
+    }
+    
+    stopLevelMonitor() {
+        clearInterval(this.levelMonitor);
+        if (this.audioContext) {
+            this.audioContext.close();
+            this.audioContext = null;
+        }
+        this.duckedUsers = new Set();
+    }
+    
     addAudioStream(userId, stream) {
         if (this.audioElements.has(userId)) {
             this.removeAudioStream(userId);
@@ -70,6 +152,7 @@ class VoiceChat {
         audioElement.autoplay = true;
         
         this.audioElements.set(userId, audioElement);
+        this.applyVolume(userId);
         this.updateVoiceStatus();
     }
     
@@ -79,6 +162,7 @@ class VoiceChat {
             audioElement.srcObject = null;
             this.audioElements.delete(userId);
         }
+        this.duckedUsers.delete(userId);
         this.updateVoiceStatus();
     }
     
@@ -113,9 +197,15 @@ class VoiceChat {
     }
     
     setVolume(userId, volume) {
+        this.volumes.set(userId, Math.max(0, Math.min(1, volume)));
+        this.applyVolume(userId);
+    }
+    
+    applyVolume(userId) {
         const audioElement = this.audioElements.get(userId);
         if (audioElement) {
-            audioElement.volume = Math.max(0, Math.min(1, volume));
+            const volume = this.volumes.has(userId) ? this.volumes.get(userId) : 1;
+            audioElement.volume = this.duckedUsers.has(userId) ? volume * 0.3 : volume;
         }
     }
 }
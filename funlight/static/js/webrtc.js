@@ -3,6 +3,14 @@ class WebRTCHandler {
         this.socket = socket;
         this.localStream = null;
         this.peerConnections = {};
+        // Trickle ICE candidates are sent in batches, one frame per peer and tick
+        this.pendingCandidates = {};
+        this.candidateFlushDelay = 10;
+        // Large voice channels connect to the server (SFU) instead of each peer
+        this.sfuConnection = null;
+        this.sfuChannelId = null;
+        this.sfuTracks = {};
+        this.sfuSignaling = Promise.resolve();
         this.mediaConstraints = {
             audio: true,
             video: {
@@ -35,18 +43,126 @@ class WebRTCHandler {
             }
         });
         
-        this.socket.on('ice_candidate', async (data) => {
-            const { candidate, from } = data;
+        this.socket.on('ice_candidates', async (data) => {
+            const { candidates, from } = data;
             const pc = this.peerConnections[from];
             if (pc) {
-                await pc.addIceCandidate(new RTCIceCandidate(candidate));
+                for (const candidate of candidates) {
+                    await pc.addIceCandidate(new RTCIceCandidate(candidate));
+                }
             }
         });
         
+        this.socket.on('call_failed', (data) => {
+            const { to } = data;
+            this.handleCallEnded(to);
+        });
+        
         this.socket.on('call_ended', (data) => {
             const { from } = data;
             this.handleCallEnded(from);
         });
+        
+        // SFU signaling is handled strictly in order
+        this.socket.on('sfu_answer', (data) => {
+            this.queueSfuSignal(data, async (pc) => {
+                await pc.setRemoteDescription(new RTCSessionDescription(data));
+            });
+        });
+        
+        this.socket.on('sfu_offer', (data) => {
+            this.queueSfuSignal(data, async (pc) => {
+                await pc.setRemoteDescription(new RTCSessionDescription(data));
+                const answer = await pc.createAnswer();
+                await pc.setLocalDescription(answer);
+                this.socket.emit('sfu_answer', {
+                    channelId: this.sfuChannelId,
+                    sdp: pc.localDescription.sdp,
+                    type: pc.localDescription.type
+                });
+                this.applySfuTracks(data.tracks);
+            });
+        });
+        
+        this.socket.on('sfu_tracks', (data) => {
+            this.queueSfuSignal(data, async () => {
+                this.applySfuTracks(data.tracks);
+            });
+        });
+    }
+    
+    queueSfuSignal(data, handler) {
+        this.sfuSignaling = this.sfuSignaling.then(() => {
+            const pc = this.sfuConnection;
+            if (pc && String(data.channelId) === String(this.sfuChannelId)) {
+                return handler(pc);
+            }
+        }).catch(error => console.error('SFU signaling error:', error));
+    }
+    
+    async joinSfu(channelId) {
+        this.leaveSfu();
+        if (!this.localStream) {
+            await this.startLocalStream(true);
+        }
+        
+        const pc = new RTCPeerConnection(this.configuration);
+        this.sfuConnection = pc;
+        this.sfuChannelId = channelId;
+        this.sfuTracks = {};
+        
+        this.localStream.getAudioTracks().forEach(track => {
+            pc.addTrack(track, this.localStream);
+        });
+        
+        const offer = await pc.createOffer();
+        await pc.setLocalDescription(offer);
+        // The server does not take trickled candidates, send them with the offer
+        await new Promise(resolve => {
+            if (pc.iceGatheringState === 'complete') {
+                resolve();
+                return;
+            }
+            pc.addEventListener('icegatheringstatechange', () => {
+                if (pc.iceGatheringState === 'complete') {
+                    resolve();
+                }
+            });
+        });
+        
+        this.socket.emit('sfu_join', {
+            channelId: channelId,
+            sdp: pc.localDescription.sdp,
+            type: pc.localDescription.type
+        });
+    }
+    
+    applySfuTracks(tracks) {
+        // Slots are reused, so a mid may carry a different user than before
+        const previous = this.sfuTracks;
+        this.sfuTracks = tracks || {};
+        
+        Object.values(previous).forEach(userId => {
+            if (!Object.values(this.sfuTracks).includes(userId)) {
+                this.handleCallEnded(userId);
+            }
+        });
+        this.sfuConnection.getTransceivers().forEach(transceiver => {
+            const userId = this.sfuTracks[transceiver.mid];
+            if (userId !== undefined && previous[transceiver.mid] !== userId) {
+                this.handleRemoteStream(new MediaStream([transceiver.receiver.track]), userId);
+            }
+        });
+    }
+    
+    leaveSfu() {
+        if (this.sfuConnection) {
+            this.sfuConnection.close();
+            Object.values(this.sfuTracks).forEach(userId => this.handleCallEnded(userId));
+        }
+        this.sfuConnection = null;
+        this.sfuChannelId = null;
+        this.sfuTracks = {};
     }
     
     async startLocalStream(audioOnly = false) {
@@ -78,10 +194,7 @@ class WebRTCHandler {
             
             pc.onicecandidate = (event) => {
                 if (event.candidate) {
-                    this.socket.emit('ice_candidate', {
-                        candidate: event.candidate,
-                        to: userId
-                    });
+                    this.queueCandidate(userId, event.candidate);
                 }
             };
             
@@ -117,10 +230,7 @@ class WebRTCHandler {
             
             pc.onicecandidate = (event) => {
                 if (event.candidate) {
-                    this.socket.emit('ice_candidate', {
-                        candidate: event.candidate,
-                        to: from
-                    });
+                    this.queueCandidate(from, event.candidate);
                 }
             };
             
@@ -142,6 +252,25 @@ class WebRTCHandler {
         }
     }
     
+    queueCandidate(userId, candidate) {
+        if (!this.pendingCandidates[userId]) {
+            this.pendingCandidates[userId] = [];
+            setTimeout(() => this.flushCandidates(userId), this.candidateFlushDelay);
+        }
+        this.pendingCandidates[userId].push(candidate.toJSON ? candidate.toJSON() : candidate);
+    }
+    
+    flushCandidates(userId) {
+        const candidates = this.pendingCandidates[userId];
+        delete this.pendingCandidates[userId];
+        if (candidates && candidates.length && this.peerConnections[userId]) {
+            this.socket.emit('ice_candidates', {
+                candidates: candidates,
+                to: userId
+            });
+        }
+    }
+    
     handleRemoteStream(stream, userId) {
         const event = new CustomEvent('remote_stream', {
             detail: { stream, userId }
@@ -150,6 +279,7 @@ class WebRTCHandler {
     }
     
     handleCallEnded(userId) {
+        delete this.pendingCandidates[userId];
         if (this.peerConnections[userId]) {
             this.peerConnections[userId].close();
             delete this.peerConnections[userId];
@@ -162,6 +292,7 @@ class WebRTCHandler {
     }
     
     endCall(userId) {
+        delete this.pendingCandidates[userId];
         if (this.peerConnections[userId]) {
             this.peerConnections[userId].close();
             delete this.peerConnections[userId];
@@ -176,6 +307,7 @@ class WebRTCHandler {
         Object.keys(this.peerConnections).forEach(userId => {
             this.endCall(userId);
         });
+        this.leaveSfu();
         
         if (this.localStream) {
             this.localStream.getTracks().forEach(track => track.stop());
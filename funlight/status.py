@@ -0,0 +1,151 @@
+"""Online/offline status with coalesced broadcasts.
+
+Every connected socket is kept in the 'online' room of the presence store,
+so with the 'database' backend all workers see the same sockets. Once per
+STATUS_FLUSH_INTERVAL the users whose status really changed are written in
+bulk and announced in one presence_update frame per audience room: the
+server_<id> rooms of the user's servers and the user_<id> rooms of the
+user's friends. A user only goes offline after STATUS_OFFLINE_GRACE
+seconds without a socket on any worker, so reloads and flapping
+connections never produce a broadcast.
+
+Sockets never send presence heartbeats for this room, the worker that
+holds them refreshes them instead. The sockets of a worker that dies
+expire after PRESENCE_TTL and their users go offline.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from funlight import db, socketio
+from funlight.friends import friend_pairs
+from funlight.models import User, ServerMember
+from funlight.presence import presence
+
+logger = logging.getLogger(__name__)
+
+ROOM = 'online'
+
+def _key(sid):
+    # Separate from the socket's voice/video entries, which expire on their own
+    return f'status:{sid}'
+
+class StatusTracker:
+    """The sockets this worker keeps online and users waiting out the grace period."""
+    
+    def __init__(self):
+        self.app = None
+        self._sockets = {}
+        self._offline_since = {}
+        self._dirty = set()
+        self._refreshed = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def init_app(self, app):
+        self.app = app
+        self.offline_grace = app.config['STATUS_OFFLINE_GRACE']
+        self.flush_interval = app.config['STATUS_FLUSH_INTERVAL']
+        self.refresh_interval = app.config['PRESENCE_TTL'] / 3
+        presence.on_expire(self._expired)
+        
+        thread = threading.Thread(target=self._run, name='status-broadcaster', daemon=True)
+        thread.start()
+    
+    def connect(self, user_id, sid):
+        is_new = presence.join(ROOM, user_id, _key(sid))
+        with self._lock:
+            self._sockets[_key(sid)] = user_id
+            self._offline_since.pop(user_id, None)
+            if is_new:
+                self._dirty.add(user_id)
+    
+    def disconnect(self, user_id, sid):
+        with self._lock:
+            self._sockets.pop(_key(sid), None)
+        if presence.leave(ROOM, _key(sid)) is not None:
+            self._went_offline(user_id)
+    
+    def flush(self):
+        """Persists and broadcasts every status that changed since the last flush."""
+        changes = self._collect()
+        # A socket may have come up on another worker during the grace period
+        changes = {user_id: status for user_id, status in changes.items()
+                   if status == 'online' or not presence.present(ROOM, user_id)}
+        if not changes:
+            return
+        
+        # Another worker may have announced the same change already
+        announced = {user_id for user_id, status in db.session.query(User.id, User.status).filter(
+            User.id.in_(list(changes))
+        ) if status == changes[user_id]}
+        for user_id in announced:
+            del changes[user_id]
+        if not changes:
+            return
+        
+        for status in ('online', 'offline'):
+            user_ids = [user_id for user_id, new_status in changes.items() if new_status == status]
+            if user_ids:
+                User.query.filter(User.id.in_(user_ids)).update({'status': status}, synchronize_session=False)
+        db.session.commit()
+        
+        frames = defaultdict(lambda: {'online': [], 'offline': []})
+        for user_id, server_id in db.session.query(ServerMember.user_id, ServerMember.server_id).filter(
+            ServerMember.user_id.in_(list(changes))
+        ):
+            frames[f'server_{server_id}'][changes[user_id]].append(user_id)
+        for user_id, friend_id in friend_pairs(changes):
+            frames[f'user_{friend_id}'][changes[user_id]].append(user_id)
+        
+        for room, frame in frames.items():
+            socketio.emit('presence_update', frame, room=room)
+    
+    def refresh(self):
+        """Keeps the sockets of this worker from expiring in the presence store."""
+        with self._lock:
+            keys = list(self._sockets)
+        if keys:
+            presence.heartbeat_many(keys)
+        self._refreshed = time.monotonic()
+    
+    def _expired(self, room, user_id):
+        if room == ROOM:
+            self._went_offline(user_id)
+    
+    def _went_offline(self, user_id):
+        with self._lock:
+            self._offline_since[user_id] = time.monotonic()
+            self._dirty.add(user_id)
+    
+    def _collect(self):
+        now = time.monotonic()
+        changes = {}
+        with self._lock:
+            for user_id in list(self._dirty):
+                offline_since = self._offline_since.get(user_id)
+                if offline_since is None:
+                    status = 'online'
+                elif now - offline_since >= self.offline_grace:
+                    status = 'offline'
+                    del self._offline_since[user_id]
+                else:
+                    # Still within the grace period, a reconnect cancels it
+                    continue
+                
+                self._dirty.discard(user_id)
+                changes[user_id] = status
+        return changes
+    
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                with self.app.app_context():
+                    if time.monotonic() - self._refreshed >= self.refresh_interval:
+                        self.refresh()
+                    self.flush()
+            except Exception:
+                logger.exception('Status broadcast failed')
+
+status_tracker = StatusTracker()
@@ -0,0 +1,130 @@
+"""Typing indicators with one coalesced frame per channel.
+
+Clients send typing every few seconds while the user types and stop_typing
+when they send or clear the message. A socket's pings for a channel are
+rate limited to one per TYPING_RATE_LIMIT seconds, the rest is dropped
+before any lookup. A typist expires TYPING_TTL seconds after its last ping.
+
+Every TYPING_INTERVAL seconds each channel whose typists changed gets one
+typing frame with the full list, so the fan-out is one frame per channel
+and tick however many people type. An empty list means nobody types.
+
+The typists live in the worker's memory, like the 'memory' presence backend.
+"""
+import logging
+import threading
+import time
+
+from funlight import socketio
+
+logger = logging.getLogger(__name__)
+
+# Names listed in a frame, clients show "several people are typing" beyond that
+MAX_TYPISTS = 5
+
+class TypingTracker:
+    """Typists per channel, the last ping per socket and the last frame per channel."""
+    
+    def __init__(self):
+        self.app = None
+        self._typists = {}
+        self._targets = {}
+        self._last_ping = {}
+        self._published = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+    
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config['TYPING_INTERVAL']
+        self.ttl = app.config['TYPING_TTL']
+        self.rate_limit = app.config['TYPING_RATE_LIMIT']
+        
+        thread = threading.Thread(target=self._run, name='typing-broadcaster', daemon=True)
+        thread.start()
+    
+    def allow(self, sid, channel_id):
+        """Takes a ping of the socket for the channel, False if it came too soon."""
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_ping.get((sid, channel_id))
+            if last is not None and now - last < self.rate_limit:
+                return False
+            self._last_ping[(sid, channel_id)] = now
+            return True
+    
+    def start(self, channel_id, user_id, username, sid, target):
+        """Marks a user as typing, target is the room or rooms the frames go to."""
+        with self._lock:
+            typists = self._typists.setdefault(channel_id, {})
+            if user_id not in typists:
+                self._dirty.add(channel_id)
+            typists[user_id] = (username, sid, time.monotonic() + self.ttl)
+            self._targets[channel_id] = target
+    
+    def stop(self, channel_id, user_id):
+        with self._lock:
+            typists = self._typists.get(channel_id)
+            if typists and typists.pop(user_id, None) is not None:
+                self._dirty.add(channel_id)
+    
+    def disconnect(self, sid):
+        """Drops everything a socket was typing."""
+        with self._lock:
+            for key in [key for key in self._last_ping if key[0] == sid]:
+                del self._last_ping[key]
+            for channel_id, typists in self._typists.items():
+                for user_id in [user_id for user_id, (_, typist_sid, _) in typists.items() if typist_sid == sid]:
+                    del typists[user_id]
+                    self._dirty.add(channel_id)
+    
+    def flush(self):
+        """Sends a frame to every channel whose typists changed."""
+        now = time.monotonic()
+        frames = []
+        with self._lock:
+            for channel_id, typists in list(self._typists.items()):
+                for user_id in [user_id for user_id, (_, _, expires) in typists.items() if expires <= now]:
+                    del typists[user_id]
+                    self._dirty.add(channel_id)
+            
+            for channel_id in self._dirty:
+                typists = self._typists.get(channel_id, {})
+                users = [{'user_id': user_id, 'username': username}
+                         for user_id, (username, _, _) in sorted(typists.items())]
+                target = self._targets.get(channel_id)
+                if not users:
+                    # Also when a start and a stop fell into one tick and no frame is due
+                    self._typists.pop(channel_id, None)
+                    self._targets.pop(channel_id, None)
+                if users == self._published.get(channel_id, []):
+                    continue
+                frames.append((channel_id, users, target))
+                if users:
+                    self._published[channel_id] = users
+                else:
+                    self._published.pop(channel_id, None)
+            self._dirty = set()
+            
+            # Old rate limit entries would otherwise pile up per socket
+            expired = now - self.rate_limit
+            for key in [key for key, last in self._last_ping.items() if last < expired]:
+                del self._last_ping[key]
+        
+        for channel_id, users, target in frames:
+            if target:
+                socketio.emit('typing', {
+                    'channel_id': channel_id,
+                    'users': users[:MAX_TYPISTS],
+                    'count': len(users)
+                }, room=target)
+    
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Typing broadcast failed')
+
+typing_tracker = TypingTracker()
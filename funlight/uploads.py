@@ -1,57 +1,353 @@
+"""File uploads.
+
+Files are stored under their content hash (<sha256>.<ext>), so identical
+files are kept once and storing a file never has to probe for a free name.
+Data is always copied in COPY_BUFFER_SIZE blocks, memory use does not depend
+on the file size.
+
+Small files can be sent in one multipart request to /upload. Larger ones use
+a resumable upload session:
+
+    POST   /upload/sessions          {filename, size, content_type, message_id?}
+    PUT    /upload/sessions/<id>?offset=<n>   raw chunk bytes
+    GET    /upload/sessions/<id>     current offset, to resume after a failure
+    DELETE /upload/sessions/<id>     abort
+
+Each chunk is a separate request bounded by MAX_CONTENT_LENGTH, while the
+whole file is bounded by MAX_UPLOAD_SIZE. Session state lives on disk next to
+the partial data, so any worker can accept the next chunk.
+"""
+import fcntl
+import hashlib
+import json
+import mimetypes
 import os
-from flask import Blueprint, request, jsonify, current_app
+import re
+import shutil
+import tempfile
+import time
+import uuid
+from flask import Blueprint, request, jsonify, current_app, send_file, redirect
 from flask_login import login_required, current_user
+from sqlalchemy import insert
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 from funlight import db
 from funlight.models import Message, Attachment
+from funlight.message_writer import message_writer
+from funlight.variants import variant_worker, parse_variant_name
 
 uploads = Blueprint('uploads', __name__)
 
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Stored files never change, clients may keep them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_UPLOAD_ID = re.compile(r'[0-9a-f]{32}')
+_CONTENT_NAME = re.compile(r'[0-9a-f]{64}(\.[a-z0-9]+)?')
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
+def _copy(source, target, digest, limit=None):
+    """Copies source to target in blocks, feeding digest, returns the bytes copied."""
+    copied = 0
+    while limit is None or copied < limit:
+        size = COPY_BUFFER_SIZE if limit is None else min(COPY_BUFFER_SIZE, limit - copied)
+        block = source.read(size)
+        if not block:
+            break
+        if digest is not None:
+            digest.update(block)
+        target.write(block)
+        copied += len(block)
+    return copied
+
+def _store(path, digest, filename):
+    """Moves a finished file to its content-addressed name, returns that name."""
+    extension = os.path.splitext(secure_filename(filename))[1].lower()
+    stored_name = digest + extension
+    target = os.path.join(current_app.config['UPLOAD_FOLDER'], stored_name)
+    
+    if os.path.exists(target):
+        # Same content was uploaded before
+        os.remove(path)
+    else:
+        shutil.move(path, target)
+    return stored_name
+
+def is_content_addressed(path):
+    """Whether a path points at a file stored by store_file, which may be shared."""
+    return bool(_CONTENT_NAME.fullmatch(os.path.basename(path)))
+
+def store_file(file):
+    """Streams an uploaded werkzeug file into the upload folder."""
+    digest = hashlib.sha256()
+    fd, path = tempfile.mkstemp(dir=current_app.config['UPLOAD_FOLDER'], prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as target:
+            _copy(file.stream, target, digest)
+        return _store(path, digest.hexdigest(), file.filename)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+def _file_info(stored_name, original_name, content_type):
+    return {
+        'filename': stored_name,
+        'name': original_name,
+        'file_type': content_type,
+        'url': f"/uploads/{stored_name}",
+        'variants': variant_worker.urls(stored_name, 'preview')
+    }
+
+def _own_message(message_id):
+    """The current user's message with that id, None if there is no such message."""
+    # The message may still be waiting in the write-behind buffer
+    message_writer.flush()
+    message = Message.query.get(message_id)
+    if not message or message.user_id != current_user.id:
+        return None
+    return message
+
+def attach_files(message_id, files):
+    """Creates the Attachment rows of a message with one bulk insert."""
+    if not files:
+        return
+    db.session.execute(insert(Attachment), [{
+        'message_id': message_id,
+        'filename': file['filename'],
+        'original_name': file['name'][:255],
+        'file_type': (file['file_type'] or '')[:50]
+    } for file in files])
+    db.session.commit()
+
 @uploads.route('/upload', methods=['POST'])
 @login_required
 def upload_files():
     if 'files[]' not in request.files:
         return jsonify({'error': 'No files provided'}), 400
-        
+    
+    message_id = request.form.get('message_id', type=int)
+    if message_id is not None and not _own_message(message_id):
+        return jsonify({'error': 'Message not found'}), 404
+    
     files = request.files.getlist('files[]')
     uploaded_files = []
     
     for file in files:
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            
-            # Create unique filename
-            base, ext = os.path.splitext(filename)
-            counter = 1
-            while os.path.exists(os.path.join(current_app.config['UPLOAD_FOLDER'], filename)):
-                filename = f"{base}_{counter}{ext}"
-                counter += 1
-            
-            # Save file
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            
-            # Create attachment record
-            attachment = Attachment(
-                filename=filename,
-                file_type=file.content_type
-            )
-            uploaded_files.append({
-                'filename': filename,
-                'file_type': file.content_type,
-                'url': f"/uploads/{filename}"
-            })
+            stored_name = store_file(file)
+            variant_worker.submit(stored_name, 'preview')
+            uploaded_files.append(_file_info(stored_name, file.filename, file.content_type))
+    
+    if message_id is not None:
+        attach_files(message_id, uploaded_files)
     
     return jsonify({
         'success': True,
         'files': uploaded_files
     })
 
+def _session_paths(upload_id):
+    directory = current_app.config['UPLOAD_SESSION_DIR']
+    return os.path.join(directory, upload_id + '.part'), os.path.join(directory, upload_id + '.json')
+
+def _load_session(upload_id):
+    """Session metadata of the current user's upload, None if there is none."""
+    if not _UPLOAD_ID.fullmatch(upload_id):
+        return None
+    _, meta_path = _session_paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            session = json.load(f)
+    except FileNotFoundError:
+        return None
+    if session['user_id'] != current_user.id:
+        return None
+    return session
+
+def _remove_session(upload_id):
+    for path in _session_paths(upload_id):
+        if os.path.exists(path):
+            os.remove(path)
+
+def cleanup_upload_sessions(max_age):
+    """Removes sessions that have not received data for max_age seconds."""
+    directory = current_app.config['UPLOAD_SESSION_DIR']
+    cutoff = time.time() - max_age
+    for entry in os.scandir(directory):
+        upload_id, extension = os.path.splitext(entry.name)
+        if extension == '.part' and entry.stat().st_mtime < cutoff:
+            _remove_session(upload_id)
+
+@uploads.route('/upload/sessions', methods=['POST'])
+@login_required
+def create_upload_session():
+    data = request.get_json() or {}
+    filename = data.get('filename') or ''
+    size = data.get('size')
+    message_id = data.get('message_id')
+    
+    if not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({'error': 'File size is required'}), 400
+    if size > current_app.config['MAX_UPLOAD_SIZE']:
+        return jsonify({'error': 'File is too large'}), 413
+    if message_id is not None and not _own_message(message_id):
+        return jsonify({'error': 'Message not found'}), 404
+    
+    os.makedirs(current_app.config['UPLOAD_SESSION_DIR'], exist_ok=True)
+    cleanup_upload_sessions(current_app.config['UPLOAD_SESSION_TTL'])
+    
+    upload_id = uuid.uuid4().hex
+    part_path, meta_path = _session_paths(upload_id)
+    open(part_path, 'wb').close()
+    with open(meta_path, 'w') as f:
+        json.dump({
+            'user_id': current_user.id,
+            'filename': filename,
+            'content_type': data.get('content_type') or '',
+            'size': size,
+            'message_id': message_id
+        }, f)
+    
+    return jsonify({
+        'upload_id': upload_id,
+        'offset': 0,
+        'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE']
+    }), 201
+
+@uploads.route('/upload/sessions/<upload_id>', methods=['GET'])
+@login_required
+def get_upload_session(upload_id):
+    session = _load_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    part_path, _ = _session_paths(upload_id)
+    return jsonify({
+        'upload_id': upload_id,
+        'offset': os.path.getsize(part_path),
+        'size': session['size']
+    })
+
+@uploads.route('/upload/sessions/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    session = _load_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    part_path, _ = _session_paths(upload_id)
+    with open(part_path, 'ab') as part:
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return jsonify({'error': 'Another chunk is being written'}), 409
+        
+        offset = part.tell()
+        if request.args.get('offset', type=int) != offset:
+            # The client resumes from the offset we actually have
+            return jsonify({'error': 'Offset mismatch', 'offset': offset}), 409
+        
+        remaining = session['size'] - offset
+        if request.content_length is not None and request.content_length > remaining:
+            return jsonify({'error': 'Chunk exceeds the file size', 'offset': offset}), 400
+        
+        offset += _copy(request.stream, part, None, limit=remaining)
+    
+    if offset < session['size']:
+        return jsonify({'upload_id': upload_id, 'offset': offset, 'complete': False})
+    
+    # The hash state cannot survive between requests, so the finished file is
+    # hashed in one more sequential pass
+    digest = hashlib.sha256()
+    with open(part_path, 'rb') as part:
+        while True:
+            block = part.read(COPY_BUFFER_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    
+    stored_name = _store(part_path, digest.hexdigest(), session['filename'])
+    _remove_session(upload_id)
+    variant_worker.submit(stored_name, 'preview')
+    
+    file_info = _file_info(stored_name, session['filename'], session['content_type'])
+    if session['message_id'] is not None:
+        attach_files(session['message_id'], [file_info])
+    
+    return jsonify({'upload_id': upload_id, 'offset': offset, 'complete': True, 'file': file_info})
+
+@uploads.route('/upload/sessions/<upload_id>', methods=['DELETE'])
+@login_required
+def abort_upload_session(upload_id):
+    if not _load_session(upload_id):
+        return jsonify({'error': 'Upload not found'}), 404
+    _remove_session(upload_id)
+    return jsonify({'success': True})
+
+def send_upload(relative_path):
+    """Sends a file from the upload folder.
+    
+    Content-addressed files and variants never change, so they get their hash
+    as a strong ETag and a long private max-age. Range and If-None-Match are
+    answered by werkzeug, which streams through wsgi.file_wrapper (sendfile
+    under gunicorn/uwsgi). With UPLOAD_OFFLOAD the transfer is handed to the
+    front proxy instead and the worker only sends headers.
+    """
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    path = safe_join(upload_folder, relative_path)
+    if path is None or not os.path.isfile(path):
+        return jsonify({'error': 'File not found'}), 404
+    
+    name = os.path.basename(path)
+    immutable = is_content_addressed(name) or parse_variant_name(name) is not None
+    etag = name if immutable else True
+    offload = current_app.config['UPLOAD_OFFLOAD']
+    
+    if offload == 'x-accel-redirect':
+        response = current_app.response_class(mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        if immutable:
+            response.set_etag(etag)
+            if request.if_none_match.contains(etag):
+                response.status_code = 304
+        if response.status_code != 304:
+            # nginx serves the file, including Range requests
+            prefix = current_app.config['UPLOAD_ACCEL_PREFIX'].rstrip('/')
+            response.headers['X-Accel-Redirect'] = f'{prefix}/{relative_path}'
+    else:
+        # USE_X_SENDFILE (set for 'x-sendfile') is applied by send_file itself
+        response = send_file(path, conditional=True, etag=etag)
+    
+    if immutable:
+        response.cache_control.public = False
+        response.cache_control.no_cache = None
+        response.cache_control.private = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+@uploads.route('/uploads/variants/<name>')
+@login_required
+def serve_variant(name):
+    variant = parse_variant_name(name)
+    if not variant:
+        return jsonify({'error': 'File not found'}), 404
+    
+    if not os.path.exists(os.path.join(variant_worker.directory, name)):
+        # Not rendered yet (or lost), show the original meanwhile
+        stored_name, size = variant
+        variant_worker.submit_missing(stored_name, size)
+        return redirect(f'/uploads/{stored_name}')
+    return send_upload(f'variants/{name}')
+
 @uploads.route('/uploads/<path:filename>')
 @login_required
 def serve_file(filename):
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    return send_upload(filename)
@@ -0,0 +1,195 @@
+"""Downscaled image variants for server icons and attachment previews.
+
+After an image is stored, a job on a process pool writes resized copies to
+UPLOAD_FOLDER/variants. A variant is named after the content-addressed
+original, <sha256>.<ext>.<size>.<format>, so it is cached on disk across
+restarts and shared by every upload of the same file. The names are known
+up front, so JSON responses list them right away. Until a variant exists,
+its URL redirects to the original.
+
+The pool is forked once, before the app starts its background threads. If
+a pool process dies, variants are switched off until the next restart.
+"""
+import logging
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from importlib.util import find_spec
+
+logger = logging.getLogger(__name__)
+
+VARIANT_SIZES = {
+    'icon': (48, 96, 256),
+    'preview': (320, 1280)
+}
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
+
+_CONTENT_NAME = re.compile(r'[0-9a-f]{64}(\.[a-z0-9]+)')
+_VARIANT_NAME = re.compile(r'([0-9a-f]{64}\.[a-z0-9]+)\.(\d+)\.(webp|jpeg)')
+
+def variant_name(stored_name, size, image_format):
+    return f'{stored_name}.{size}.{image_format}'
+
+def parse_variant_name(name):
+    """(stored_name, size) of a variant file name, None if it is not one."""
+    match = _VARIANT_NAME.fullmatch(name)
+    if not match:
+        return None
+    return match.group(1), int(match.group(2))
+
+def _image_name(path):
+    """The content-addressed name of an image path, None for anything else."""
+    if not path:
+        return None
+    name = os.path.basename(path)
+    match = _CONTENT_NAME.fullmatch(name)
+    if not match or match.group(1) not in IMAGE_EXTENSIONS:
+        return None
+    return name
+
+def render_variants(source, directory, stored_name, sizes, image_format):
+    """Writes the missing variants of one image. Runs in a pool process."""
+    from PIL import Image
+    
+    written = []
+    with Image.open(source) as image:
+        # Lets the JPEG decoder skip detail the largest variant does not need
+        image.draft('RGB', (max(sizes), max(sizes)))
+        image.seek(0)
+        image.load()
+        
+        for size in sizes:
+            path = os.path.join(directory, variant_name(stored_name, size, image_format))
+            if os.path.exists(path):
+                continue
+            
+            variant = image.copy()
+            # Only ever shrinks, smaller images keep their size
+            variant.thumbnail((size, size), Image.LANCZOS)
+            if image_format == 'jpeg' and variant.mode not in ('RGB', 'L'):
+                variant = variant.convert('RGB')
+            elif variant.mode == 'P':
+                variant = variant.convert('RGBA')
+            
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            variant.save(temp_path, format=image_format.upper(), quality=80)
+            os.replace(temp_path, path)
+            written.append(os.path.basename(path))
+    return written
+
+class VariantWorker:
+    """Queues variant jobs on a process pool, at most one job per image and kind."""
+    
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.image_format = 'webp'
+        self._executor = None
+        self._pending = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+    
+    def init_app(self, app):
+        self.upload_folder = app.config['UPLOAD_FOLDER']
+        self.directory = os.path.join(self.upload_folder, 'variants')
+        self.image_format = app.config['VARIANT_FORMAT']
+        self.workers = app.config['VARIANT_WORKERS']
+        if self.image_format not in ('webp', 'jpeg'):
+            raise ValueError("VARIANT_FORMAT must be 'webp' or 'jpeg'")
+        
+        self.enabled = self.workers > 0
+        if self.enabled and find_spec('PIL') is None:
+            logger.warning('Pillow is not installed, images are served without variants')
+            self.enabled = False
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            # Fork the pool now, while the app has not started any threads yet
+            self._get_executor().submit(os.getpid).result()
+    
+    def urls(self, path, kind):
+        """Variant URLs of an image by size, empty if it gets no variants."""
+        stored_name = _image_name(path)
+        if not self.enabled or not stored_name:
+            return {}
+        return {
+            str(size): f'/uploads/variants/{variant_name(stored_name, size, self.image_format)}'
+            for size in VARIANT_SIZES[kind]
+        }
+    
+    def url(self, path, size):
+        """URL of the smallest icon variant covering size, None if there is none."""
+        stored_name = _image_name(path)
+        if not self.enabled or not stored_name:
+            return None
+        size = next((s for s in VARIANT_SIZES['icon'] if s >= size), VARIANT_SIZES['icon'][-1])
+        return f'/uploads/variants/{variant_name(stored_name, size, self.image_format)}'
+    
+    def submit(self, path, kind):
+        """Queues the variants of an image, returns the job's future or None."""
+        stored_name = _image_name(path)
+        if not self.enabled or not stored_name:
+            return None
+        
+        sizes = VARIANT_SIZES[kind]
+        key = (stored_name, kind)
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+            if key in self._failed:
+                # Not an image Pillow can read, keep serving the original
+                return None
+            if all(os.path.exists(os.path.join(self.directory, variant_name(stored_name, size, self.image_format)))
+                   for size in sizes):
+                return None
+            
+            job = (render_variants, os.path.join(self.upload_folder, stored_name),
+                   self.directory, stored_name, sizes, self.image_format)
+            try:
+                future = self._get_executor().submit(*job)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory). Forking a new pool
+                # now would copy the background threads' locks, so serve
+                # originals until the next restart
+                logger.error('Image variant pool broke, images are served without variants')
+                self.enabled = False
+                return None
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._finish(key, f))
+        return future
+    
+    def submit_missing(self, stored_name, size):
+        """Queues the job that produces a missing variant of the given size."""
+        for kind, sizes in VARIANT_SIZES.items():
+            if size in sizes:
+                return self.submit(stored_name, kind)
+        return None
+    
+    def _get_executor(self):
+        if self._executor is None:
+            # Forked rather than spawned: spawn would re-import run.py, which
+            # creates a whole app in every worker. init_app creates it before
+            # any thread runs, the fork context starts all workers right away
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('fork')
+            )
+        return self._executor
+    
+    def _finish(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+            if future.exception():
+                self._failed.add(key)
+        if future.exception():
+            logger.error('Generating variants of %s failed: %s', key[0], future.exception())
+
+variant_worker = VariantWorker()
+
+def icon_url(icon, size):
+    """URL of a server icon for display at size pixels, used by the templates."""
+    from flask import url_for
+    return variant_worker.url(icon, size) or url_for('static', filename=icon)
@@ -1,14 +1,54 @@
-from flask import Blueprint
+from flask import Blueprint, request
 from flask_login import login_required, current_user
-from flask_socketio import emit, join_room, leave_room
+from flask_socketio import emit, join_room, leave_room, rooms
 from funlight import socketio, db
 from funlight.models import Channel, User
+from funlight.permissions import Permissions, channel_server_id, check_permission
+from funlight.presence import presence
+from funlight.speakers import speaker_tracker
+from funlight.signaling import signaling
+from funlight.sfu import voice_sfu
 
 voice_video = Blueprint('voice_video', __name__)
 
-# Dictionary to keep track of users in voice/video rooms
-voice_rooms = {}
-video_rooms = {}
+# Who is in which voice/video room lives in the presence store, keyed by the
+# socket room name (voice_<channel_id> / video_<room_id>)
+LEFT_EVENTS = {
+    'voice': 'user_left_voice',
+    'video': 'user_left_video'
+}
+
+def _emit_left(room, user_id):
+    speaker_tracker.leave(room, user_id)
+    socketio.emit(LEFT_EVENTS[room.split('_', 1)[0]], {
+        'userId': user_id
+    }, room=room)
+
+def _release_sfu(room):
+    """Closes the SFU of a voice room once nobody is left in it."""
+    kind, channel_id = room.split('_', 1)
+    if kind == 'voice' and voice_sfu.is_active(channel_id) and not presence.members(room):
+        voice_sfu.deactivate(channel_id)
+
+@presence.on_expire
+def handle_presence_expired(room, user_id):
+    if room.split('_', 1)[0] not in LEFT_EVENTS:
+        # Online sockets of the status tracker
+        return
+    _emit_left(room, user_id)
+    _release_sfu(room)
+
+def leave_all_rooms(sid):
+    """Removes a disconnected socket from every voice/video room it was in."""
+    voice_sfu.leave_all(sid)
+    for room, user_id in presence.leave_all(sid):
+        _emit_left(room, user_id)
+        _release_sfu(room)
+
+@socketio.on('presence_heartbeat')
+@login_required
+def handle_presence_heartbeat(data=None):
+    presence.heartbeat(request.sid)
 
 @socketio.on('join_voice')
 @login_required
@@ -16,45 +56,89 @@ def handle_join_voice(data):
     channel_id = data.get('channelId')
     if not channel_id:
         return
-        
+    
+    room = f'voice_{channel_id}'
+    
     # Add user to voice room
-    if channel_id not in voice_rooms:
-        voice_rooms[channel_id] = set()
-    voice_rooms[channel_id].add(current_user.id)
+    is_new = presence.join(room, current_user.id, request.sid)
     
     # Join socket room
-    join_room(f'voice_{channel_id}')
+    join_room(room)
     
     # Notify other users in the room
-    emit('user_joined_voice', {
-        'userId': current_user.id,
-        'username': current_user.username
-    }, room=f'voice_{channel_id}')
+    if is_new:
+        emit('user_joined_voice', {
+            'userId': current_user.id,
+            'username': current_user.username
+        }, room=room)
     
     # Send list of users already in the room
+    members = presence.members(room)
     emit('voice_users', {
-        'users': list(voice_rooms[channel_id])
-    }, room=f'voice_{channel_id}')
+        'users': members
+    }, room=request.sid)
+    
+    # Large channels switch from mesh to the SFU, for everybody in them
+    if voice_sfu.activate(str(channel_id), len(members)):
+        emit('voice_mode', {'channelId': channel_id, 'mode': 'sfu'}, room=room)
+    elif voice_sfu.is_active(str(channel_id)):
+        emit('voice_mode', {'channelId': channel_id, 'mode': 'sfu'}, room=request.sid)
+
+@socketio.on('sfu_join')
+@login_required
+def handle_sfu_join(data):
+    channel_id = data.get('channelId')
+    if not channel_id or current_user.id not in presence.members(f'voice_{channel_id}'):
+        return
+    
+    offer = {'sdp': data.get('sdp'), 'type': data.get('type')}
+    if not voice_sfu.join(str(channel_id), current_user.id, request.sid, offer):
+        # The channel went back to mesh in the meantime
+        emit('voice_mode', {'channelId': channel_id, 'mode': 'mesh'}, room=request.sid)
+
+@socketio.on('sfu_answer')
+@login_required
+def handle_sfu_answer(data):
+    channel_id = data.get('channelId')
+    if channel_id:
+        voice_sfu.answer(str(channel_id), request.sid, {'sdp': data.get('sdp'), 'type': data.get('type')})
+
+@socketio.on('audio_level')
+@login_required
+def handle_audio_level(data):
+    channel_id = data.get('channelId')
+    level = data.get('level')
+    room = f'voice_{channel_id}'
+    if not isinstance(level, (int, float)) or room not in rooms():
+        return
+    
+    try:
+        server_id = channel_server_id(int(channel_id))
+    except (TypeError, ValueError):
+        return
+    priority = server_id is not None and check_permission(current_user.id, server_id, Permissions.PRIORITY_SPEAKER)
+    speaker_tracker.report(room, current_user.id, level, priority)
 
 @socketio.on('leave_voice')
 @login_required
 def handle_leave_voice(data):
     channel_id = data.get('channelId')
-    if not channel_id or channel_id not in voice_rooms:
+    if not channel_id:
         return
-        
+    
+    room = f'voice_{channel_id}'
+    
     # Remove user from voice room
-    voice_rooms[channel_id].discard(current_user.id)
-    if not voice_rooms[channel_id]:
-        del voice_rooms[channel_id]
-        
+    user_id = presence.leave(room, request.sid)
+    voice_sfu.leave(str(channel_id), request.sid)
+    
     # Leave socket room
-    leave_room(f'voice_{channel_id}')
+    leave_room(room)
     
-    # Notify other users
-    emit('user_left_voice', {
-        'userId': current_user.id
-    }, room=f'voice_{channel_id}')
+    # Notify other users once the last socket of the user is gone
+    if user_id is not None:
+        _emit_left(room, user_id)
+    _release_sfu(room)
 
 @socketio.on('join_video')
 @login_required
@@ -62,84 +146,92 @@ def handle_join_video(data):
     room_id = data.get('roomId')
     if not room_id:
         return
-        
+    
+    room = f'video_{room_id}'
+    
     # Add user to video room
-    if room_id not in video_rooms:
-        video_rooms[room_id] = set()
-    video_rooms[room_id].add(current_user.id)
+    is_new = presence.join(room, current_user.id, request.sid)
     
     # Join socket room
-    join_room(f'video_{room_id}')
+    join_room(room)
     
     # Notify other users in the room
-    emit('user_joined_video', {
-        'userId': current_user.id,
-        'username': current_user.username
-    }, room=f'video_{room_id}')
+    if is_new:
+        emit('user_joined_video', {
+            'userId': current_user.id,
+            'username': current_user.username
+        }, room=room)
     
     # Send list of users already in the room
     emit('video_users', {
-        'users': list(video_rooms[room_id])
-    }, room=f'video_{room_id}')
+        'users': presence.members(room)
+    }, room=request.sid)
 
 @socketio.on('leave_video')
 @login_required
 def handle_leave_video(data):
     room_id = data.get('roomId')
-    if not room_id or room_id not in video_rooms:
+    if not room_id:
         return
-        
+    
+    room = f'video_{room_id}'
+    
     # Remove user from video room
-    video_rooms[room_id].discard(current_user.id)
-    if not video_rooms[room_id]:
-        del video_rooms[room_id]
-        
+    user_id = presence.leave(room, request.sid)
+    
     # Leave socket room
-    leave_room(f'video_{room_id}')
+    leave_room(room)
     
-    # Notify other users
-    emit('user_left_video', {
-        'userId': current_user.id
-    }, room=f'video_{room_id}')
+    # Notify other users once the last socket of the user is gone
+    if user_id is not None:
+        _emit_left(room, user_id)
+
+def _peer_id(data):
+    """The user id a signaling message is addressed to, None if it is not one."""
+    to_user = data.get('to') if isinstance(data, dict) else None
+    try:
+        return int(to_user)
+    except (TypeError, ValueError):
+        return None
 
 @socketio.on('call_user')
 @login_required
 def handle_call_user(data):
-    to_user = data.get('to')
-    offer = data.get('offer')
+    to_user = _peer_id(data)
+    if to_user is None:
+        return
     
-    emit('call_user', {
-        'offer': offer,
-        'from': current_user.id
-    }, room=to_user)
+    if not signaling.start_call(current_user.id, request.sid, to_user, data.get('offer')):
+        emit('call_failed', {
+            'to': to_user,
+            'reason': 'unavailable'
+        }, room=request.sid)
 
 @socketio.on('call_accepted')
 @login_required
 def handle_call_accepted(data):
-    to_user = data.get('to')
-    answer = data.get('answer')
-    
-    emit('call_accepted', {
-        'answer': answer,
-        'from': current_user.id
-    }, room=to_user)
+    to_user = _peer_id(data)
+    if to_user is not None:
+        signaling.accept_call(current_user.id, request.sid, to_user, data.get('answer'))
 
 @socketio.on('ice_candidate')
 @login_required
 def handle_ice_candidate(data):
-    to_user = data.get('to')
-    candidate = data.get('candidate')
-    
-    emit('ice_candidate', {
-        'candidate': candidate,
-        'from': current_user.id
-    }, room=to_user)
+    to_user = _peer_id(data)
+    if to_user is not None and data.get('candidate'):
+        signaling.relay_candidates(current_user.id, request.sid, to_user, [data['candidate']])
+
+@socketio.on('ice_candidates')
+@login_required
+def handle_ice_candidates(data):
+    to_user = _peer_id(data)
+    candidates = data.get('candidates')
+    if to_user is not None and isinstance(candidates, list) and candidates:
+        signaling.relay_candidates(current_user.id, request.sid, to_user, candidates)
 
 @socketio.on('end_call')
 @login_required
 def handle_end_call(data):
-    to_user = data.get('to')
-    
-    emit('call_ended', {
-        'from': current_user.id
-    }, room=to_user)
+    to_user = _peer_id(data)
+    if to_user is not None:
+        signaling.end_call(current_user.id, request.sid, to_user)
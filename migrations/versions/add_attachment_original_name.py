@@ -0,0 +1,29 @@
+"""add original_name to attachment
+
+Revision ID: add_attachment_original_name
+Revises: add_message_fts
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_attachment_original_name'
+down_revision = 'add_message_fts'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # init_db adds the column to existing databases too
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('attachment')}
+    if 'original_name' not in columns:
+        with op.batch_alter_table('attachment', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('original_name', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('attachment', schema=None) as batch_op:
+        batch_op.drop_column('original_name')
@@ -0,0 +1,62 @@
+"""add unique server membership, default roles and invites
+
+Revision ID: add_bulk_membership
+Revises: add_attachment_original_name
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_bulk_membership'
+down_revision = 'add_attachment_original_name'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # init_db applies the same changes to existing databases, skip what it did
+    inspector = sa.inspect(op.get_bind())
+    unique = [index['column_names'] for index in inspector.get_indexes('server_member') if index['unique']]
+    unique += [constraint['column_names'] for constraint in inspector.get_unique_constraints('server_member')]
+    if ['server_id', 'user_id'] not in unique:
+        # Keep the oldest of duplicated memberships before adding the constraint
+        op.execute(
+            "DELETE FROM server_member WHERE id NOT IN "
+            "(SELECT MIN(id) FROM server_member GROUP BY server_id, user_id)"
+        )
+        op.execute("DELETE FROM member_roles WHERE member_id NOT IN (SELECT id FROM server_member)")
+        with op.batch_alter_table('server_member', schema=None) as batch_op:
+            batch_op.create_unique_constraint('uq_server_member_server_id_user_id', ['server_id', 'user_id'])
+
+    if 'is_default' not in {column['name'] for column in inspector.get_columns('role')}:
+        with op.batch_alter_table('role', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('is_default', sa.Boolean(), nullable=True))
+
+    op.create_table('invite',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('code', sa.String(length=16), nullable=False),
+        sa.Column('server_id', sa.Integer(), nullable=False),
+        sa.Column('creator_id', sa.Integer(), nullable=False),
+        sa.Column('max_uses', sa.Integer(), nullable=True),
+        sa.Column('uses', sa.Integer(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['creator_id'], ['user.id'], ),
+        sa.ForeignKeyConstraint(['server_id'], ['server.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('code'),
+        if_not_exists=True
+    )
+    op.create_index('ix_invite_server_id', 'invite', ['server_id'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_invite_server_id', table_name='invite')
+    op.drop_table('invite')
+    with op.batch_alter_table('role', schema=None) as batch_op:
+        batch_op.drop_column('is_default')
+    with op.batch_alter_table('server_member', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_server_member_server_id_user_id', type_='unique')
@@ -0,0 +1,62 @@
+"""add direct message tables
+
+Revision ID: add_direct_messages
+Revises: add_read_state
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_direct_messages'
+down_revision = 'add_read_state'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # create_app's create_all makes these tables on existing databases first
+    op.create_table('dm_conversation',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_low_id', sa.Integer(), nullable=True),
+        sa.Column('user_high_id', sa.Integer(), nullable=True),
+        sa.Column('name', sa.String(length=100), nullable=True),
+        sa.Column('last_message_id', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_high_id'], ['user.id'], ),
+        sa.ForeignKeyConstraint(['user_low_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_low_id', 'user_high_id', name='uq_dm_conversation_pair'),
+        if_not_exists=True
+    )
+    op.create_table('dm_participant',
+        sa.Column('conversation_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['conversation_id'], ['dm_conversation.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('conversation_id', 'user_id'),
+        if_not_exists=True
+    )
+    op.create_index('ix_dm_participant_user_id', 'dm_participant', ['user_id'], if_not_exists=True)
+    op.create_table('dm_message',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('conversation_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('content', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['conversation_id'], ['dm_conversation.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        if_not_exists=True
+    )
+    op.create_index('ix_dm_message_conversation_id_id', 'dm_message', ['conversation_id', 'id'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_dm_message_conversation_id_id', table_name='dm_message')
+    op.drop_table('dm_message')
+    op.drop_index('ix_dm_participant_user_id', table_name='dm_participant')
+    op.drop_table('dm_participant')
+    op.drop_table('dm_conversation')
@@ -0,0 +1,90 @@
+"""consolidate friendships, friend_associations and accepted requests into friendship
+
+Revision ID: add_friendship
+Revises: add_direct_messages
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_friendship'
+down_revision = 'add_direct_messages'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # friendships and friend_request were only ever created by db.create_all()
+    tables = set(sa.inspect(op.get_bind()).get_table_names())
+
+    op.create_table('friendship',
+        sa.Column('user_low_id', sa.Integer(), nullable=False),
+        sa.Column('user_high_id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.CheckConstraint('user_low_id < user_high_id', name='ck_friendship_ordered'),
+        sa.ForeignKeyConstraint(['user_high_id'], ['user.id'], ),
+        sa.ForeignKeyConstraint(['user_low_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('user_low_id', 'user_high_id'),
+        if_not_exists=True
+    )
+    op.create_index('ix_friendship_user_high_id_user_low_id', 'friendship', ['user_high_id', 'user_low_id'],
+                    if_not_exists=True)
+
+    if 'friend_request' not in tables:
+        op.create_table('friend_request',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('sender_id', sa.Integer(), nullable=False),
+            sa.Column('receiver_id', sa.Integer(), nullable=False),
+            sa.Column('status', sa.String(length=20), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['receiver_id'], ['user.id'], ),
+            sa.ForeignKeyConstraint(['sender_id'], ['user.id'], ),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    # Shared with init_db, which merges them on databases that skip migrations
+    from funlight.friends import merge_legacy_friendships
+    merge_legacy_friendships(op.get_bind())
+
+    op.create_index('ix_friend_request_receiver_id_status', 'friend_request', ['receiver_id', 'status'],
+                    if_not_exists=True)
+    op.create_index('ix_friend_request_sender_id_receiver_id', 'friend_request', ['sender_id', 'receiver_id'],
+                    if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_friend_request_sender_id_receiver_id', table_name='friend_request')
+    op.drop_index('ix_friend_request_receiver_id_status', table_name='friend_request')
+
+    op.create_table('friend_associations',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user1_id', sa.Integer(), nullable=False),
+        sa.Column('user2_id', sa.Integer(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user1_id'], ['user.id'], ),
+        sa.ForeignKeyConstraint(['user2_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('friendships',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('friend_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['friend_id'], ['user.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'friend_id')
+    )
+    op.execute(
+        "INSERT INTO friend_associations (user1_id, user2_id, status, created_at) "
+        "SELECT user_low_id, user_high_id, 'accepted', created_at FROM friendship"
+    )
+    op.execute(
+        "INSERT INTO friendships (user_id, friend_id) "
+        "SELECT user_low_id, user_high_id FROM friendship "
+        "UNION ALL SELECT user_high_id, user_low_id FROM friendship"
+    )
+
+    op.drop_index('ix_friendship_user_high_id_user_low_id', table_name='friendship')
+    op.drop_table('friendship')
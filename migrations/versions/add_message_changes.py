@@ -0,0 +1,43 @@
+"""add channel seq and message_change
+
+Revision ID: add_message_changes
+Revises: add_friendship
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_message_changes'
+down_revision = 'add_friendship'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # init_db adds the column on existing databases too
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('channel')}
+    if 'seq' not in columns:
+        with op.batch_alter_table('channel', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('seq', sa.Integer(), nullable=False, server_default='0'))
+
+    op.create_table('message_change',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('channel_id', sa.Integer(), nullable=False),
+        sa.Column('seq', sa.Integer(), nullable=False),
+        sa.Column('message_id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=10), nullable=False),
+        sa.ForeignKeyConstraint(['channel_id'], ['channel.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        if_not_exists=True
+    )
+    op.create_index('ix_message_change_channel_id_seq', 'message_change', ['channel_id', 'seq'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_message_change_channel_id_seq', table_name='message_change')
+    op.drop_table('message_change')
+    with op.batch_alter_table('channel', schema=None) as batch_op:
+        batch_op.drop_column('seq')
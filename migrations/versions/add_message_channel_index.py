@@ -0,0 +1,26 @@
+"""add (channel_id, id) index to message
+
+Revision ID: add_message_channel_index
+Revises: add_category_id
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_message_channel_index'
+down_revision = 'add_category_id'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Composite index used by the keyset-paginated history endpoint. init_db
+    # creates it as well, so an existing database may have it already
+    op.create_index('ix_message_channel_id_id', 'message', ['channel_id', 'id'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_message_channel_id_id', table_name='message')
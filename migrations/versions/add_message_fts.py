@@ -0,0 +1,33 @@
+"""add full-text search index over message content
+
+Revision ID: add_message_fts
+Revises: add_server_member_nickname
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_message_fts'
+down_revision = 'add_server_member_nickname'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    from funlight.search import FTS_SCHEMA
+    for statement in FTS_SCHEMA:
+        op.execute(statement)
+    op.execute("INSERT INTO message_fts(message_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for trigger in ('message_fts_insert', 'message_fts_delete', 'message_fts_update'):
+        op.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    op.execute('DROP TABLE IF EXISTS message_fts')
@@ -0,0 +1,48 @@
+"""add channel high-water marks and read_state
+
+Revision ID: add_read_state
+Revises: add_bulk_membership
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_read_state'
+down_revision = 'add_bulk_membership'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # init_db adds and seeds the column on existing databases too
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('channel')}
+    if 'last_message_id' not in columns:
+        with op.batch_alter_table('channel', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('last_message_id', sa.Integer(), nullable=True))
+        # One pass over the (channel_id, id) index to seed the high-water marks
+        op.execute(
+            "UPDATE channel SET last_message_id = "
+            "(SELECT MAX(id) FROM message WHERE message.channel_id = channel.id)"
+        )
+    op.create_index('ix_channel_server_id', 'channel', ['server_id'], if_not_exists=True)
+
+    op.create_table('read_state',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('channel_id', sa.Integer(), nullable=False),
+        sa.Column('last_read_message_id', sa.Integer(), nullable=True),
+        sa.Column('mention_count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['channel_id'], ['channel.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'channel_id'),
+        if_not_exists=True
+    )
+
+
+def downgrade():
+    op.drop_table('read_state')
+    op.drop_index('ix_channel_server_id', table_name='channel')
+    with op.batch_alter_table('channel', schema=None) as batch_op:
+        batch_op.drop_column('last_message_id')
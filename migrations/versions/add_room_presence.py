@@ -0,0 +1,39 @@
+"""add room_presence table
+
+Revision ID: add_room_presence
+Revises: add_message_channel_index
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_room_presence'
+down_revision = 'add_message_channel_index'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Voice/video room presence shared by all workers
+    op.create_table('room_presence',
+        sa.Column('room', sa.String(length=64), nullable=False),
+        sa.Column('sid', sa.String(length=64), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('room', 'sid'),
+        if_not_exists=True
+    )
+    op.create_index('ix_room_presence_room_user_id', 'room_presence', ['room', 'user_id'], if_not_exists=True)
+    op.create_index('ix_room_presence_sid', 'room_presence', ['sid'], if_not_exists=True)
+    op.create_index('ix_room_presence_expires_at', 'room_presence', ['expires_at'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_room_presence_expires_at', table_name='room_presence')
+    op.drop_index('ix_room_presence_sid', table_name='room_presence')
+    op.drop_index('ix_room_presence_room_user_id', table_name='room_presence')
+    op.drop_table('room_presence')
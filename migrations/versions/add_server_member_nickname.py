@@ -0,0 +1,32 @@
+"""add nickname and (server_id, id) index to server_member
+
+Revision ID: add_server_member_nickname
+Revises: add_server_member_user_index
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_server_member_nickname'
+down_revision = 'add_server_member_user_index'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # init_db adds the column to existing databases too
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('server_member')}
+    if 'nickname' not in columns:
+        with op.batch_alter_table('server_member', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('nickname', sa.String(length=32), nullable=True))
+    # Keyset index for the paged member list
+    op.create_index('ix_server_member_server_id_id', 'server_member', ['server_id', 'id'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_server_member_server_id_id', table_name='server_member')
+    with op.batch_alter_table('server_member', schema=None) as batch_op:
+        batch_op.drop_column('nickname')
@@ -0,0 +1,25 @@
+"""add user_id index to server_member
+
+Revision ID: add_server_member_user_index
+Revises: add_room_presence
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_server_member_user_index'
+down_revision = 'add_room_presence'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Looks up the servers of a user for presence fan-out
+    op.create_index('ix_server_member_user_id', 'server_member', ['user_id'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_server_member_user_id', table_name='server_member')
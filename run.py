@@ -1,6 +1,27 @@
+import os
+
+# Green-thread servers need the standard library patched before anything
+# else is imported
+ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
 from funlight import create_app, socketio
 
 app = create_app()
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True)
+    # The threading mode runs on the Werkzeug development server, eventlet and
+    # gevent bring their own production WSGI servers
+    debug = os.environ.get('FLASK_DEBUG', '1' if ASYNC_MODE == 'threading' else '0') == '1'
+    socketio.run(
+        app,
+        host=os.environ.get('HOST', '127.0.0.1'),
+        port=int(os.environ.get('PORT', 5000)),
+        debug=debug,
+        allow_unsafe_werkzeug=ASYNC_MODE == 'threading'
+    )
@@ -0,0 +1,32 @@
+import pytest
+
+from funlight import create_app, db
+from funlight.models import Role, User
+
+@pytest.fixture
+def app(monkeypatch, tmp_path):
+    monkeypatch.setenv('DATABASE_URL', 'sqlite://')
+    monkeypatch.setenv('VARIANT_WORKERS', '0')
+    monkeypatch.setenv('MESSAGE_JOURNAL_DIR', str(tmp_path / 'journal'))
+    monkeypatch.setenv('UPLOAD_SESSION_DIR', str(tmp_path / 'upload_sessions'))
+    app = create_app()
+    app.config['TESTING'] = True
+
+    with app.app_context():
+        owner = User(username='owner', email='owner@example.com')
+        owner.set_password('password')
+        db.session.add(owner)
+        db.session.add_all(User(username=f'user{i}', email=f'user{i}@example.com', password_hash='x')
+                           for i in range(100))
+        db.session.commit()
+    return app
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'owner', 'password': 'password'})
+    client.post('/api/servers', data={'name': 'Server'})
+    with app.app_context():
+        db.session.add(Role(name='everyone', server_id=1, permissions=1, is_default=True))
+        db.session.commit()
+    return client
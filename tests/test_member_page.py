@@ -0,0 +1,35 @@
+import pytest
+from sqlalchemy import event
+
+from funlight import db
+
+def count_statements(app, client, url):
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 200
+    return response, len(statements)
+
+def add_members(client, user_ids):
+    response = client.post('/api/servers/1/members/bulk', json={'user_ids': user_ids})
+    assert response.status_code == 200
+
+@pytest.mark.parametrize('url', ['/server/1/members', '/api/servers/1'])
+def test_member_page_statements_do_not_grow_with_members(app, client, url):
+    add_members(client, list(range(2, 7)))
+    response, few = count_statements(app, client, url)
+    assert len(response.json['members']) == 6
+
+    add_members(client, list(range(7, 102)))
+    response, many = count_statements(app, client, url)
+    assert len(response.json['members']) == 100
+    assert all(member['roles'] for member in response.json['members'][1:])
+    assert many == few
@@ -0,0 +1,25 @@
+import pytest
+
+from funlight import create_app
+
+def test_metrics_answers_loopback(app):
+    response = app.test_client().get('/metrics')
+    assert response.status_code == 200
+
+def test_metrics_refuses_proxied_requests_without_token(app):
+    response = app.test_client().get('/metrics', headers={'X-Forwarded-For': '203.0.113.7'})
+    assert response.status_code == 403
+
+def test_metrics_token(app):
+    app.config['METRICS_TOKEN'] = 'secret'
+    client = app.test_client()
+    assert client.get('/metrics').status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret', 'X-Forwarded-For': '203.0.113.7'})
+    assert response.status_code == 200
+
+def test_front_proxy_requires_token(app, monkeypatch):
+    monkeypatch.setenv('UPLOAD_OFFLOAD', 'x-accel-redirect')
+    with pytest.raises(ValueError):
+        create_app()
+    monkeypatch.setenv('METRICS_TOKEN', 'secret')
+    create_app()
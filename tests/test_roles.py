@@ -0,0 +1,67 @@
+import pytest
+
+from funlight import db
+from funlight.models import Role, ServerMember, User
+from funlight.permissions import Permissions
+
+ADMINISTRATOR = Permissions.ADMINISTRATOR.value
+MANAGE_ROLES = Permissions.MANAGE_ROLES.value
+
+@pytest.fixture
+def member(app, client):
+    """A logged in member of server 1 with only the default @everyone permissions."""
+    with app.app_context():
+        Role.query.filter_by(server_id=1, is_default=True).one().permissions = \
+            Permissions.default_everyone_permissions().value
+        db.session.commit()
+    add = client.post('/api/servers/1/members/bulk', json={'user_ids': [2]})
+    assert add.status_code == 200
+    with app.app_context():
+        user = db.session.get(User, 2)
+        user.set_password('password')
+        db.session.commit()
+    member = app.test_client()
+    member.post('/login', data={'username': 'user0', 'password': 'password'})
+    return member
+
+def grant_manage_roles(app):
+    with app.app_context():
+        role = Role(name='managers', server_id=1, permissions=MANAGE_ROLES | Permissions.VIEW_CHANNEL.value)
+        member = ServerMember.query.filter_by(server_id=1, user_id=2).one()
+        member.roles.append(role)
+        db.session.commit()
+
+def test_member_without_manage_roles_cannot_create_roles(member):
+    response = member.post('/api/servers/1/roles', data={
+        'name': 'admins', 'permissions': ADMINISTRATOR, 'is_default': 'true'
+    })
+    assert response.status_code == 403
+
+def test_owner_creates_roles(client):
+    response = client.post('/api/servers/1/roles', data={'name': 'admins', 'permissions': ADMINISTRATOR})
+    assert response.status_code == 200
+    assert response.json['permissions'] == ADMINISTRATOR
+
+@pytest.mark.parametrize('permissions', ['admin', '-1', str(1 << 40)])
+def test_invalid_permissions_are_rejected(client, permissions):
+    response = client.post('/api/servers/1/roles', data={'name': 'bad', 'permissions': permissions})
+    assert response.status_code == 400
+
+def test_roles_cannot_grant_more_than_the_granter_has(app, member):
+    grant_manage_roles(app)
+    response = member.post('/api/servers/1/roles', data={'name': 'admins', 'permissions': ADMINISTRATOR})
+    assert response.status_code == 403
+    response = member.post('/api/servers/1/roles', data={'name': 'managers 2', 'permissions': MANAGE_ROLES})
+    assert response.status_code == 200
+
+def test_assign_role(app, client, member):
+    admins = client.post('/api/servers/1/roles', data={'name': 'admins', 'permissions': ADMINISTRATOR}).json
+    grant_manage_roles(app)
+    response = member.post('/api/servers/1/members/2/roles', data={'role_id': admins['id']})
+    assert response.status_code == 403
+    
+    response = client.post('/api/servers/1/members/2/roles', data={'role_id': admins['id']})
+    assert response.status_code == 200
+    with app.app_context():
+        roles = ServerMember.query.filter_by(server_id=1, user_id=2).one().roles
+        assert admins['id'] in [role.id for role in roles]
@@ -0,0 +1,16 @@
+from funlight import db
+from funlight.models import Channel
+
+def test_channel_outside_categories_opens(app, client):
+    with app.app_context():
+        # Databases built through the migrations allow channels without a category
+        channel = Channel(name='loose', server_id=1, category_id=999)
+        db.session.add(channel)
+        db.session.commit()
+        channel_id = channel.id
+
+    response = client.get(f'/server/1?channel_id={channel_id}')
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert f'id="messages" data-channel-id="{channel_id}"' in page
+    assert f'<div class="channel-item active" data-channel-id="{channel_id}">' in page
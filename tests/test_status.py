@@ -0,0 +1,52 @@
+import pytest
+
+from funlight import create_app, db
+from funlight.models import User
+from funlight.status import StatusTracker
+
+@pytest.fixture
+def workers(app, monkeypatch):
+    monkeypatch.setenv('PRESENCE_BACKEND', 'database')
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(username='user', email='user@example.com', password_hash='x'))
+        db.session.commit()
+        trackers = [StatusTracker(), StatusTracker()]
+        for tracker in trackers:
+            tracker.offline_grace = 0
+        yield trackers
+
+def status():
+    db.session.expire_all()
+    return db.session.get(User, 1).status
+
+def flush(workers):
+    for tracker in workers:
+        tracker.flush()
+
+def test_user_stays_online_while_any_worker_has_a_socket(workers):
+    first, second = workers
+    first.connect(1, 'a')
+    second.connect(1, 'b')
+    flush(workers)
+    assert status() == 'online'
+    
+    first.disconnect(1, 'a')
+    flush(workers)
+    assert status() == 'online'
+    
+    second.disconnect(1, 'b')
+    flush(workers)
+    assert status() == 'offline'
+
+def test_reconnect_on_another_worker_during_grace(workers):
+    first, second = workers
+    first.offline_grace = 60
+    first.connect(1, 'a')
+    flush(workers)
+    first.disconnect(1, 'a')
+    second.connect(1, 'b')
+    first.offline_grace = 0
+    flush(workers)
+    assert status() == 'online'